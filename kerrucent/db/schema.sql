@@ -19,17 +19,66 @@ create table probes (
     filename text not null,
     mac text not null,
     alpha float,
-    beta float
+    beta float,
+    profile text,
+    check_interval integer
 );
-insert into probes(name, filename, mac, alpha, beta)
+insert into probes(name, filename, mac, alpha, beta, profile)
 values (
     'Ne pas supprimer',
     'test',
     '00:11:22:33:44:55',
     0.000192522,
-    0.00000802250
+    0.00000802250,
+    'dense'
 );
 
+-- Compteur de modifications de la table probes (cf ProbeRegistry)
+drop table if exists probes_version;
+create table probes_version (
+    version integer not null
+);
+insert into probes_version(version) values (0);
+create trigger probes_inserted after insert on probes
+begin
+    update probes_version set version = version + 1;
+end;
+create trigger probes_updated after update on probes
+begin
+    update probes_version set version = version + 1;
+end;
+create trigger probes_deleted after delete on probes
+begin
+    update probes_version set version = version + 1;
+end;
+
+-- Les groupes de capteurs et leur RRD (somme des capteurs, cf GroupAggregator)
+drop table if exists probe_groups;
+create table probe_groups (
+    id integer primary key autoincrement,
+    name text not null,
+    filename text not null,
+    profile text
+);
+drop table if exists probe_group_members;
+create table probe_group_members (
+    group_id integer not null,
+    probe_id integer not null,
+    primary key (group_id, probe_id)
+);
+create trigger probe_groups_changed after delete on probe_groups
+begin
+    update probes_version set version = version + 1;
+end;
+create trigger probe_group_members_inserted after insert on probe_group_members
+begin
+    update probes_version set version = version + 1;
+end;
+create trigger probe_group_members_deleted after delete on probe_group_members
+begin
+    update probes_version set version = version + 1;
+end;
+
 drop table if exists alerts;
 create table alerts (
     id integer primary key autoincrement,
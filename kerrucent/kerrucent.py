@@ -16,19 +16,36 @@ import time
 from random import randint
 from hashlib import sha256
 import threading
+import atexit
+from datetime import datetime
+from werkzeug.http import http_date
 
 # Import other packages
+import click
 from email_validator import validate_email, EmailNotValidError
 
 # Import flask packages
 from flask import Flask, request, session, g, redirect, url_for, abort, \
-     render_template, flash
+     render_template, flash, Response, make_response, jsonify
 
 # Import custom packages
 from .scripts.graph import *
 from .scripts.rrd import *
+from .scripts.fetch import *
+from .scripts.export import *
+from .scripts.series import *
+from .scripts.importer import *
+from .scripts.jobs import *
+from .scripts.groups import *
+from .scripts.alerts import *
 from .scripts.mail import *
 from .scripts.data import *
+from .scripts.batch import *
+from .scripts.server import *
+from .scripts.registry import *
+from .scripts.journal import *
+from .scripts import metrics
+from .scripts.loadgen import *
 
 
 
@@ -69,12 +86,325 @@ def init_db():
         db.cursor().executescript(f.read())
     db.commit()
 
+def upgrade_db():
+    """Met à jour une base de données créée par une version précédente
+    (rien à faire pour une base pas encore initialisée, cf flask initdb)"""
+    db = get_db()
+    if not db.execute('SELECT name FROM sqlite_master WHERE type=\'table\' AND name=\'probes\'').fetchone() :
+        return None
+    columns = [c['name'] for c in db.execute('PRAGMA table_info(probes)').fetchall()]
+    # Le profil de stockage des RRD (NULL : ancien format, cf 'dense')
+    if not 'profile' in columns :
+        db.execute('ALTER TABLE probes ADD COLUMN profile text')
+        db.commit()
+    # L'intervalle de vérification des alertes (NULL : ALERT_INTERVAL)
+    if not 'check_interval' in columns :
+        db.execute('ALTER TABLE probes ADD COLUMN check_interval integer')
+        db.commit()
+    # Les groupes de capteurs (cf schema.sql)
+    tables = [t['name'] for t in db.execute('SELECT name FROM sqlite_master WHERE type=\'table\'').fetchall()]
+    if not 'probe_groups' in tables :
+        db.executescript('''
+            create table if not exists probe_groups (
+                id integer primary key autoincrement,
+                name text not null,
+                filename text not null,
+                profile text
+            );
+            create table if not exists probe_group_members (
+                group_id integer not null,
+                probe_id integer not null,
+                primary key (group_id, probe_id)
+            );''')
+        db.commit()
+    # Le compteur de modifications des capteurs et des groupes (cf ProbeRegistry)
+    if not 'probes_version' in tables :
+        db.executescript('''
+            create table if not exists probes_version (
+                version integer not null
+            );
+            insert into probes_version(version) values (0);''')
+    db.executescript('''
+        create trigger if not exists probes_inserted after insert on probes
+        begin
+            update probes_version set version = version + 1;
+        end;
+        create trigger if not exists probes_updated after update on probes
+        begin
+            update probes_version set version = version + 1;
+        end;
+        create trigger if not exists probes_deleted after delete on probes
+        begin
+            update probes_version set version = version + 1;
+        end;
+        create trigger if not exists probe_groups_changed after delete on probe_groups
+        begin
+            update probes_version set version = version + 1;
+        end;
+        create trigger if not exists probe_group_members_inserted after insert on probe_group_members
+        begin
+            update probes_version set version = version + 1;
+        end;
+        create trigger if not exists probe_group_members_deleted after delete on probe_group_members
+        begin
+            update probes_version set version = version + 1;
+        end;''')
+    db.commit()
+
 @app.cli.command()
 def initdb():
     """Initializes the database."""
     init_db()
     log('Initialized the database.')
 
+@app.cli.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'binary']), default=None,
+        help='Format du fichier (par défaut binary pour un .bin, csv sinon)')
+@click.option('--mac', default=None, help='La mac du capteur si le CSV n\'a pas de colonne mac')
+@click.option('--period', default=86400, help='Période de la prédiction (s) des RRD reconstruites')
+def importdata(path, fmt, mac, period):
+    """Importe l'historique daté de capteurs (par leur mac) dans leur RRD.
+    CSV : mac,timestamp,courant,tension,dephasage,puiss_active,puiss_reactive,puiss_apparente
+    Binaire : suite d'échantillons au format des paquets (sans en-tête).
+    Le fichier doit être trié par date. Une RRD plus récente que le premier
+    échantillon de son capteur est reconstruite (même profil et paramètres de
+    prédiction) en gardant toutes ses données, qui priment sur le fichier.
+    RQ : la reconstruction est refusée si la RRD a plus d'historique que son
+    archive la plus fine ou des données avant le premier échantillon."""
+    if not fmt :
+        fmt = 'binary' if path.endswith('.bin') else 'csv'
+
+    db = get_db()
+    rows = db.execute('SELECT mac, filename, alpha, beta, profile FROM probes').fetchall()
+    probes = {p['mac'] : p['filename'] for p in rows}
+    params = {p['filename'] : p for p in rows}
+    if mac and not normalize_mac(mac) in [normalize_mac(m) for m in probes] :
+        log('Aucun capteur n\'a la mac '+mac)
+        return None
+
+    def progress(stats, elapsed) :
+        log(str(stats['read'])+' échantillons lus, '+str(stats['written'])+' écrits ('
+                +'%.0f' % (stats['written']/elapsed if elapsed else 0)+' par seconde)')
+
+    def create(filename, tmp, start) :
+        p = params[filename]
+        create_rrd(filename, start, alpha=p['alpha'], beta=p['beta'], period=period,
+                profile=p['profile'] or 'dense', path=tmp)
+
+    stats = Importer(probes, progress=progress, create=create).run(path, fmt, mac)
+    log('Import terminé : '+str(stats['written'])+' échantillons écrits ('+str(stats['rebuilt'])+' RRD reconstruites, '
+            +str(stats['refused'])+' reconstructions refusées), '
+            +str(stats['skipped'])+' ignorés (doublons ou dans le désordre), '
+            +str(stats['unknown'])+' de capteurs inconnus, '+str(stats['invalid'])+' illisibles, '
+            +str(stats['errors'])+' en échec, '+str(stats['rejected'])+' valeurs hors plage')
+
+@app.cli.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--profile', default=DEFAULT_STORAGE_PROFILE, type=click.Choice(sorted(STORAGE_PROFILES.keys())),
+        help='Le profil de stockage des nouvelles RRD')
+@click.option('--workers', default=PROVISION_WORKERS, help='Nombre de RRD créées en parallèle')
+def addprobes(path, profile, workers):
+    """Ajoute en masse les capteurs d'un CSV name,mac[,alpha,beta,period].
+    Les RRD sont créées en parallèle, chaque capteur est ajouté
+    à la BDD dès que sa RRD est prête."""
+    with open(path, newline='') as f :
+        probes, errors = parse_onboarding(f)
+    for e in errors :
+        log(e)
+
+    queue = ProvisionQueue(register_probe, workers=workers, log=log)
+    queue.start()
+    start = time.time()
+    jobs = [queue.submit(p['name'], p['mac'], alpha=p['alpha'], beta=p['beta'], period=p['period'], profile=profile)
+            for p in probes]
+    log('Création de '+str(len(jobs))+' RRD ('+profile+', environ '+human_size(rrd_size(profile, DEFAULT_PERIOD))
+            +' chacune) sur '+str(workers)+' processus')
+    queue.wait(jobs)
+
+    failed = [j for j in jobs if j.status == 'error']
+    log('Ajout terminé en '+'%.1f' % (time.time() - start)+' s : '+str(len(jobs) - len(failed))+' capteurs ajoutés, '
+            +str(len(failed))+' en échec, '+str(len(errors))+' lignes incorrectes')
+
+@app.cli.command()
+@click.argument('filenames', nargs=-1)
+@click.option('--profile', required=True, type=click.Choice(sorted(STORAGE_PROFILES.keys())),
+        help='Le nouveau profil de stockage')
+@click.option('--all', 'everything', is_flag=True, help='Toutes les RRD de la BDD')
+@click.option('--period', default=86400, help='Période de la prédiction (s)')
+def reshape(filenames, profile, everything, period):
+    """Passe des RRD (noms de fichier sans .rrd) à un autre profil
+    de stockage. Peut être lancé pendant que le serveur tourne."""
+    db = get_db()
+    if everything :
+        probes = db.execute('SELECT id, name, filename, alpha, beta FROM probes ORDER BY id').fetchall()
+    else :
+        probes = [db.execute('SELECT id, name, filename, alpha, beta FROM probes WHERE filename=?', [f]).fetchone() for f in filenames]
+        for f, p in zip(filenames, probes) :
+            if not p :
+                log('Aucun capteur n\'utilise '+f+'.rrd')
+        probes = [p for p in probes if p]
+
+    log('Taille estimée d\'une RRD '+profile+' : '+human_size(rrd_size(profile, period)))
+    for p in probes :
+        before = os.path.getsize(rrd_file(p['filename']))
+        try :
+            reshape_rrd(p['filename'], profile, alpha=p['alpha'], beta=p['beta'], period=period)
+            db.execute('UPDATE probes SET profile=? WHERE id=?', [profile, p['id']])
+            db.commit()
+        except :
+            log('Échec du changement de profil de '+p['filename']+'.rrd : '+str(sys.exc_info()[1]))
+        else :
+            log(p['filename']+'.rrd : '+human_size(before)+' -> '+human_size(os.path.getsize(rrd_file(p['filename']))))
+
+def provision_loadgen(db, count) :
+    """Crée les capteurs jetables de loadgen (mac inventée, RRD au profil par défaut)
+    et attend que le serveur les connaisse, renvoie [(mac, filename)]"""
+
+    used = set(normalize_mac(p['mac']) for p in db.execute('SELECT mac FROM probes'))
+    taken = set(p['filename'] for p in db.execute('SELECT filename FROM probes'))
+    macs = []
+    i = 0
+    try :
+        while len(macs) < count :
+            mac, filename = random_mac(i), 'loadgen-'+str(i)
+            i += 1
+            if normalize_mac(mac) in used or filename in taken or os.path.exists(rrd_file(filename)) :
+                continue
+            create_rrd(filename)
+            macs.append((mac, filename))
+            db.execute('INSERT INTO probes (name, filename, mac, profile) VALUES (?, ?, ?, ?)',
+                    [filename, filename, mac, DEFAULT_STORAGE_PROFILE])
+        db.commit()
+    except :
+        remove_loadgen(db, [f for m, f in macs])
+        raise
+
+    log(str(count)+' capteurs jetables créés')
+    # Le serveur relit les capteurs toutes les REGISTRY_POLL s
+    time.sleep(REGISTRY_POLL + 1)
+    return macs
+
+def remove_loadgen(db, filenames) :
+    """Supprime les capteurs jetables de loadgen et leur RRD"""
+
+    db.executemany('DELETE FROM probes WHERE filename=?', [[f] for f in filenames])
+    db.commit()
+    # Le serveur doit les oublier avant qu'on supprime leur RRD
+    time.sleep(REGISTRY_POLL + 1)
+    for filename in filenames :
+        try :
+            del_rrd(filename)
+        except OSError :
+            pass
+    log(str(len(filenames))+' capteurs jetables supprimés')
+    return None
+
+@app.cli.command()
+@click.option('--probes', default=100, help='Nombre de capteurs simulés')
+@click.option('--rate', default=100.0, help='Débit total (paquets par seconde)')
+@click.option('--duration', default=60, help='Durée de la simulation (s)')
+@click.option('--profile', default='mixed', type=click.Choice(['mixed']+sorted(PROFILES.keys())),
+        help='Profil de consommation des capteurs (mixed : les 3 à tour de rôle)')
+@click.option('--host', default='127.0.0.1', help='Adresse du serveur')
+@click.option('--port', default=SERVER_PORT, help='Port du serveur')
+@click.option('--binary', is_flag=True, help='Utiliser le format binaire')
+@click.option('--existing', is_flag=True,
+        help='Utiliser les capteurs de la BDD (écrit de fausses données dans leur RRD)')
+def loadgen(probes, rate, duration, profile, host, port, binary, existing):
+    """Simule des capteurs pour dimensionner le serveur.
+    Chaque capteur simulé a son capteur jetable (loadgen-<n>) et sa RRD,
+    supprimés à la fin, pour mesurer les pertes et la latence (en relisant
+    leur RRD) sans toucher aux vrais capteurs.
+    RQ : avec --existing, les capteurs de la BDD sont utilisés en premier
+    (leurs RRD reçoivent les données simulées), les suivants ont une mac
+    inventée que le serveur ignore."""
+    db = get_db()
+    profiles = sorted(PROFILES.keys()) if profile == 'mixed' else [profile]
+
+    if existing :
+        known = db.execute('SELECT filename, mac FROM probes ORDER BY id LIMIT ?', [probes]).fetchall()
+        macs = [(p['mac'], p['filename']) for p in known] + [(random_mac(i), None) for i in range(len(known), probes)]
+        log('Attention : les RRD de '+str(len(known))+' capteurs réels vont recevoir des données simulées')
+    else :
+        macs = provision_loadgen(db, probes)
+    simulated = [(mac, filename, profiles[i % len(profiles)]) for i, (mac, filename) in enumerate(macs)]
+
+    try :
+        log('Simulation de '+str(probes)+' capteurs ('+str(sum(1 for m, f in macs if f))+' avec une RRD) à '
+                +str(rate)+' paquets/s pendant '+str(duration)+' s')
+        report = LoadGenerator(simulated, rate, duration, host=host, port=port, binary=binary).run()
+    finally :
+        if not existing :
+            remove_loadgen(db, [f for m, f in macs])
+
+    log('Envoyés : '+str(report['packets'])+' paquets en '+'%.1f' % report['duration']+' s, soit '+'%.1f' % report['rate']+' paquets/s')
+    if report['loss'] is None :
+        log('Aucun capteur connu : pertes et latence non mesurées')
+    else :
+        log('Pertes : '+'%.2f' % (100*report['loss'])+' % sur '+str(report['checked'])+' échantillons vérifiés')
+        if report['latency_max'] is not None :
+            log('Latence : médiane '+'%.2f' % report['latency_p50']+' s, 95% '+'%.2f' % report['latency_p95']+' s, max '+'%.2f' % report['latency_max']+' s')
+
+@app.cli.command()
+@click.argument('filenames', nargs=-1)
+@click.option('--all', 'everything', is_flag=True, help='Toutes les RRD de la BDD')
+def addpeaks(filenames, everything):
+    """Ajoute les archives MIN et MAX (pics) aux RRD (noms de
+    fichier sans .rrd) qui n'en ont pas. Peut être lancé pendant
+    que le serveur tourne."""
+    db = get_db()
+    if everything :
+        probes = db.execute('SELECT filename, profile FROM probes ORDER BY id').fetchall()
+    else :
+        probes = [db.execute('SELECT filename, profile FROM probes WHERE filename=?', [f]).fetchone() for f in filenames]
+        for f, p in zip(filenames, probes) :
+            if not p :
+                log('Aucun capteur n\'utilise '+f+'.rrd')
+        probes = [p for p in probes if p]
+
+    for p in probes :
+        try :
+            # Les RRD sans profil ont été créées avec l'ancien format (dense)
+            added = add_peaks_rrd(p['filename'], p['profile'] or 'dense')
+        except :
+            log('Échec de l\'ajout des pics à '+p['filename']+'.rrd : '+str(sys.exc_info()[1]))
+        else :
+            log(p['filename']+'.rrd : '+('pics ajoutés' if added else 'a déjà ses pics'))
+
+@app.cli.command()
+@click.argument('filenames', nargs=-1)
+@click.option('--all', 'everything', is_flag=True, help='Tous les groupes de la BDD')
+@click.option('--days', default=None, type=float,
+        help='Nombre de jours recalculés (par défaut la durée de l\'archive la plus fine)')
+@click.option('--workers', default=REBUILD_WORKERS, help='Nombre de capteurs lus en parallèle')
+def rebuildgroup(filenames, everything, days, workers):
+    """Recalcule les RRD de groupes (noms de fichier sans .rrd) à
+    partir de l'historique de leurs capteurs. Peut être lancé
+    pendant que le serveur tourne."""
+    db = get_db()
+    if everything :
+        groups = db.execute('SELECT id, name, filename, profile FROM probe_groups ORDER BY id').fetchall()
+    else :
+        groups = [db.execute('SELECT id, name, filename, profile FROM probe_groups WHERE filename=?', [f]).fetchone() for f in filenames]
+        for f, gr in zip(filenames, groups) :
+            if not gr :
+                log('Aucun groupe n\'utilise '+f+'.rrd')
+        groups = [gr for gr in groups if gr]
+
+    for gr in groups :
+        members = [m['filename'] for m in db.execute('SELECT probes.filename FROM probe_group_members '
+                +'JOIN probes ON probes.id=probe_group_members.probe_id WHERE group_id=?', [gr['id']]).fetchall()]
+        start = int(time.time() - days*86400) if days else None
+        begin = time.time()
+        try :
+            written = rebuild_group(gr['filename'], members, gr['profile'], start=start, workers=workers, log=log)
+        except :
+            log('Échec du recalcul de '+gr['filename']+'.rrd : '+str(sys.exc_info()[1]))
+        else :
+            log(gr['filename']+'.rrd : '+str(written)+' lignes recalculées depuis '+str(len(members))
+                    +' capteurs en '+'%.1f' % (time.time() - begin)+' s')
+
 def get_db():
     """Opens a new database connection if there is none yet for the
     current application context.
@@ -92,134 +422,217 @@ def close_db(error):
 
 
 
-#################################
-## Détection d'erreur (thread) ##
-#################################
+#############################
+## Autres fonctions utiles ##
+#############################
 
-def test_error () :
-    """Vérifie régulièrement si il y a une erreur pour chaque capteur surveillé et envoie un mail si il y a une erreur"""
+def saltpassword (password, salt) :
+    """Retourne un mot de passé salé selon l'algo sha256(pass+salt)"""
 
-    # On doit ramener le contexte de l'appli
-    # car on lance la requete BDD avant la 1ère requete HTTP
-    with app.app_context():
+    saltedpassword = password + str(salt)
+    return sha256(saltedpassword.encode('utf-8')).hexdigest()
 
-        # On récupère les infos sur les catpeurs à surveiller (id, filename et email)
-        db = get_db()
-        cur = db.execute('SELECT probes.name, probes.filename, probes.id, alerts.email FROM alerts JOIN probes ON alerts.probe_id=probes.id')
-        probes_to_watch = cur.fetchall()
 
-        # On trie la liste des capteurs pour éviter de checker 2 fois le même capteur pour 2 emails
-        sorted_probes = unique (probes_to_watch)
 
-        # Pour chaque capteur, on vérifie si il y a des erreurs et on envoie un mail le cas échéant
-        for p in sorted_probes :
-            if has_error(p[0]['filename']) :
-                for j in range(len(p)) :
-                    sendmail(p[j]['email'], text='Le capteur '+p[j]['name']+' a des erreurs')
-                    log('Email envoyé à '+p[j]['email']+' pour une erreur sur le capteur '+p[j]['name'])
+def log (message) :
+    """Print un message pour qu'il apparaisse dans les logs"""
 
-        # On met le thread en puase pour pas spammer de mails et de vérifictions
-        time.sleep(60)
+    print(time.ctime() + ' [INFO] ' + message)
+    return None
 
 
 
 
-def unique (s) :
-    """Trie les tuples (name, filename, id, email) pour éviter les doublons de capteurs (sans perdre l'info de l'email)"""
+def serving() :
+    """Indique si l'appli est lancée pour servir (flask run, serveur WSGI) et pas pour
+    une autre commande flask (initdb, importdata, reshape, ...) : celles-ci ne lancent
+    ni l'écoute des capteurs (dont le port est pris par le serveur), ni les alertes,
+    ni rien qui les empêcherait de se terminer"""
 
-    # On utilise un tri par dictionnaire (c'est globalement ce qu'il y a de plus rapide en python)
-    u = {}
+    # flask charge l'appli dans le contexte click de la commande run, dans celui du
+    # groupe flask pour les autres commandes ; un serveur WSGI n'a pas de contexte click
+    ctx = click.get_current_context(silent=True)
+    return ctx is None or ctx.info_name == 'run'
 
-    # On regarde tous les éléments
-    for x in s :
-        # Si on a jamais rencontré ce capteur, on crée le champs associé dans le dico
-        if not x['name'] in u.keys() :
-            u[x['name']] = []
-        # On ajoute le cpateur (et les infos associées) à ce champs
-        u[x['name']] += [x]
+SERVING = serving()
 
-    # On renvoie les tuples d'infos
-    return u.values()
 
 
 
+# On met la BDD à jour avant que les threads ne s'en servent
+if os.path.isfile(app.config['DATABASE']) :
+    with app.app_context() :
+        upgrade_db()
 
-# On lance un thread pour la vérification d'erreur et l'envoi d'email
-threading.Thread(target=test_error).start()
 
 
 
+###############################################
+## Création des RRD des capteurs (processus) ##
+###############################################
 
-####################################################
-## Récupération des données des capteurs (thread) ##
-####################################################
+def register_probe(job) :
+    """Ajoute à la BDD un capteur dont la RRD vient d'être créée (cf ProvisionQueue)
+    RQ : appelée hors de toute requête HTTP, on ouvre notre propre connexion"""
 
-def get_data() :
-    """Récupère en permanance les données sur le réseau
-    et rafraichit les données de la BDD toutes les 15 min environ
-    pour ne pas faire des requetes BDD ultra fréquentes"""
+    db = connect_db()
+    try :
+        db.execute('INSERT INTO probes (name, filename, mac, alpha, beta, profile) VALUES (?, ?, ?, ?, ?, ?)',
+                [job.name, job.filename, job.mac, job.alpha, job.beta, job.profile])
+        db.commit()
+    finally :
+        db.close()
 
-    while (1) :
-        # On doit ramener le contexte de l'appli
-        # car on lance la requete BDD avant la 1ère requete HTTP
-        with app.app_context():
+    # On commence tout de suite à remplir la RRD
+    registry.set(job.mac, job.filename)
+    log('Capteur '+job.name+' ajouté')
+    return None
 
-            # On récupère les infos sur les capteurs à remplir (filename et mac)
-            db = get_db()
-            cur = db.execute('SELECT probes.filename, probes.mac FROM probes')
-            probes_info = cur.fetchall()
-            probes_dict = make_dict(probes_info)
 
-        log('Cache des capteurs à remplir mis à jour')
 
-        # On déclenche pendant 15 minutes environ
-        # (sous hypothèse d'une donnée dispo en permanance
-        # et tous les capteurs envoie des données)
-        for i in range(60*15*len(probes_dict.keys())) :
-            ident, values = listen()
-            if ident in probes_dict.keys() :
-                update_rrd(probes_dict[ident], values)
-            time.sleep(1)
 
+###########################################
+## Processus (lancés avant tout thread) ##
+###########################################
 
+# Les processus sont créés par fork : le processus ne doit encore avoir aucun thread
+# RQ : les pools lancent un thread en plus de leurs processus, ils passent après les processus d'écoute
 
-def make_dict(data) :
-    """Transforme le résultat de la requete BDD en dictionnaire {identifiant : filename}"""
+# Les processus d'écoute
+ingest = None
+if SERVING and INGEST_WORKERS > 1 :
+    ingest = ShardedIngest(app.config['DATABASE'], log=log)
+    ingest.spawn()
 
-    res = {}
-    for d in data :
-        res[d['mac']] = d['filename']
+# Les créations de RRD en tâche de fond
+provisioning = ProvisionQueue(register_probe, log=log)
+if SERVING :
+    provisioning.start()
 
-    return res
+# Les threads des processus d'écoute, une fois tous les processus lancés
+if ingest :
+    ingest.start()
+    log('Plusieurs processus d\'écoute : les RRD des groupes ne sont pas tenues à jour (cf flask rebuildgroup)')
 
 
 
-# On lance un thread pour l'écoute des données
-threading.Thread(target=get_data).start()
 
+########################
+## rrdcached (thread) ##
+########################
 
+# On lance rrdcached avant les threads qui lisent et écrivent les RRD
+if SERVING and RRDCACHED and RRDCACHED_SPAWN :
+    rrdcached = RRDCached(log=log)
+    rrdcached.start()
+    atexit.register(rrdcached.stop)
 
 
-#############################
-## Autres fonctions utiles ##
-#############################
 
-def saltpassword (password, salt) :
-    """Retourne un mot de passé salé selon l'algo sha256(pass+salt)"""
 
-    saltedpassword = password + str(salt)
-    return sha256(saltedpassword.encode('utf-8')).hexdigest()
+#################################
+## Détection d'erreur (thread) ##
+#################################
 
+def watched_probes() :
+    """Les capteurs surveillés, un par capteur quel que soit le nombre d'emails à prévenir :
+    [(filename, name, intervalle de vérification, [emails])] (cf AlertScheduler)
+    RQ : appelée hors de toute requête HTTP, on ouvre notre propre connexion"""
 
+    db = connect_db()
+    try :
+        cur = db.execute('SELECT probes.name, probes.filename, probes.check_interval, alerts.email FROM alerts JOIN probes ON alerts.probe_id=probes.id')
+        rows = cur.fetchall()
+    finally :
+        db.close()
 
-def log (message) :
-    """Print un message pour qu'il apparaisse dans les logs"""
+    probes = {}
+    for r in rows :
+        interval = r['check_interval'] if r['check_interval'] else ALERT_INTERVAL
+        probes.setdefault(r['filename'], (r['filename'], r['name'], interval, []))[3].append(r['email'])
+    return list(probes.values())
 
-    print(time.ctime() + ' [INFO] ' + message)
+
+
+
+def notify_error(check, error) :
+    """Envoie un mail à chaque email qui surveille le capteur en erreur"""
+
+    for email in check.emails :
+        sendmail(email, text='Le capteur '+check.name+' a des erreurs')
+        log('Email envoyé à '+email+' pour une erreur sur le capteur '+check.name)
     return None
 
 
 
+
+# On vérifie en continu les capteurs surveillés, chacun à son intervalle
+alert_scheduler = AlertScheduler(watched_probes, notify_error, log=log)
+if SERVING :
+    alert_scheduler.start()
+    atexit.register(alert_scheduler.stop)
+
+
+
+
+####################################################
+## Récupération des données des capteurs (thread) ##
+####################################################
+
+# Les capteurs à remplir, tenus à jour par les pages de gestion des capteurs
+registry = ProbeRegistry(app.config['DATABASE'])
+
+def get_data() :
+    """Lance le serveur de réception des données des capteurs
+    et tient à jour le registre des capteurs à remplir"""
+
+    # Plusieurs processus d'écoute qui gèrent eux-mêmes leur registre (lancés plus haut)
+    if ingest :
+        return None
+
+    registry.load()
+    log('Registre des capteurs à remplir chargé')
+
+    # Le journal qui absorbe les rafales et les arrêts de l'écriture dans les RRD
+    journal = None
+    if JOURNAL :
+        journal = Journal(os.path.join(APP_ROOT, JOURNAL))
+        log(str(journal.pending())+' échantillons à relire dans le journal')
+
+    # Le serveur tourne dans son propre thread (cf IngestServer)
+    server = IngestServer(registry, log=log, journal=journal)
+    server.start()
+
+    # Les modifications faites dans ce processus sont immédiates,
+    # on ne surveille que celles faites par d'autres (flask cli, ...)
+    while (1) :
+        time.sleep(REGISTRY_POLL)
+        if registry.refresh() :
+            log('Registre des capteurs à remplir mis à jour')
+
+
+
+# On lance un thread pour l'écoute des données
+if SERVING :
+    threading.Thread(target=get_data).start()
+
+
+
+
+###########################
+## Flask views : metrics ##
+###########################
+
+@app.route('/metrics')
+def metrics_view() :
+    """Les métriques de la chaîne d'écoute au format texte de Prometheus
+    Pas de connexion requise pour que Prometheus puisse les récupérer"""
+
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+
+
 ###########################
 ## Flask views : acceuil ##
 ###########################
@@ -239,77 +652,183 @@ def accueil() :
 
 @app.route('/apercu/')
 def apercu() :
-    """La page web qui donne un aperçu de l'ensemble des capteurs gérés par le système"""
+    """La page web qui donne un aperçu de l'ensemble des capteurs gérés par le système
+    Les capteurs sont affichés par pages de APERCU_PAGE (page), chaque image
+    est chargée à part (cf overview) quand elle devient visible"""
 
     if not session.get('logged_in'):
         return redirect(url_for('login'))
 
-    # On récupères les infos sur les capteurs
+    # La page demandée
+    try :
+        page = max(1, int(request.args.get('page', 1)))
+    except ValueError :
+        page = 1
+
+    # On récupères les infos sur les capteurs de la page
     db = get_db()
-    cur = db.execute('SELECT id, name, filename FROM probes ORDER BY id')
+    count = db.execute('SELECT COUNT(*) FROM probes').fetchone()[0]
+    pages = max(1, -(-count//APERCU_PAGE))
+    page = min(page, pages)
+    cur = db.execute('SELECT id, name, filename FROM probes ORDER BY id LIMIT ? OFFSET ?',
+            [APERCU_PAGE, (page-1)*APERCU_PAGE])
     probes = cur.fetchall()
 
-    # On génère les images pour chacun de ces capteurs
-    images = {}
-    for p in probes :
-        images[p['id']] = graph_accueil(p['filename'], p['name'], width=550, height=300)['image_info']
-
     # On renvoie l'HTML avec les infos
-    return render_template('apercu.html', probes=probes, images=images)
+    return render_template('apercu.html', probes=probes, page=page, pages=pages,
+            width=THUMBNAIL_SIZE[0], height=THUMBNAIL_SIZE[1])
+
+
+
+
+# Les processus qui génèrent les graphes de l'aperçu (lancés au 1er affichage)
+thumbnails = GraphPool(GRAPHS, log=log)
+
+@app.route('/graph/<int:id>/overview.png')
+def overview(id) :
+    """Le graphe d'aperçu d'un capteur (PNG), généré dans le pool des graphes"""
+
+    if not session.get('logged_in'):
+        abort(403)
+
+    probe = get_probe(id)
+    if not probe :
+        abort(404)
+
+    return overview_response(probe['filename'], probe['name'])
+
+
+
+
+def overview_response(filename, name) :
+    """Le graphe d'aperçu d'une RRD (capteur ou groupe)
+    ETag et Last-Modified dépendent de la tranche de temps du graphe (cf graph_version) :
+    tant qu'elle n'a pas changé, le navigateur (ou un proxy) reçoit un 304 sans que
+    le graphe soit regénéré"""
+
+    width, height = THUMBNAIL_SIZE
+    now = int(time.time())
+    key = accueil_key(filename, name, '-7d', '+0h', width, height, now)
+    try :
+        last = last_rrd(filename)
+    except Exception :
+        abort(404)
+    etag, modified, expires = graph_version(key, last)
+    # Le graphe reste le même jusqu'à la fin de sa tranche de temps
+    # RQ : Vary pour qu'un proxy ne serve pas l'image sans la session
+    headers = {'ETag' : '"'+etag+'"',
+            'Last-Modified' : http_date(modified),
+            'Cache-Control' : 'max-age='+str(max(0, expires - now)) if expires else 'no-cache',
+            'Vary' : 'Cookie'}
+
+    # Le navigateur a déjà la bonne version
+    if request.if_none_match.contains(etag) or \
+            (not request.if_none_match and request.if_modified_since and request.if_modified_since.timestamp() >= modified) :
+        return Response(status=304, headers=headers)
+
+    # Le fichier peut être évincé du cache avant qu'on le lise : on le regénère une fois
+    for i in range(2) :
+        graph = thumbnails.graphs_accueil([(filename, name)], '-7d', '+0h', width, height, now)[filename]
+        if not graph :
+            break
+        png = GRAPHS.read(key, name)
+        if png is not None :
+            return Response(png, mimetype='image/png', headers=headers)
+
+    # Graphe en échec ou trop long : la page affiche un message à la place
+    return Response('Aperçu indisponible', status=503, headers={'Retry-After' : str(GRAPH_TIMEOUT)}, mimetype='text/plain')
+
+
+
+
+def get_probe(id) :
+    """Renvoie les infos d'un capteur (None si l'id ne correspond à aucun capteur)"""
+
+    db = get_db()
+    cur = db.execute('SELECT id, name, filename, mac FROM probes WHERE id=?', [id])
+    return cur.fetchone()
+
+
+
+
+def get_period(duree=Duree.j1) :
+    """Renvoie la période (start, end) demandée : deux dates du formulaire (from, to),
+    deux timestamps (start, end) ou une durée prédéfinie (time) jusqu'à maintenant
+    Une période incorrecte est signalée (flash) et remplacée par la durée prédéfinie"""
+
+    try :
+        return parse_period(duree)
+    except ValueError as e :
+        flash(str(e))
+    return parse_period(duree, strict=False)
+
+
+
+
+def parse_period(duree=Duree.j1, strict=True) :
+    """Comme get_period, sans flash : lève ValueError (avec le message à afficher) pour
+    une période incorrecte, ou la remplace par la durée prédéfinie si strict est faux"""
+
+    now = int(time.time())
+    start = None
+    end = None
+
+    # On récupère la durée de visualisation demandée
+    durees = {'heure' : Duree.h1, 'jour' : Duree.j1, 'mois' : Duree.m1, 'an' : Duree.a1}
+    if request.values.get('time') in durees :
+        duree = durees[request.values['time']]
+
+    # On récupère la période précise demandée (si il y en a une)
+    try :
+        if request.values.get('from') and request.values.get('to') :
+            start = int(datetime.strptime(request.values['from'], '%Y-%m-%dT%H:%M').timestamp())
+            end = int(datetime.strptime(request.values['to'], '%Y-%m-%dT%H:%M').timestamp())
+        elif request.values.get('start') and request.values.get('end') :
+            start = int(request.values['start'])
+            end = int(request.values['end'])
+    except ValueError :
+        if strict :
+            raise ValueError('Les dates demandées ne sont pas valides')
+        start = None
+    if start is not None and end - start < MIN_SPAN :
+        if strict :
+            raise ValueError('La période demandée est trop courte (au moins '+str(MIN_SPAN)+' s)')
+        start = None
+    if start is None :
+        start = now - DUREES[duree]
+        end = now
+
+    return start, end
 
 
 
 
 @app.route('/detail/<int:id>/', methods=['GET', 'POST'])
 def detail(id) :
-    """La page web qui permet d'avoir le détail de consommation d'un capteur en particulier"""
+    """La page web qui permet d'avoir le détail de consommation d'un capteur en particulier
+    La période affichée est une durée prédéfinie jusqu'à maintenant (time), deux dates
+    du formulaire (from, to) ou deux timestamps (start, end) pour le zoom et le déplacement"""
 
     if not session.get('logged_in'):
         return redirect(url_for('login'))
 
     # On récupère les infos sur le capteur demandé
-    db = get_db()
-    cur = db.execute('SELECT id, name, filename, mac FROM probes WHERE id=?', [id])
-    probe = cur.fetchone()
+    probe = get_probe(id)
 
     # On vérifie que l'id correspond bien à un capteur
     if not probe :
         flash ('Le capteur que vous avez demandé n\'existe pas')
         return redirect(url_for('apercu'))
 
-    # Valeur par défaut des paramètres
-    time = Duree.j1
+    # La période demandée (un jour par défaut)
+    start, end = get_period()
     grandeurs = []
 
-    # Si l'utilisateur demande des valeurs de paramètres en particulier
-    if request.method == 'POST' :
-
-        # On récupère la durée de visualisation demandée
-        try :
-            if request.form['time'] == 'heure':
-                time = Duree.h1
-            elif request.form['time'] == 'jour':
-                time = Duree.j1
-            elif request.form['time'] == 'mois':
-                time = Duree.m1
-            elif request.form['time'] == 'an':
-                time = Duree.a1
-        except :
-            pass
-
-        # On récupère la ou les grandeurs demandées
-        if 'courant' in request.form.getlist('grandeurs'):
-            grandeurs.append(Grandeur.courant)
-        if 'tension' in request.form.getlist('grandeurs'):
-            grandeurs.append(Grandeur.tension)
-        if 'dephasage' in request.form.getlist('grandeurs'):
-            grandeurs.append(Grandeur.dephasage)
-        if 'puiss_active' in request.form.getlist('grandeurs'):
-            grandeurs.append(Grandeur.puiss_active)
-        if 'puiss_reactive' in request.form.getlist('grandeurs'):
-            grandeurs.append(Grandeur.puiss_reactive)
-        if 'puiss_apparente' in request.form.getlist('grandeurs'):
-            grandeurs.append(Grandeur.puiss_apparente)
+    # On récupère la ou les grandeurs demandées
+    # RQ : pas de variable g, qui masquerait flask.g dans toute la fonction
+    for grandeur in Grandeur :
+        if grandeur.name in request.values.getlist('grandeurs') :
+            grandeurs.append(grandeur)
 
     # Si aucune grandeur demandé ou methode GET => on met au moins une
     # grandeur a visualiser pour éviter un graph vide et inutile
@@ -317,10 +836,182 @@ def detail(id) :
         grandeurs.append(Grandeur.courant)
 
     # On génère l'image avec les paramètres ainsi choisi
-    image = graph_detail(probe['filename'], probe['name'], time, grandeurs, width=1000, height=500)['image_info']
+    graph = graph_detail(probe['filename'], probe['name'], start, end, grandeurs, width=1000, height=500)
+
+    # Les périodes pour zoomer et se déplacer (en gardant les grandeurs)
+    span = end - start
+    navigation = [('« Avant', start - span//2, end - span//2),
+            ('Zoom +', start + span//4, end - span//4) if span//2 >= MIN_SPAN else None,
+            ('Zoom -', start - span//2, end + span//2),
+            ('Après »', start + span//2, end + span//2)]
+    navigation = [n for n in navigation if n]
 
     # On renvoie l'HTML avec les infos
-    return render_template('detail.html', probe=probe, image=image)
+    # RQ : la résolution choisie est aussi dans les en-têtes pour suivre le coût des graphes
+    response = make_response(render_template('detail.html', probe=probe, image=graph['image_info'],
+            step=graph['step'], start=start, end=end, grandeurs=[grandeur.name for grandeur in grandeurs],
+            navigation=navigation, date_from=datetime.fromtimestamp(start).strftime('%Y-%m-%dT%H:%M'),
+            date_to=datetime.fromtimestamp(end).strftime('%Y-%m-%dT%H:%M')))
+    if graph['step'] :
+        response.headers['X-Kerrucent-Step'] = str(graph['step'])
+        response.headers['X-Kerrucent-Rows'] = str(span//graph['step'])
+    return response
+
+
+
+
+@app.route('/compare/', methods=['GET', 'POST'])
+def compare() :
+    """La page web qui superpose une grandeur (grandeur, courant par défaut) de plusieurs
+    capteurs (probes, leurs ids) sur un même graphe, généré en un seul rendu (cf graph_compare)
+    La période se choisit comme dans detail (time, from et to ou start et end)"""
+
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+
+    db = get_db()
+    all_probes = db.execute('SELECT id, name, filename FROM probes ORDER BY id').fetchall()
+
+    # Les capteurs demandés, dans l'ordre de la liste
+    ids = set(int(i) for i in request.values.getlist('probes') if i.isdigit())
+    probes = [p for p in all_probes if p['id'] in ids]
+    if len(probes) > COMPARE_MAX :
+        flash('Au plus '+str(COMPARE_MAX)+' capteurs peuvent être comparés, seuls les premiers sont affichés')
+        probes = probes[:COMPARE_MAX]
+
+    # La grandeur demandée (une seule, pour partager l'axe)
+    grandeur = Grandeur.courant
+    if request.values.get('grandeur') in Grandeur.__members__ :
+        grandeur = Grandeur[request.values['grandeur']]
+
+    start, end = get_period()
+    graph = None
+    if probes :
+        graph = graph_compare([(p['filename'], p['name']) for p in probes], grandeur, start, end, width=1000, height=500)
+
+    # Les périodes pour zoomer et se déplacer (en gardant les capteurs et la grandeur)
+    span = end - start
+    navigation = [('« Avant', start - span//2, end - span//2),
+            ('Zoom +', start + span//4, end - span//4) if span//2 >= MIN_SPAN else None,
+            ('Zoom -', start - span//2, end + span//2),
+            ('Après »', start + span//2, end + span//2)]
+    navigation = [n for n in navigation if n]
+
+    # On renvoie l'HTML avec les infos
+    response = make_response(render_template('compare.html', all_probes=all_probes,
+            selected=[p['id'] for p in probes], grandeur=grandeur.name, legendes=LEGENDES,
+            image=graph['image_info'] if graph else None, step=graph['step'] if graph else None,
+            start=start, end=end, navigation=navigation,
+            date_from=datetime.fromtimestamp(start).strftime('%Y-%m-%dT%H:%M'),
+            date_to=datetime.fromtimestamp(end).strftime('%Y-%m-%dT%H:%M')))
+    if graph and graph['step'] :
+        response.headers['X-Kerrucent-Step'] = str(graph['step'])
+    return response
+
+
+
+
+@app.route('/export/<int:id>')
+def export_probe(id) :
+    """Les données brutes d'un capteur (les 6 grandeurs) en CSV ou NDJSON
+    Paramètres : la période (cf get_period, un jour par défaut), la résolution
+    en s (resolution, 1 par défaut) et le format (format, csv par défaut)
+    La réponse est générée morceau par morceau (et compressée au fil de l'eau
+    si le client accepte gzip) pour ne jamais avoir toute la période en mémoire"""
+
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+
+    # On récupère les infos sur le capteur demandé
+    probe = get_probe(id)
+    if not probe :
+        abort(404)
+
+    # Les paramètres de l'export
+    start, end = get_period()
+    format = request.args.get('format', 'csv')
+    try :
+        resolution = int(request.args.get('resolution', 1))
+    except ValueError :
+        abort(400)
+    if not format in EXPORT_FORMATS or resolution < 1 :
+        abort(400)
+
+    chunks = export(probe['filename'], start, end, resolution, format)
+    headers = {'Content-Disposition' : 'attachment; filename='+probe['filename']+'.'+format}
+    if 'gzip' in request.headers.get('Accept-Encoding', '') :
+        chunks = gzip_stream(chunks)
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+
+    log('Export de '+probe['name']+' ('+format+', '+str(end-start)+' s)')
+    return Response(chunks, mimetype=EXPORT_FORMATS[format], headers=headers)
+
+
+
+
+@app.route('/api/probe/<int:id>/series')
+def api_series(id) :
+    """Les grandeurs d'un capteur réduites à la largeur du graphe, pour les tracer dans le navigateur"""
+
+    if not session.get('logged_in'):
+        abort(403)
+
+    probe = get_probe(id)
+    if not probe :
+        abort(404)
+
+    return series_response(probe['filename'])
+
+
+
+
+def api_error(message, status) :
+    """La réponse JSON d'erreur de l'API"""
+
+    return jsonify(error=message), status
+
+
+
+
+def series_response(filename) :
+    """Les grandeurs d'une RRD (capteur ou groupe) pour l'API, cf probe_series
+    Paramètres : la période (cf get_period, un jour par défaut), les grandeurs (grandeurs,
+    plusieurs fois ou séparées par des virgules, courant par défaut), la largeur en pixels
+    (width, 1000 par défaut), la réduction (reducer : minmax ou lttb), la bande de prédiction
+    (band=1) et le format (format : json ou binary, cf to_json et to_binary)"""
+
+    # Les paramètres de la requête
+    try :
+        start, end = parse_period()
+    except ValueError as e :
+        return api_error(str(e), 400)
+    names = [n for v in request.args.getlist('grandeurs') for n in v.split(',') if n]
+    if not names :
+        names = [Grandeur.courant.name]
+    try :
+        width = int(request.args.get('width', 1000))
+    except ValueError :
+        return api_error('La largeur demandée n\'est pas un entier', 400)
+    reducer = request.args.get('reducer', 'minmax')
+    format = request.args.get('format', 'json')
+    if not all(n in Grandeur.__members__ for n in names) :
+        return api_error('Grandeur inconnue', 400)
+    if not 1 <= width <= API_MAX_WIDTH :
+        return api_error('La largeur doit être comprise entre 1 et '+str(API_MAX_WIDTH), 400)
+    if not reducer in REDUCERS or not format in ['json', 'binary'] :
+        return api_error('Réduction ou format inconnu', 400)
+
+    # Une autre erreur que l'absence de la RRD est une vraie erreur (500)
+    if not os.path.isfile(rrd_file(filename)) :
+        return api_error('La RRD '+filename+' n\'existe pas', 404)
+    data = probe_series(filename, names, start, end, width, reducer, request.args.get('band') == '1')
+
+    if format == 'binary' :
+        body, layout = to_binary(data)
+        headers = {'X-Kerrucent-Layout' : layout, 'X-Kerrucent-Step' : str(data['step'])}
+        return Response(body, mimetype='application/octet-stream', headers=headers)
+    return Response(to_json(data), mimetype='application/json')
 
 
 
@@ -509,11 +1200,13 @@ def manage_probes():
 
     # On récupère les infos sur l'ensemble des capteur
     db = get_db()
-    cur = db.execute('SELECT id, name FROM probes ORDER BY id')
+    cur = db.execute('SELECT id, name, profile FROM probes ORDER BY id')
     probes = cur.fetchall()
 
-    # On renvoie l'HTML avec les infos
-    return render_template('manageprobes.html', probes=probes)
+    # On renvoie l'HTML avec les infos (et les créations en cours)
+    # RQ : les créations en échec restent affichées (jusqu'au redémarrage)
+    jobs = [j for j in provisioning.list() if j.state() != 'done']
+    return render_template('manageprobes.html', probes=probes, jobs=jobs)
 
 
 
@@ -527,7 +1220,7 @@ def remove_probe(id):
 
     # On récupère les infos concernant le capteur en particulier
     db = get_db()
-    cur = db.execute('SELECT name, filename FROM probes WHERE id=?', [id])
+    cur = db.execute('SELECT name, filename, mac FROM probes WHERE id=?', [id])
     probe = cur.fetchone()
 
     # On vérifie que le capteur en question existe
@@ -541,10 +1234,16 @@ def remove_probe(id):
             db.commit()
             db.execute('DELETE FROM alerts WHERE probe_id=?', [id])
             db.commit()
+            db.execute('DELETE FROM probe_group_members WHERE probe_id=?', [id])
+            db.commit()
         except :
             flash('Une erreur est survenue lors de la suppression de '+probe['name']+' de la BDD')
             print(sys.exc_info())
         else :
+            # On arrête tout de suite de remplir la RRD (et de la lire)
+            registry.discard(probe['mac'])
+            CACHE.forget(probe['filename'])
+            GRAPHS.forget(probe['filename'])
             # On supprime le fichier RRD qui est associé (attention irréversible)
             try :
                 del_rrd(probe['filename'])
@@ -572,10 +1271,11 @@ def edit_probe(id):
     error_name = None
     error_mac = None
     error_pred = None
+    error_interval = None
 
     # On récupère les infos sur le capteur
     db = get_db()
-    cur = db.execute('SELECT id, name, filename, mac, alpha, beta FROM probes WHERE id=?', [id])
+    cur = db.execute('SELECT id, name, filename, mac, alpha, beta, check_interval FROM probes WHERE id=?', [id])
     probe = cur.fetchone()
 
     # On vérifie que l'id demandé correspond bien à un capteur
@@ -600,12 +1300,12 @@ def edit_probe(id):
                 flash ('Le nom du capteur '+probe['name']+' a bien été changé en '+name)
 
         # Demande de changer la mac du capteur
-        if request.form['mac'] and request.form['mac'] != probe['mac'] :
+        if request.form['mac'] and normalize_mac(request.form['mac']) != probe['mac'] :
             # On vérifie que ça correspond bien à une MAC
             if not re.match('([0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}', request.form['mac']) :
                 error_mac = 'Veuillez entrer une addresse MAC au format correct'
             else:
-                mac = request.form['mac']
+                mac = normalize_mac(request.form['mac'])
                 # On essaye de changer la mac dans la BDD
                 try :
                     db.execute('UPDATE probes SET mac=? WHERE id=?', [mac, id])
@@ -614,6 +1314,9 @@ def edit_probe(id):
                     error_mac = 'Une erreur est survenue lors de la modification de la MAC dans la base de donnée'
                     print(sys.exc_info())
                 else :
+                    # La RRD reste la même : on l'ajoute sous sa nouvelle mac avant de retirer l'ancienne
+                    registry.set(mac, probe['filename'])
+                    registry.discard(probe['mac'])
                     log('Mac du capteur '+probe['name']+' changé')
                     flash('La mac du capteur '+probe['name']+' a correctement été modifié')
 
@@ -653,12 +1356,34 @@ def edit_probe(id):
                         log('Paramètres de prédiction de '+probe['name']+' changés')
                         flash('Les paramètres de prédiction de '+probe['name']+' ont correctement été changé')
 
+        # Demande de changer l'intervalle de vérification des alertes (pris en compte sous ALERT_RELOAD s)
+        # RQ : le champ est pré-rempli, le vider remet l'intervalle par défaut (NULL, cf ALERT_INTERVAL)
+        value = request.form.get('check_interval', '').strip()
+        if 'check_interval' in request.form and value != str(probe['check_interval'] or '') :
+            try :
+                interval = int(value) if value else None
+                if interval is not None and interval < 1 :
+                    raise ValueError
+            except ValueError :
+                error_interval = 'Veuillez entrer un nombre entier de secondes pour l\'intervalle de vérification'
+            else :
+                try :
+                    db.execute('UPDATE probes SET check_interval=? WHERE id=?', [interval, id])
+                    db.commit()
+                except :
+                    error_interval = 'Une erreur est survenue lors de la modification de l\'intervalle de vérification dans la base de données'
+                    print(sys.exc_info())
+                else :
+                    log('Intervalle de vérification de '+probe['name']+' changé')
+                    flash('L\'intervalle de vérification de '+probe['name']+' a correctement été changé')
+
     # On recharge les modifications depuis la BDD pour prendre en compte les modif effectuées
     # Nécessaire pour un affichage joli et sans ambiguité
-    probe = db.execute('SELECT id, name, filename, mac, alpha, beta FROM probes WHERE id=?', [id]).fetchone()
+    probe = db.execute('SELECT id, name, filename, mac, alpha, beta, check_interval FROM probes WHERE id=?', [id]).fetchone()
 
     # On retourne l'HTML avec les infos
-    return render_template('editprobe.html', probe=probe, error_name=error_name, error_mac=error_mac, error_pred=error_pred)
+    return render_template('editprobe.html', probe=probe, error_name=error_name, error_mac=error_mac, error_pred=error_pred,
+            error_interval=error_interval, default_interval=ALERT_INTERVAL)
 
 
 
@@ -672,11 +1397,13 @@ def add_probe():
 
     # Les erreurs qu'on remonte à l'utilisateur (si il y en a)
     error = None
+    job = None
 
     # Les valeurs par défaut des paramètres
-    alpha = 0.000192522
-    beta = 0.00000802250
-    period = 86400
+    alpha = DEFAULT_ALPHA
+    beta = DEFAULT_BETA
+    period = DEFAULT_PERIOD
+    profile = DEFAULT_STORAGE_PROFILE
 
     # Si l'utilisateur demande l'ajout d'un capteur
     if request.method == 'POST' :
@@ -688,55 +1415,284 @@ def add_probe():
             try :
                 if request.form['alpha'] : alpha = float(request.form['alpha'])
                 if request.form['beta'] : beta = float(request.form['beta'])
-                if request.form['period'] : period = float(request.form['period'])
+                if request.form['period'] : period = int(request.form['period'])
             except :
                 error = 'Veuillez entrer des nombres pour les paramètres de prédiction'
                 print(sys.exc_info())
             else :
-                # On récupère le nom et on génère un nom de fichier avec qui n'existe pas déjà
+                # Le profil de stockage de la RRD
+                if request.form.get('profile') in STORAGE_PROFILES :
+                    profile = request.form['profile']
+
                 name = request.form['name']
-                filename = safename(name)
-                final_filename = filename
-                i = 0
-                while os.path.isfile(os.path.join(app.root_path, 'rrd/', final_filename+'.rrd')) :
-                    i+=1
-                    final_filename = filename + str(i).zfill(2)
 
                 # On vérifie que la mac est bien une mac
                 if not re.match('([0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}', request.form['mac']) :
                     error = 'Veuillez entrer une adrrese MAC au format correct'
                 else :
-                    mac = request.form['mac']
+                    mac = normalize_mac(request.form['mac'])
 
-                    # On essaye de créer la RRD
+                    # La RRD (préallouée, longue à créer) est créée en tâche de fond
+                    # avec un nom de fichier qui n'existe pas déjà (cf ProvisionQueue.reserve),
+                    # le capteur est ajouté à la BDD une fois la RRD créée
                     try :
-                        create_rrd(final_filename, alpha=alpha, beta=beta, period=period)
+                        job = provisioning.submit(name, mac, alpha=alpha, beta=beta, period=period, profile=profile)
                     except :
                         error = 'Une erreur est survenue lors de la création de la RRD'
                         print(sys.exc_info())
                     else :
+                        log('Création de '+job.filename+'.rrd pour le capteur '+name+' lancée')
+                        flash('La nouvelle sonde '+name+' est en cours de création')
 
-                        # On essaye d'ajouter ce nouveau capteur dans la BDD
-                        try :
-                            db = get_db()
-                            db.execute('INSERT INTO probes (name, filename, mac, alpha, beta) VALUES (?, ?, ?, ?, ?)',
-                                    [name, final_filename, mac, alpha, beta])
-                            db.commit()
-                        except :
-                            error = 'Une erreur est survenue lors de l\'ajout de la sonde à la base de donnée. Suppression de '+final_filename+'.rrd'
-                            # Si il y a une erreur on supprime la RRD qu'on vient de créer
-                            del_rrd(final_filename)
-                            print(sys.exc_info())
-                        else :
-                            log('Capteur '+name+' ajouté')
-                            flash('La nouvelle sonde '+name+' a été correctement ajoutée')
+    # Les profils de stockage proposés et la taille des RRD correspondantes
+    profiles = [(p, human_size(rrd_size(p, period))) for p in STORAGE_PROFILES]
+
+    # On renvoie l'HTML avec les infos (et les créations en cours)
+    return render_template('addprobe.html', error=error, profiles=profiles, profile=profile,
+            jobs=[job] if job else provisioning.active())
+
+
+
+
+@app.route('/addprobes/', methods=['GET', 'POST'])
+def add_probes():
+    """La page web qui permet d'ajouter des capteurs en masse
+    à partir d'un CSV name,mac[,alpha,beta,period] (fichier ou texte)"""
+
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+
+    # Les erreurs qu'on remonte à l'utilisateur (si il y en a)
+    errors = []
+    profile = DEFAULT_STORAGE_PROFILE
+    batch = None
+
+    # Si l'utilisateur envoie sa liste de capteurs
+    if request.method == 'POST' :
+        if request.form.get('profile') in STORAGE_PROFILES :
+            profile = request.form['profile']
+
+        # Le CSV peut être envoyé en fichier ou collé dans le formulaire
+        upload = request.files.get('file')
+        if upload and upload.filename :
+            text = upload.read().decode('utf-8', 'replace')
+        else :
+            text = request.form.get('csv', '')
+
+        probes, errors = parse_onboarding(text.splitlines())
+        if not probes and not errors :
+            errors = ['Aucun capteur à ajouter']
+
+        # On lance les créations (en parallèle, cf ProvisionQueue)
+        if probes :
+            batch = provisioning.new_batch()
+            for p in probes :
+                provisioning.submit(p['name'], p['mac'], alpha=p['alpha'], beta=p['beta'],
+                        period=p['period'], profile=profile, batch=batch)
+            log('Ajout en masse de '+str(len(probes))+' capteurs lancé')
+            flash(str(len(probes))+' capteurs sont en cours de création')
+
+    # Les profils de stockage proposés et la taille des RRD correspondantes
+    profiles = [(p, human_size(rrd_size(p, DEFAULT_PERIOD))) for p in STORAGE_PROFILES]
+
+    # On renvoie l'HTML avec les infos (et les créations de cet ajout en masse)
+    return render_template('addprobes.html', errors=errors, profiles=profiles, profile=profile,
+            jobs=provisioning.list(batch) if batch else provisioning.active())
+
+
+
+
+@app.route('/jobs/')
+def jobs_status():
+    """Le statut (JSON) des créations de capteurs, interrogé régulièrement par les pages
+    de gestion des capteurs tant que des créations sont en cours
+    Paramètres : batch (un ajout en masse) ou id (une création) optionnels"""
+
+    if not session.get('logged_in'):
+        abort(403)
+
+    try :
+        batch = int(request.args['batch']) if request.args.get('batch') else None
+        id = int(request.args['id']) if request.args.get('id') else None
+    except ValueError :
+        abort(400)
+
+    jobs = provisioning.list(batch)
+    if id is not None :
+        jobs = [j for j in jobs if j.id == id]
+    return jsonify(jobs=[j.as_dict() for j in jobs], active=len([j for j in jobs if not j.done.is_set()]))
+
+
+
+
+
+##########################
+## Flask views : groups ##
+##########################
+
+@app.route('/managegroups/')
+def manage_groups():
+    """La page web qui permet de gérer les groupes de capteurs et de voir leur consommation"""
+
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+
+    # On récupère les groupes et leurs capteurs
+    db = get_db()
+    groups = db.execute('SELECT id, name, filename, profile FROM probe_groups ORDER BY id').fetchall()
+    members = {}
+    for m in db.execute('SELECT group_id, probes.name FROM probe_group_members '
+            +'JOIN probes ON probes.id=probe_group_members.probe_id ORDER BY probes.name').fetchall() :
+        members.setdefault(m['group_id'], []).append(m['name'])
+
+    # On renvoie l'HTML avec les infos
+    return render_template('managegroups.html', groups=groups, members=members,
+            width=THUMBNAIL_SIZE[0], height=THUMBNAIL_SIZE[1])
+
+
+
+
+def get_group(id) :
+    """Renvoie les infos d'un groupe (None si l'id ne correspond à aucun groupe)"""
+
+    db = get_db()
+    cur = db.execute('SELECT id, name, filename, profile FROM probe_groups WHERE id=?', [id])
+    return cur.fetchone()
+
+
+
+
+@app.route('/graph/group/<int:id>/overview.png')
+def group_overview(id) :
+    """Le graphe d'aperçu d'un groupe (PNG), lu dans la seule RRD du groupe"""
+
+    if not session.get('logged_in'):
+        abort(403)
+
+    group = get_group(id)
+    if not group :
+        abort(404)
+
+    return overview_response(group['filename'], group['name'])
+
+
+
+
+@app.route('/api/group/<int:id>/series')
+def api_group_series(id) :
+    """Les grandeurs d'un groupe pour les tracer dans le navigateur (cf series_response)"""
+
+    if not session.get('logged_in'):
+        abort(403)
+
+    group = get_group(id)
+    if not group :
+        abort(404)
+
+    return series_response(group['filename'])
+
+
+
+
+@app.route('/addgroup/', methods=['GET', 'POST'])
+def add_group():
+    """La page web qui permet d'ajouter un groupe de capteurs
+    Sa RRD est remplie par l'écoute dès l'ajout, son historique
+    peut être recalculé avec flask rebuildgroup"""
+
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+
+    # Les erreurs qu'on remonte à l'utilisateur (si il y en a)
+    error = None
+    profile = DEFAULT_STORAGE_PROFILE
+
+    db = get_db()
+    probes = db.execute('SELECT id, name FROM probes ORDER BY id').fetchall()
+
+    # Si les données ont été envoyées
+    if request.method == 'POST' :
+        if request.form.get('profile') in STORAGE_PROFILES :
+            profile = request.form['profile']
+        known = set(p['id'] for p in probes)
+        ids = [int(i) for i in request.form.getlist('probes') if i.isdigit() and int(i) in known]
+
+        if not request.form.get('name') :
+            error = 'Le groupe doit avoir un nom'
+        elif not ids :
+            error = 'Le groupe doit contenir au moins un capteur'
+        else :
+            name = request.form['name']
+            filename = group_filename(name)
+            # On crée la RRD du groupe avant de l'ajouter à la BDD
+            try :
+                create_group_rrd(filename, profile=profile)
+            except :
+                error = 'Une erreur est survenue lors de la création de la RRD du groupe'
+                print(sys.exc_info())
+            else :
+                try :
+                    cur = db.execute('INSERT INTO probe_groups (name, filename, profile) VALUES (?, ?, ?)',
+                            [name, filename, profile])
+                    db.executemany('INSERT INTO probe_group_members (group_id, probe_id) VALUES (?, ?)',
+                            [(cur.lastrowid, i) for i in ids])
+                    db.commit()
+                except :
+                    error = 'Une erreur est survenue lors de l\'ajout du groupe à la base de donnée. Suppression de '+filename+'.rrd'
+                    print(sys.exc_info())
+                    del_rrd(filename)
+                else :
+                    log('Groupe '+name+' ajouté ('+str(len(ids))+' capteurs)')
+                    flash('Le groupe '+name+' a bien été ajouté, son historique peut être recalculé avec flask rebuildgroup '+filename)
+                    return redirect(url_for('manage_groups'))
 
     # On renvoie l'HTML avec les infos
-    return render_template('addprobe.html', error=error)
+    profiles = [(p, human_size(rrd_size(p, predict=False))) for p in STORAGE_PROFILES]
+    return render_template('addgroup.html', error=error, probes=probes, profiles=profiles, profile=profile)
 
 
 
 
+@app.route('/removegroup/<int:id>/')
+def remove_group(id):
+    """La page web qui permet de retirer un groupe de capteurs (les capteurs restent)"""
+
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+
+    group = get_group(id)
+
+    # On vérifie que le groupe en question existe
+    if not group :
+        flash('Le groupe n\'a pas été trouvé')
+    else :
+        db = get_db()
+        try :
+            db.execute('DELETE FROM probe_group_members WHERE group_id=?', [id])
+            db.execute('DELETE FROM probe_groups WHERE id=?', [id])
+            db.commit()
+        except :
+            flash('Une erreur est survenue lors de la suppression de '+group['name']+' de la BDD')
+            print(sys.exc_info())
+        else :
+            # L'écoute arrête de remplir la RRD au prochain rechargement du registre
+            registry.refresh()
+            CACHE.forget(group['filename'])
+            GRAPHS.forget(group['filename'])
+            try :
+                del_rrd(group['filename'])
+            except :
+                flash('Une erreur est survenue lors de la suppression de '+group['filename']+'.rrd')
+                print(sys.exc_info())
+            else :
+                log('Groupe '+group['name']+' supprimé')
+                flash('Le groupe '+group['name']+' a bien été supprimé')
+
+    # On redirige vers la page de gestion des groupes
+    return redirect(url_for('manage_groups'))
+
+
+
 
 ##########################
 ## Flask views : alerts ##
@@ -751,11 +1707,30 @@ def manage_alerts():
 
     # On récupère les infos concernant l'ensemble des alertes
     db = get_db()
-    cur = db.execute('SELECT alerts.id, alerts.email, probes.name FROM alerts JOIN probes ON alerts.probe_id=probes.id ORDER BY alerts.id')
+    cur = db.execute('SELECT alerts.id, alerts.email, probes.name, probes.filename FROM alerts JOIN probes ON alerts.probe_id=probes.id ORDER BY alerts.id')
     alerts = cur.fetchall()
 
+    # Le dernier résultat des vérifications, par capteur
+    checks = {c['filename'] : c for c in alert_scheduler.status()}
+    for c in checks.values() :
+        if c['last_run'] :
+            c['last_run'] = datetime.fromtimestamp(c['last_run']).strftime('%d/%m/%Y %H:%M:%S')
+
     # On renvoie l'HTML avec les infos
-    return render_template('managealerts.html', alerts=alerts)
+    return render_template('managealerts.html', alerts=alerts, checks=checks)
+
+
+
+
+@app.route('/alerts/status')
+def alerts_status():
+    """L'état (JSON) des vérifications d'erreur des capteurs surveillés :
+    intervalle, dernière vérification (timestamp), durée, résultat et cycles manqués"""
+
+    if not session.get('logged_in'):
+        abort(403)
+
+    return jsonify(checks=alert_scheduler.status())
 
 
 
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import time
+from .constant import *
+from .metrics import LATE, BUCKET_SAMPLES
+
+class Aggregator :
+    """Regroupe les échantillons d'un capteur par seconde (la résolution des RRD)
+
+    Chaque seconde ouverte garde pour chaque grandeur la somme, le minimum,
+    le maximum et le nombre de valeurs reçues. Elle est scellée quand un
+    échantillon d'une seconde suivante arrive ou quand elle est ouverte
+    depuis plus de AGGREGATE_DELAY secondes : emit(name, moyennes, seconde)
+    est alors appelé une seule fois pour cette seconde.
+    Les échantillons d'une seconde déjà scellée sont ignorés.
+    RQ : rrdtool ne prend qu'une valeur par seconde, les archives MIN et MAX de
+    la RRD ne gardent que les pics entre secondes. Pour une seconde qui a reçu
+    plusieurs échantillons, peak(name, minimums, maximums, seconde) est aussi
+    appelé (cf create_subsecond_rrd)."""
+
+    def __init__ (self, emit, delay=None, peak=None) :
+        self.emit = emit
+        self.peak = peak
+        self.delay = delay if delay is not None else AGGREGATE_DELAY
+        # Les secondes ouvertes {filename : [seconde, sommes, minimums, maximums, nombres]}
+        self.buckets = {}
+        # La date d'ouverture des secondes ouvertes {filename : date}
+        # RQ : l'ordre d'insertion du dico est l'ordre d'ancienneté
+        self.opened = {}
+        # La dernière seconde scellée de chaque capteur {filename : seconde}
+        self.sealed = {}
+
+    def add (self, name, values, t=None) :
+        """Ajoute un échantillon à la seconde t du capteur name
+        Renvoie False si l'échantillon arrive trop tard (seconde déjà scellée)"""
+
+        if not t :
+            t = time.time()
+        t = int(t)
+
+        bucket = self.buckets.get(name)
+        if bucket is not None and t != bucket[0] :
+            if t < bucket[0] :
+                LATE.inc()
+                return False
+            self.seal(name)
+            bucket = None
+
+        if bucket is None :
+            if t <= self.sealed.get(name, 0) :
+                LATE.inc()
+                return False
+            bucket = self.buckets[name] = [t, [0.0]*6, ['U']*6, ['U']*6, [0]*6]
+            self.opened[name] = time.time()
+
+        sums, mins, maxs, counts = bucket[1:]
+        for i, v in enumerate(values) :
+            if v == 'U' :
+                continue
+            v = float(v)
+            sums[i] += v
+            if not counts[i] or v < mins[i] :
+                mins[i] = v
+            if not counts[i] or v > maxs[i] :
+                maxs[i] = v
+            counts[i] += 1
+
+        return True
+
+    def seal (self, name) :
+        """Scelle la seconde ouverte d'un capteur et émet ses moyennes"""
+
+        t, sums, mins, maxs, counts = self.buckets.pop(name)
+        del self.opened[name]
+        self.sealed[name] = t
+
+        BUCKET_SAMPLES.observe(max(counts))
+        self.emit(name, [s/c if c else 'U' for s, c in zip(sums, counts)], t)
+        if self.peak and max(counts) > 1 :
+            self.peak(name, mins, maxs, t)
+        return None
+
+    def seal_due (self, now=None) :
+        """Scelle les secondes ouvertes depuis plus de AGGREGATE_DELAY secondes"""
+
+        if not now :
+            now = time.time()
+
+        # On parcourt de la plus vieille à la plus récente et on s'arrête à la première assez jeune
+        names = []
+        for name, opened in self.opened.items() :
+            if now - opened < self.delay :
+                break
+            names.append(name)
+
+        for name in names :
+            self.seal(name)
+        return None
+
+    def seal_all (self) :
+        """Scelle toutes les secondes ouvertes (avant un arrêt)"""
+
+        for name in list(self.buckets.keys()) :
+            self.seal(name)
+        return None
+
+    def forget (self, name) :
+        """Oublie tout ce qui concerne une RRD (par exemple quand elle est supprimée)"""
+
+        self.buckets.pop(name, None)
+        self.opened.pop(name, None)
+        self.sealed.pop(name, None)
+        return None
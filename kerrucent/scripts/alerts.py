@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from .constant import *
+from .fetch import has_error
+from .metrics import ALERT_MISSED, ALERT_TIMEOUTS, ALERT_RUNNING, ALERT_LAG
+
+class Check :
+    """La vérification périodique d'un capteur surveillé (cf AlertScheduler)
+
+    next est la date de la prochaine vérification prévue et covered la date
+    jusqu'à laquelle les erreurs ont déjà été cherchées. last_result vaut
+    'ok', 'error' (erreur trouvée), 'failed' (vérification en échec) ou
+    'timeout' (vérification qui dépasse ALERT_TIMEOUT s, toujours en cours)."""
+
+    def __init__ (self, filename, name, interval, emails, now) :
+        self.filename = filename
+        self.name = name
+        self.interval = interval
+        self.emails = emails
+        # Les capteurs de même intervalle sont étalés sur l'intervalle
+        self.next = now + zlib.crc32(filename.encode('utf-8')) % interval
+        self.covered = now - interval
+        self.future = None
+        self.started = None
+        self.timed_out = False
+        self.last_run = None
+        self.last_duration = None
+        self.last_result = None
+        self.runs = 0
+        self.missed = 0
+
+    def running (self) :
+        return self.future is not None and not self.future.done()
+
+    def as_dict (self) :
+        return {
+            'filename' : self.filename,
+            'name' : self.name,
+            'interval' : self.interval,
+            'next' : self.next,
+            'last_run' : self.last_run,
+            'last_duration' : self.last_duration,
+            'last_result' : self.last_result,
+            'running' : self.running(),
+            'runs' : self.runs,
+            'missed' : self.missed,
+        }
+
+
+
+class AlertScheduler :
+    """Vérifie en continu les capteurs surveillés, chacun à son propre intervalle
+
+    load() renvoie les capteurs surveillés [(filename, name, intervalle en s, [emails])],
+    relus toutes les ALERT_RELOAD s. Les vérifications dues sont faites par un pool
+    de ALERT_WORKERS threads : check(filename, start) renvoie l'erreur trouvée depuis
+    start (cf has_error) et notify(Check, erreur) prévient les emails du capteur.
+
+    Une vérification qui dure plus de ALERT_TIMEOUT s est marquée 'timeout' et
+    comptée, mais elle ne peut pas être interrompue : elle garde son thread et le
+    capteur n'est pas revérifié avant sa fin. Les cycles passés pendant ce temps
+    (ou pendant que le pool était occupé) sont comptés comme manqués et ne sont
+    pas rattrapés un par un : la vérification suivante couvre toute la période
+    depuis la dernière réussie (au plus ALERT_MAX_WINDOW s)."""
+
+    def __init__ (self, load, notify, check=None, workers=None, timeout=None, log=print) :
+        self.load = load
+        self.notify = notify
+        self.check = check if check else has_error
+        self.workers = workers if workers else ALERT_WORKERS
+        self.timeout = timeout if timeout else ALERT_TIMEOUT
+        self.log = log
+        # Les vérifications des capteurs surveillés {filename : Check}
+        self.checks = {}
+        self.loaded = 0
+        self.lag = 0
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.stopping = threading.Event()
+        self.thread = None
+
+        ALERT_RUNNING.set_function(lambda : sum(1 for c in list(self.checks.values()) if c.running()))
+        ALERT_LAG.set_function(lambda : self.lag)
+
+    def reload (self, now) :
+        """Met à jour la liste des capteurs surveillés en gardant l'état des vérifications"""
+
+        checks = {}
+        for filename, name, interval, emails in self.load() :
+            interval = max(1, int(interval))
+            c = self.checks.get(filename)
+            if c is None :
+                c = Check(filename, name, interval, emails, now)
+            else :
+                c.name = name
+                c.emails = emails
+                # Un intervalle raccourci prend effet tout de suite
+                if interval != c.interval :
+                    c.next = min(c.next, now + interval)
+                    c.interval = interval
+            checks[filename] = c
+
+        # On remplace le dictionnaire d'un coup (cf status)
+        self.checks = checks
+        self.loaded = now
+        return None
+
+    def step (self, now=None) :
+        """Lance les vérifications dues (appelée toutes les ALERT_TICK s)"""
+
+        if not now :
+            now = time.time()
+        if now - self.loaded >= ALERT_RELOAD :
+            self.reload(now)
+
+        lag = 0
+        for c in list(self.checks.values()) :
+            if c.running() :
+                if not c.timed_out and now - c.started > self.timeout :
+                    c.timed_out = True
+                    c.last_result = 'timeout'
+                    ALERT_TIMEOUTS.inc()
+                    self.log('La vérification du capteur '+c.name+' dure depuis plus de '+str(self.timeout)+' s')
+                continue
+            if now < c.next :
+                continue
+
+            # Les cycles passés sans vérification (précédente trop longue, pool occupé, ...)
+            late = int((now - c.next)//c.interval)
+            if late :
+                c.missed += late
+                ALERT_MISSED.inc(late)
+            lag = max(lag, now - c.next)
+            c.next += (late + 1)*c.interval
+            self.submit(c, now)
+
+        self.lag = lag
+        return None
+
+    def submit (self, c, now) :
+        """Lance la vérification d'un capteur dans le pool"""
+
+        start = int(max(c.covered, now - ALERT_MAX_WINDOW))
+        c.started = now
+        c.timed_out = False
+        c.future = self.executor.submit(self.execute, c, start)
+        c.future.add_done_callback(lambda f : self.finish(c, f, now))
+        return None
+
+    def execute (self, c, start) :
+        """Vérifie un capteur (dans un thread du pool), renvoie (erreur, durée de la vérification)"""
+
+        begin = time.perf_counter()
+        error = self.check(c.filename, start)
+        duration = time.perf_counter() - begin
+
+        if error :
+            try :
+                self.notify(c, error)
+            except Exception as e :
+                self.log('Impossible de prévenir pour le capteur '+c.name+' : '+str(e))
+        return error, duration
+
+    def finish (self, c, future, started) :
+        """Enregistre le résultat d'une vérification"""
+
+        c.runs += 1
+        c.last_run = started
+        try :
+            error, c.last_duration = future.result()
+        except Exception as e :
+            c.last_duration = time.time() - started
+            c.last_result = 'failed'
+            self.log('Échec de la vérification du capteur '+c.name+' : '+str(e))
+        else :
+            c.last_result = 'error' if error else 'ok'
+            c.covered = started
+        return None
+
+    def status (self) :
+        """L'état des vérifications, par nom de capteur"""
+
+        return sorted((c.as_dict() for c in list(self.checks.values())), key=lambda c : c['name'])
+
+    def run (self) :
+        while not self.stopping.wait(ALERT_TICK) :
+            try :
+                self.step()
+            except Exception as e :
+                self.log('Erreur du planificateur d\'alertes : '+str(e))
+
+    def start (self) :
+        """Lance le planificateur dans un thread dédié"""
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return None
+
+    def stop (self) :
+        self.stopping.set()
+        if self.thread :
+            self.thread.join()
+        self.executor.shutdown(wait=False)
+        return None
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import time
+from .constant import *
+from .rrd import update_rrd_many, last_rrd
+
+class Batcher :
+    """Accumule les échantillons de chaque capteur et les écrit par paquets
+    dans les RRD : un seul appel à rrdtool.update pour plusieurs échantillons,
+    déclenché dès qu'un capteur a BATCH_SIZE échantillons en attente
+    ou que le plus vieux d'entre eux a plus de BATCH_MAX_AGE secondes"""
+
+    def __init__ (self, size=None, max_age=None) :
+        self.size = size if size else BATCH_SIZE
+        self.max_age = max_age if max_age is not None else BATCH_MAX_AGE
+        # Les échantillons en attente {filename : [(timestamp, values), ...]}
+        self.pending = {}
+        # La date d'arrivée du plus vieil échantillon en attente {filename : date}
+        # RQ : l'ordre d'insertion du dico est l'ordre d'ancienneté
+        self.since = {}
+        # Le dernier timestamp accepté pour chaque capteur {filename : timestamp}
+        self.last = {}
+        # Les capteurs qui ont atteint la taille maximale
+        self.full = set()
+
+    def add (self, name, values, t=None) :
+        """Met en attente un échantillon pour la RRD name
+        Renvoie False si l'échantillon est rejeté (seconde déjà remplie)"""
+
+        if not t :
+            t = int(time.time())
+        t = int(t)
+
+        # La 1ère fois, on part de la dernière mise à jour de la RRD
+        # (données déjà écrites avant un redémarrage, relues depuis le journal, ...)
+        if not name in self.last :
+            try :
+                self.last[name] = last_rrd(name)
+            except Exception :
+                self.last[name] = 0
+
+        # rrdtool refuse deux valeurs pour une même seconde (ou plus vieilles que la RRD)
+        # et une seule valeur refusée fait échouer tout le paquet
+        if t <= self.last[name] :
+            return False
+        self.last[name] = t
+
+        if not name in self.pending :
+            self.pending[name] = []
+            self.since[name] = time.time()
+        self.pending[name].append((t, values))
+
+        if len(self.pending[name]) >= self.size :
+            self.full.add(name)
+
+        return True
+
+    def due (self, now=None) :
+        """Renvoie la liste des capteurs dont les échantillons doivent être écrits"""
+
+        if not now :
+            now = time.time()
+
+        names = list(self.full)
+        # On parcourt du plus vieux au plus récent et on s'arrête au premier assez jeune
+        for name, since in self.since.items() :
+            if now - since < self.max_age :
+                break
+            if not name in self.full :
+                names.append(name)
+
+        return names
+
+    def flush (self, force=False) :
+        """Écrit dans les RRD les échantillons qui doivent l'être (tous si force)
+        Renvoie la liste des (filename, exception) des écritures qui ont échoué"""
+
+        names = list(self.pending.keys()) if force else self.due()
+
+        errors = []
+        for name in names :
+            # La RRD a pu être oubliée entre temps (cf forget, depuis un autre thread)
+            samples = self.pending.pop(name, None)
+            self.since.pop(name, None)
+            self.full.discard(name)
+            if not samples :
+                continue
+            try :
+                update_rrd_many(name, samples)
+            except Exception as e :
+                errors.append((name, e))
+
+        return errors
+
+    def forget (self, name) :
+        """Oublie tout ce qui concerne une RRD (par exemple quand elle est supprimée)"""
+
+        self.pending.pop(name, None)
+        self.since.pop(name, None)
+        self.last.pop(name, None)
+        self.full.discard(name)
+        return None
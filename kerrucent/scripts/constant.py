@@ -7,6 +7,36 @@ RRD_PATH = "rrd/"
 # Le dossier contenant les graph générés
 GRAPH_OUTPUT = "static/graph/"
 
+# L'adresse du démon rrdcached par lequel passent les écritures et lectures des RRD
+# (ex : 'unix:/var/run/kerrucent-rrdcached.sock', None pour accéder directement aux fichiers)
+RRDCACHED = None
+# Kerrucent lance et surveille lui même rrdcached
+RRDCACHED_SPAWN = False
+# L'exécutable de rrdcached
+RRDCACHED_BIN = "rrdcached"
+# Le dossier du journal de rrdcached
+RRDCACHED_JOURNAL = "rrdcached/"
+# La période (en s) d'écriture sur le disque des données de chaque RRD
+RRDCACHED_WRITE = 300
+# Le délai aléatoire (en s) ajouté à cette période pour étaler les écritures
+RRDCACHED_DELAY = 60
+# Le délai (en s) avant de relancer rrdcached s'il s'arrête
+RRDCACHED_RESTART = 5
+
+# Le profil de stockage des nouvelles RRD ('dense', 'standard' ou 'compact', cf rrd.py)
+DEFAULT_STORAGE_PROFILE = 'standard'
+
+# Le nombre maximal de lignes lues d'un coup dans une RRD (cf iter_fetch, 48 octets par ligne)
+FETCH_CHUNK = 86400
+
+# La taille maximale (en octets) du cache des lectures de RRD
+FETCH_CACHE_SIZE = 64*1024*1024
+# Le nombre de lignes d'un bloc du cache des lectures de RRD
+FETCH_CACHE_BLOCK = 3600
+
+# Les noms des grandeurs mesurées (dans l'ordre des paquets et des RRD)
+DS_NAMES = ['courant', 'tension', 'dephasage', 'puiss_active', 'puiss_reactive', 'puiss_apparente']
+
 # Les maximas et minimas des valeurs attendues
 MAXIMA = [30, 300, 360, 10000, 10000, 10000]
 MINIMA = [0, 0, 0, 0, 0, 0]
@@ -15,3 +45,123 @@ MINIMA = [0, 0, 0, 0, 0, 0]
 SERVER_IP = ''
 # Le port d'écoute du serveur pour les capteurs
 SERVER_PORT = 5005
+# La taille (en octets) du tampon noyau de réception du socket
+SERVER_RCVBUF = 4*1024*1024
+# Le nombre maximal d'échantillons reçus en attente d'écriture (au delà ils sont perdus)
+QUEUE_SIZE = 100000
+# Le délai (en s) au bout duquel l'écriture se réveille même sans nouveau paquet
+SERVER_TIMEOUT = 1
+
+# La période (en s) de vérification des modifications de capteurs faites par d'autres processus
+REGISTRY_POLL = 1
+
+# Le journal des échantillons reçus, relu en tâche de fond pour écrire dans les RRD
+# (chemin depuis APP_ROOT, None pour écrire directement depuis la réception)
+JOURNAL = None
+# Le nombre d'échantillons que peut contenir le journal (120 octets par échantillon)
+JOURNAL_CAPACITY = 262144
+# Que faire quand le journal est plein : 'drop_oldest', 'drop_newest' ou 'block'
+# (attention : 'block' bloque la réception de tous les capteurs en attendant la relecture)
+JOURNAL_POLICY = 'drop_oldest'
+# Le nombre maximal d'échantillons relus par passe
+JOURNAL_CHUNK = 50000
+# Le délai (en s) entre deux passes de relecture quand le journal est presque vide
+JOURNAL_REPLAY_INTERVAL = 5
+# Le nombre de passes de relecture consécutives en échec avant d'abandonner les échantillons d'une RRD
+JOURNAL_RETRIES = 12
+
+# Le nombre de processus d'écoute (chacun écrit dans ses propres RRD)
+INGEST_WORKERS = 1
+# La période (en s) d'envoi des métriques des processus d'écoute au processus web (cf /metrics)
+INGEST_METRICS_INTERVAL = 5
+# Les processus d'écoute partagent SERVER_PORT via SO_REUSEPORT (sinon un répartiteur est utilisé)
+INGEST_REUSEPORT = True
+# Le port privé du 1er processus d'écoute (les suivants prennent les ports suivants)
+INGEST_BASE_PORT = 5100
+
+# L'écart maximal (en s) entre le timestamp d'un échantillon reçu et la date de réception,
+# dans le futur et dans le passé (horloge du capteur déréglée, paquet corrompu, ...)
+SAMPLE_MAX_AHEAD = 60
+SAMPLE_MAX_AGE = 86400
+# Le nombre de mac binaires dont la conversion en texte est gardée (cf decode_many)
+MAC_CACHE_SIZE = 65536
+
+# Le délai (en s) après lequel une seconde est écrite même sans échantillon plus récent du capteur
+# (les échantillons d'une même seconde sont moyennés, cf Aggregator)
+AGGREGATE_DELAY = 1.5
+# Le dossier (dans RRD_PATH) des RRD des pics à l'intérieur des secondes, pour les capteurs
+# qui envoient plus d'un échantillon par seconde (cf Aggregator et subsecond_name)
+SUBSECOND_PATH = "pics/"
+
+# Le nombre d'échantillons en attente pour un capteur qui déclenche l'écriture dans la RRD
+BATCH_SIZE = 60
+# L'âge maximal (en s) d'un échantillon en attente avant son écriture dans la RRD
+BATCH_MAX_AGE = 10
+
+# Le nombre d'échantillons lus et triés d'un coup par flask importdata
+IMPORT_CHUNK = 1000000
+# Le nombre d'échantillons par appel à rrdtool.update pour flask importdata
+IMPORT_BATCH = 10000
+
+# Les paramètres de prédiction (Holt-Winters) par défaut des nouveaux capteurs
+DEFAULT_ALPHA = 0.000192522
+DEFAULT_BETA = 0.00000802250
+DEFAULT_PERIOD = 86400
+
+# Le nombre de processus qui créent les RRD des nouveaux capteurs en tâche de fond
+PROVISION_WORKERS = 4
+# Le nombre de créations terminées dont on garde le statut (pour les pages de gestion)
+PROVISION_HISTORY = 200
+
+# La durée (en s) pendant laquelle un graphe reste à jour selon la période affichée :
+# [(période maximale, durée)], au delà la dernière durée
+GRAPH_CACHE_BUCKETS = [(3600, 60), (86400, 300), (2678400, 1800), (31622400, 3600)]
+# Le nombre maximal de graphes gardés dans GRAPH_OUTPUT
+GRAPH_CACHE_FILES = 500
+# La taille maximale (en octets) des graphes gardés dans GRAPH_OUTPUT
+GRAPH_CACHE_SIZE = 100*1024*1024
+# L'âge (en s) au delà duquel un graphe inconnu du cache est supprimé (autre processus, ancien nom, ...)
+GRAPH_CACHE_ORPHAN_AGE = 3600
+# La période (en s) de recherche des graphes orphelins
+GRAPH_CACHE_GC_INTERVAL = 600
+
+# Le nombre de processus qui génèrent en parallèle les graphes de la page d'aperçu
+GRAPH_WORKERS = 4
+# Le temps (en s) laissé à chaque graphe de la page d'aperçu avant d'afficher un message à la place
+GRAPH_TIMEOUT = 10
+
+# Le nombre de capteurs par page de l'aperçu global
+APERCU_PAGE = 20
+# La taille (en pixels) des graphes de l'aperçu global
+THUMBNAIL_SIZE = (550, 300)
+
+# La largeur (en pixels) maximale demandée à l'API des séries (cf /api/probe/<id>/series)
+API_MAX_WIDTH = 10000
+
+# Le délai (en s) après la dernière seconde reçue d'un capteur avant d'écrire une seconde de ses groupes
+# (laisse aux autres capteurs du groupe le temps d'envoyer la même seconde)
+GROUP_DELAY = 5
+# La durée (en s) pendant laquelle la dernière valeur d'un capteur compte dans la somme de ses groupes
+GROUP_HOLD = 10
+# Le nombre maximal de secondes d'un groupe parcourues d'un coup (la suite attend le prochain passage)
+GROUP_SEAL_MAX = 3600
+# Le préfixe des fichiers RRD des groupes de capteurs
+GROUP_PREFIX = 'groupe_'
+# Le nombre de capteurs lus en parallèle par flask rebuildgroup
+REBUILD_WORKERS = 4
+
+# Le nombre maximal de capteurs superposés sur le graphe de comparaison
+COMPARE_MAX = 20
+
+# L'intervalle (en s) par défaut entre deux vérifications d'erreur d'un capteur surveillé
+ALERT_INTERVAL = 60
+# Le nombre de vérifications d'erreur faites en parallèle
+ALERT_WORKERS = 8
+# Le temps (en s) au delà duquel une vérification est comptée comme trop longue
+ALERT_TIMEOUT = 10
+# La période (en s) de relecture des capteurs surveillés dans la BDD
+ALERT_RELOAD = 30
+# La période (en s) à laquelle le planificateur cherche les vérifications dues
+ALERT_TICK = 1
+# La période maximale (en s) couverte par une vérification après des cycles manqués
+ALERT_MAX_WINDOW = 3600
@@ -1,22 +1,43 @@
 #!/bin/usr/python
 
-import socket
+import struct
+import time
+from functools import lru_cache
+import numpy as np
 from .constant import *
+from .metrics import SAMPLES, REJECTED, BAD_TIMESTAMPS
 
-# On ouvre un socket
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-server_address = (SERVER_IP, SERVER_PORT)
-sock.bind(server_address)
+# Format binaire des paquets (little endian) :
+#   en-tête  : 'KR' (2 octets), version (1 octet), nombre d'échantillons n (1 octet)
+#   n fois   : mac (6 octets), timestamp (uint32, 0 = date de réception), 6 valeurs (float32)
+# Le format texte <mac>/<v1>/.../<v6> reste accepté (une mac texte ne commence jamais par 'K')
+WIRE_MAGIC = b'KR'
+WIRE_VERSION = 1
+WIRE_HEADER = struct.Struct('<2sBB')
+WIRE_SAMPLE = np.dtype([('mac', 'S6'), ('t', '<u4'), ('v', '<f4', (6,))])
+WIRE_MAX_SAMPLES = 255
 
-def listen() :
-    """Ecoute le socket et renvoie les données reçue pour peu
-    qu'elles correspondent à des données cohérentes"""
+_MINIMA = np.array(MINIMA, dtype=np.float64)
+_MAXIMA = np.array(MAXIMA, dtype=np.float64)
 
-    # On attend un paquet
-    data, address = sock.recvfrom(1024)
+@lru_cache(maxsize=MAC_CACHE_SIZE)
+def mac_text(mac) :
+    """Convertit une mac binaire en texte 'AA:BB:CC:DD:EE:FF' (les dernières sont gardées :
+    n'importe qui peut envoyer des mac inventées, le cache doit rester borné)"""
+
+    # RQ : numpy retire les \x00 de fin des champs 'S', on complète
+    return ':'.join('%02X' % b for b in mac.ljust(6, b'\x00'))
+
+def decode(data) :
+    """Décode un paquet reçu d'un capteur et renvoie (mac, valeurs) pour peu
+    qu'il corresponde à des données cohérentes, (None, None) sinon
+    Les valeurs hors de [MINIMA, MAXIMA] sont remplacées par 'U' (inconnue)"""
 
     # On reforme les données
-    d = data.decode('utf-8').replace('\x00', '').split('/')
+    try :
+        d = data.decode('utf-8').replace('\x00', '').split('/')
+    except UnicodeDecodeError :
+        return None, None
 
     # On sépare les infos les unes des autres
     ident = d[0]
@@ -26,6 +47,96 @@ def listen() :
             values[i] = d[i+1] if MINIMA[i] <= float(d[i+1]) <= MAXIMA[i] else 'U'
         except :
             pass
+        if values[i] == 'U' :
+            REJECTED.inc(1, DS_NAMES[i])
 
     # On renvoie les infos utiles
     return ident, values
+
+
+
+def is_binary(data) :
+    """Indique si un paquet est au format binaire"""
+
+    return data[:2] == WIRE_MAGIC
+
+
+
+def encode(samples) :
+    """Encode une liste de (mac, timestamp, valeurs) au format binaire
+    (timestamp à 0 ou None pour utiliser la date de réception)"""
+
+    if len(samples) > WIRE_MAX_SAMPLES :
+        raise ValueError('Au plus '+str(WIRE_MAX_SAMPLES)+' échantillons par paquet')
+
+    arr = np.zeros(len(samples), dtype=WIRE_SAMPLE)
+    for i, (mac, t, values) in enumerate(samples) :
+        arr[i]['mac'] = bytes(int(b, 16) for b in mac.split(':'))
+        arr[i]['t'] = int(t) if t else 0
+        arr[i]['v'] = [float('nan') if v == 'U' else float(v) for v in values]
+
+    return WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, len(samples)) + arr.tobytes()
+
+
+
+def decode_many(buffers, now=None) :
+    """Décode d'un coup une liste de paquets (texte ou binaires)
+    Renvoie une liste de (indice du paquet, mac, timestamp, valeurs),
+    les paquets incohérents étant ignorés
+
+    Tous les paquets binaires sont décodés et vérifiés en une seule passe NumPy.
+    Les échantillons datés de plus de SAMPLE_MAX_AHEAD s après la réception ou
+    de plus de SAMPLE_MAX_AGE s avant sont ignorés"""
+
+    if not now :
+        now = int(time.time())
+
+    samples = []
+    payloads = []
+    indices = []
+    counts = []
+
+    for i, data in enumerate(buffers) :
+        if not is_binary(data) :
+            ident, values = decode(data)
+            if ident :
+                samples.append((i, ident, now, values))
+            continue
+
+        # On vérifie l'en-tête avant de garder le paquet
+        if len(data) < WIRE_HEADER.size :
+            continue
+        magic, version, n = WIRE_HEADER.unpack_from(data)
+        if version != WIRE_VERSION or n == 0 or len(data) != WIRE_HEADER.size + n*WIRE_SAMPLE.itemsize :
+            continue
+        payloads.append(data[WIRE_HEADER.size:])
+        indices.append(i)
+        counts.append(n)
+
+    if not payloads :
+        SAMPLES.inc(len(samples))
+        return samples
+
+    arr = np.frombuffer(b''.join(payloads), dtype=WIRE_SAMPLE)
+
+    # Les vérifications de plage pour tous les échantillons (NaN est toujours hors plage)
+    v = arr['v'].astype(np.float64)
+    rejected = ~((v >= _MINIMA) & (v <= _MAXIMA))
+    v[rejected] = np.nan
+    for i, n in enumerate(rejected.sum(axis=0).tolist()) :
+        if n :
+            REJECTED.inc(n, DS_NAMES[i])
+    # La date de réception pour les échantillons sans timestamp
+    t = arr['t'].astype(np.int64)
+    t[t == 0] = now
+    # Les dates aberrantes bloqueraient les secondes des capteurs et des groupes
+    ok = (t <= now + SAMPLE_MAX_AHEAD) & (t >= now - SAMPLE_MAX_AGE)
+    if not ok.all() :
+        BAD_TIMESTAMPS.inc(int((~ok).sum()))
+
+    origins = np.repeat(indices, counts)[ok].tolist()
+    for i, mac, ts, values in zip(origins, arr['mac'][ok].tolist(), t[ok].tolist(), v[ok].tolist()) :
+        samples.append((i, mac_text(mac), ts, [x if x == x else 'U' for x in values]))
+
+    SAMPLES.inc(len(samples))
+    return samples
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import zlib
+import numpy as np
+from .constant import *
+from .fetch import iter_fetch
+
+# Les formats d'export {nom : type MIME}
+EXPORT_FORMATS = {'csv' : 'text/csv', 'ndjson' : 'application/x-ndjson'}
+
+def export_csv(name, start, end, resolution=1) :
+    """Génère morceau par morceau le CSV (timestamp + les 6 grandeurs) d'une RRD
+    Les valeurs inconnues sont laissées vides"""
+
+    yield ','.join(['timestamp'] + DS_NAMES) + '\n'
+
+    for series in iter_fetch(name, 'AVERAGE', start, end, resolution) :
+        buf = io.StringIO()
+        np.savetxt(buf, np.column_stack([series.times, series.values]),
+                fmt=['%d'] + ['%.6g']*len(series.names), delimiter=',')
+        yield buf.getvalue().replace('nan', '')
+
+
+
+def export_ndjson(name, start, end, resolution=1) :
+    """Génère morceau par morceau le NDJSON (un objet par ligne) d'une RRD
+    Les valeurs inconnues valent null"""
+
+    for series in iter_fetch(name, 'AVERAGE', start, end, resolution) :
+        lines = []
+        for t, values in zip(series.times.tolist(), series.values.tolist()) :
+            row = {'timestamp' : t}
+            for n, v in zip(series.names, values) :
+                row[n] = v if v == v else None
+            lines.append(json.dumps(row))
+        if lines :
+            yield '\n'.join(lines) + '\n'
+
+
+
+def export(name, start, end, resolution=1, format='csv') :
+    """Génère l'export d'une RRD au format demandé (cf EXPORT_FORMATS)"""
+
+    if format == 'ndjson' :
+        return export_ndjson(name, start, end, resolution)
+    return export_csv(name, start, end, resolution)
+
+
+
+def gzip_stream(chunks, level=6) :
+    """Compresse au fil de l'eau (format gzip) un générateur de morceaux de texte"""
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks :
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data :
+            yield data
+    yield compressor.flush()
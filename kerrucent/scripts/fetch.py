@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+import rrdtool
+from .constant import *
+from .rrd import rrd_file, daemon_args, last_rrd, subsecond_name
+from .metrics import ALERT_CHECK, FETCH_CACHE_HITS, FETCH_CACHE_MISSES, FETCH_CACHE_BYTES
+
+class Series :
+    """Le résultat d'une lecture de RRD (fetch ou xport) sous forme de tableaux NumPy
+
+    values est un tableau float64 à 2 dimensions (une ligne par date, une colonne
+    par grandeur dans l'ordre de names), les valeurs inconnues valent NaN.
+    La ligne i couvre les step secondes qui précèdent times[i] = start + step*(i+1)"""
+
+    def __init__ (self, start, step, names, values) :
+        self.start = start
+        self.step = step
+        self.names = list(names)
+        self.values = values
+
+    @property
+    def times (self) :
+        return self.start + self.step*np.arange(1, len(self.values)+1, dtype=np.int64)
+
+    @property
+    def end (self) :
+        return self.start + self.step*len(self.values)
+
+    def __len__ (self) :
+        return len(self.values)
+
+    def __getitem__ (self, name) :
+        """La colonne (1 dimension) d'une grandeur"""
+
+        return self.values[:, self.names.index(name)]
+
+    def after (self, t) :
+        """Renvoie la partie de la série postérieure à t"""
+
+        skip = max(0, min(len(self.values), (t - self.start)//self.step))
+        return Series(self.start + skip*self.step, self.step, self.names, self.values[skip:])
+
+    def before (self, t) :
+        """Renvoie la partie de la série antérieure à t (la ligne qui contient t comprise)"""
+
+        keep = max(0, min(len(self.values), -(-(t - self.start)//self.step)))
+        return Series(self.start, self.step, self.names, self.values[:keep])
+
+
+
+def to_array(rows, columns) :
+    """Convertit les lignes renvoyées par rrdtool (None pour inconnu) en tableau float64 (NaN)"""
+
+    if not rows :
+        return np.empty((0, columns), dtype=np.float64)
+    return np.array(rows, dtype=np.float64).reshape(len(rows), columns)
+
+
+
+def fetch_array(name, cf='AVERAGE', start='-1d', end='now', resolution=None) :
+    """rrdtool.fetch sur une RRD, renvoyé sous forme de Series"""
+
+    params = daemon_args() + [rrd_file(name), cf, '--start', str(start), '--end', str(end)]
+    if resolution :
+        params += ['--resolution', str(resolution)]
+
+    (first, last, step), names, rows = rrdtool.fetch(*params)
+    return Series(first, step, names, to_array(rows, len(names)))
+
+
+
+def xport_array(name, cf='AVERAGE', start='-1d', end='now', step=None, names=None) :
+    """rrdtool.xport des grandeurs names (toutes par défaut) d'une RRD, renvoyé sous forme de Series
+    Contrairement à fetch, rrdtool consolide lui même les données au step demandé"""
+
+    if not names :
+        names = DS_NAMES
+
+    params = daemon_args() + ['--start', str(start), '--end', str(end)]
+    if step :
+        params += ['--step', str(step)]
+    for n in names :
+        params += ['DEF:'+n+'='+rrd_file(name)+':'+n+':'+cf, 'XPORT:'+n+':'+n]
+
+    res = rrdtool.xport(*params)
+    meta = res['meta']
+    return Series(meta['start'] - meta['step'], meta['step'], names, to_array(res['data'], len(names)))
+
+
+
+def iter_fetch(name, cf='AVERAGE', start=None, end=None, resolution=1, chunk=None) :
+    """Lit une RRD entre start et end (timestamps) par morceaux d'au plus chunk lignes
+    pour que la mémoire utilisée reste bornée sur les longues périodes
+    Génère des Series consécutives, sans ligne en double entre deux morceaux"""
+
+    if not chunk :
+        chunk = FETCH_CHUNK
+    if not end :
+        end = int(time.time())
+    if not start :
+        start = end - 86400
+
+    done = start
+    step = resolution
+    while done < end :
+        series = fetch_array(name, cf, done, min(end, done + chunk*step), resolution)
+        # rrdtool aligne les dates sur sa résolution : on retire ce qui a déjà été renvoyé
+        series = series.after(done)
+        if not len(series) :
+            break
+        yield series
+        done = series.end
+        # rrdtool a pu répondre avec une archive plus grossière que demandé
+        step = max(resolution, series.step)
+    return None
+
+
+
+class FetchCache :
+    """Cache LRU (en mémoire, borné en octets) des lectures de RRD
+
+    Les lectures sont découpées en blocs de FETCH_CACHE_BLOCK lignes alignés
+    sur la résolution : (fichier, fonction de consolidation, résolution, début du bloc).
+    Un bloc entièrement antérieur à la dernière mise à jour de la RRD ne bouge
+    plus et est réutilisé tel quel, les autres (la fin de la période) ne le sont
+    que si la RRD n'a pas été mise à jour depuis leur lecture."""
+
+    def __init__ (self, size=None, block=None) :
+        self.size = size if size else FETCH_CACHE_SIZE
+        self.block = block if block else FETCH_CACHE_BLOCK
+        # {clé : (Series, dernière mise à jour lors de la lecture, bloc terminé)}
+        # RQ : l'ordre du dico est l'ordre d'utilisation (le moins récent en premier)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def get (self, key, start, end, last, load) :
+        """Renvoie le bloc key (de start à end), lu par load(start, end) si besoin"""
+
+        with self.lock :
+            entry = self.entries.get(key)
+            if entry and (entry[2] or entry[1] == last) :
+                self.entries.move_to_end(key)
+                FETCH_CACHE_HITS.inc()
+                return entry[0]
+
+        FETCH_CACHE_MISSES.inc()
+        series = load(start, end)
+
+        with self.lock :
+            old = self.entries.pop(key, None)
+            if old :
+                self.bytes -= old[0].values.nbytes
+            self.entries[key] = (series, last, series.end <= last)
+            self.bytes += series.values.nbytes
+            # On oublie les blocs les moins récemment utilisés
+            while self.bytes > self.size and self.entries :
+                k, (s, l, f) = self.entries.popitem(last=False)
+                self.bytes -= s.values.nbytes
+
+        return series
+
+    def read (self, key, start, end, resolution, load) :
+        """Lit une période par blocs alignés et renvoie la liste des Series (non coupées)
+        key est le début des clés des blocs, load(start, end) lit un bloc"""
+
+        last = last_rrd(key[1])
+        span = resolution*self.block
+        blocks = []
+        for b in range((start//span)*span, end, span) :
+            blocks.append(self.get(key + (b,), b, b + span, last, load))
+        return blocks
+
+    def forget (self, name) :
+        """Oublie les blocs d'une RRD (supprimée, recréée, ...) et de ses RRD de pics"""
+
+        names = (name, subsecond_name(name, 'MIN'), subsecond_name(name, 'MAX'))
+        with self.lock :
+            for key in [k for k in self.entries if k[1] in names] :
+                self.bytes -= self.entries.pop(key)[0].values.nbytes
+        return None
+
+    def __len__ (self) :
+        return len(self.entries)
+
+
+
+# Le cache des lectures de RRD du processus
+CACHE = FetchCache()
+FETCH_CACHE_BYTES.set_function(lambda : CACHE.bytes)
+
+def join(blocks, start, end) :
+    """Recolle des blocs consécutifs en une Series de start à end
+    Renvoie None si c'est impossible (résolutions différentes, trou, ...)"""
+
+    blocks = [b for b in blocks if len(b)]
+    if not blocks :
+        return None
+    for a, b in zip(blocks, blocks[1:]) :
+        if a.step != b.step or a.end != b.start :
+            return None
+
+    series = Series(blocks[0].start, blocks[0].step, blocks[0].names, np.concatenate([b.values for b in blocks]))
+    return series.after(start).before(end)
+
+
+
+def cached_fetch(name, cf='AVERAGE', start=None, end=None, resolution=1) :
+    """fetch_array (start et end en timestamps) qui passe par le cache des lectures"""
+
+    if not end :
+        end = int(time.time())
+    if not start :
+        start = end - 86400
+
+    load = lambda s, e : fetch_array(name, cf, s, e, resolution)
+    series = join(CACHE.read(('fetch', name, cf, resolution), start, end, resolution, load), start, end)
+    return series if series is not None else fetch_array(name, cf, start, end, resolution)
+
+
+
+def has_error (name, start=None) :
+    """Vérifie si une rrd (donc un capteur présente des erreurs depuis start
+    (timestamp, la dernière minute par défaut), en passant par le cache des lectures
+    Renvoie (ligne, grandeur) de la première erreur, None sinon"""
+
+    begin = time.perf_counter()
+    try :
+        end = int(time.time())
+        series = cached_fetch(name, 'FAILURES', int(start) if start else end - 60, end)
+        errors = np.argwhere(series.values == 1.0)
+        if len(errors) :
+            return tuple(int(x) for x in errors[0])
+    finally :
+        ALERT_CHECK.observe(time.perf_counter() - begin, name)
+
+    return None
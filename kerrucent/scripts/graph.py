@@ -1,30 +1,464 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
+import sys
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, BrokenExecutor, wait, FIRST_COMPLETED
+from collections import OrderedDict
 from datetime import datetime
+from hashlib import sha1
 from enum import Enum
+import zlib
 import rrdtool
 from .constant import *
+from .rrd import rrd_file, daemon_args, rrd_archives
+from .metrics import GRAPH_CACHE_HITS, GRAPH_CACHE_MISSES, GRAPH_CACHE_COUNT, GRAPH_FAILURES
 
 WIDTH = 1200
 Duree = Enum("Duree", "h1 j1 m1 a1")
 Grandeur = Enum("Grandeur", "courant tension dephasage puiss_active puiss_reactive puiss_apparente")
 
+# La longueur (en s) des graphes pour chaque durée
+DUREES = {Duree.h1 : 3600, Duree.j1 : 86400, Duree.m1 : 2678400, Duree.a1 : 31622400}
+# Le nom des données, le facteur d'échelle et la couleur de chaque grandeur dans graph_detail
+COURBES = {Grandeur.courant : ("courant", 100, "FF0000"),
+        Grandeur.tension : ("tension", 10, "00FF00"),
+        Grandeur.dephasage : ("dephasage", 10, "0000FF"),
+        Grandeur.puiss_active : ("active", 1, "FFBF00"),
+        Grandeur.puiss_reactive : ("reactive", 1, "2E9AFE"),
+        Grandeur.puiss_apparente : ("apparente", 1, "FF00FF")}
+# La plus petite période (en s) affichable dans graph_detail
+MIN_SPAN = 60
+# Le nom et l'unité de chaque grandeur dans graph_compare
+LEGENDES = {Grandeur.courant : ("Courant", "A"),
+        Grandeur.tension : ("Tension", "V"),
+        Grandeur.dephasage : ("Déphasage", "°"),
+        Grandeur.puiss_active : ("Puissance active", "W"),
+        Grandeur.puiss_reactive : ("Puissance réactive", "VAR"),
+        Grandeur.puiss_apparente : ("Puissance apparente", "VA")}
+# Les couleurs des courbes de graph_compare (cf couleurs)
+PALETTE = ["1F77B4", "FF7F0E", "2CA02C", "D62728", "9467BD", "8C564B",
+        "E377C2", "7F7F7F", "BCBD22", "17BECF", "393B79", "AD494A"]
+# La hauteur (en pixels) d'une ligne de légende et le nombre de caractères gardés des noms
+LIGNE_LEGENDE = 16
+NOM_LEGENDE = 24
+# Les unités des durées relatives de rrdtool (approximées pour mon et y)
+UNITES = {"s" : 1, "min" : 60, "h" : 3600, "d" : 86400, "w" : 604800, "mon" : 2678400, "y" : 31622400}
+
 def safename(name) :
     return "".join(i for i in name if ord(i)<128).replace(' ', '_').replace('/', '_').replace('\\', '_')
 
+def offset(t) :
+    """Convertit une date relative de rrdtool (ex : -7d, +0h) en secondes, None si autre chose"""
+
+    m = re.match(r"^([-+]?)(\d+)(s|min|h|d|w|mon|y)$", t)
+    if not m :
+        return None
+    return (-1 if m.group(1) == "-" else 1) * int(m.group(2)) * UNITES[m.group(3)]
+
+def timestamp(t, now=None) :
+    """Convertit une date (timestamp ou date relative de rrdtool) en timestamp, None si impossible"""
+
+    if isinstance(t, (int, float)) :
+        return int(t)
+    if not now :
+        now = int(time.time())
+    t = offset(t)
+    return now + t if t is not None else None
+
+def resolution(capteur_filename, start, end, width) :
+    """Choisit la résolution (en s) des données d'un graphe : l'archive AVERAGE la plus
+    grossière qui donne encore environ une ligne par pixel parmi celles qui remontent
+    jusqu'à start (sinon celle qui remonte le plus loin)
+    Renvoie (résolution, pics) où pics indique s'il faut tracer les archives MIN et MAX :
+    l'archive est consolidée et la moyenne y cache les pointes
+    Renvoie (None, False) si la RRD ne peut pas être lue (rrdtool choisit alors seul)"""
+
+    start, end = timestamp(start), timestamp(end)
+    try :
+        archives, last = rrd_archives(capteur_filename)
+    except Exception :
+        return None, False
+    averages = archives.get("AVERAGE")
+    if start is None or end is None or not averages :
+        return None, False
+
+    per_pixel = (end - start)/float(width)
+    covering = [res for res, rows in averages if last - res*rows <= start]
+    if not covering :
+        step = max(averages, key=lambda a : a[0]*a[1])[0]
+    else :
+        fitting = [res for res in covering if res <= per_pixel]
+        step = max(fitting) if fitting else min(covering)
+
+    return step, peak_archives(archives, step)
+
+def peak_archives(archives, step) :
+    """Indique s'il faut tracer les archives MIN et MAX d'une RRD (cf rrd_archives) lue à
+    la résolution step : l'archive est consolidée et ses MIN et MAX existent à cette résolution"""
+
+    averages = archives.get("AVERAGE")
+    return bool(averages) and step > averages[0][0] and \
+            step in [res for res, rows in archives.get("MAX", [])] and \
+            step in [res for res, rows in archives.get("MIN", [])]
+
+def peaks_at(capteur_filename, step) :
+    """Comme peak_archives, à partir du nom de la RRD (False si elle ne peut pas être lue)"""
+
+    try :
+        return peak_archives(rrd_archives(capteur_filename)[0], step)
+    except Exception :
+        return False
+
+def bucket(span) :
+    """La durée (en s) pendant laquelle un graphe de span secondes reste à jour (cf GRAPH_CACHE_BUCKETS)"""
+
+    for limit, b in GRAPH_CACHE_BUCKETS :
+        if span <= limit :
+            return b
+    return GRAPH_CACHE_BUCKETS[-1][1]
+
+def period_key(start, end, now=None) :
+    """La partie temporelle de la clé d'un graphe dans le cache
+    Une période qui va jusqu'à maintenant (relative ou en timestamps) ne dépend que
+    de sa longueur et de la tranche de bucket(longueur) secondes en cours : le graphe
+    reste le même pendant toute la tranche. Une période passée est fixe.
+    RQ : un graphe passé n'est donc pas regénéré après un import d'historique (flask importdata)"""
+
+    if not now :
+        now = int(time.time())
+    s, e = timestamp(start, now), timestamp(end, now)
+    if s is None or e is None :
+        return (str(start), str(end), now)
+    b = bucket(e - s)
+    if e >= now - b :
+        return (e - s, "live", now//b)
+    return (s, e)
+
+class GraphCache :
+    """Cache LRU des graphes générés dans GRAPH_OUTPUT
+
+    Un graphe est identifié par une clé (type, capteur, paramètres, taille et
+    période, cf period_key) et son fichier est nommé d'après cette clé : tant
+    que la clé ne change pas, on renvoie le résultat de rrdtool.graphv déjà obtenu.
+    Le nombre et la taille des fichiers sont bornés (GRAPH_CACHE_FILES,
+    GRAPH_CACHE_SIZE), les graphes qui ne sont pas dans le cache (anciens noms,
+    autres processus, redémarrage) sont supprimés après GRAPH_CACHE_ORPHAN_AGE s."""
+
+    def __init__ (self, directory=None, files=None, size=None) :
+        self.directory = directory if directory else os.path.join(APP_ROOT, GRAPH_OUTPUT)
+        self.files = files if files else GRAPH_CACHE_FILES
+        self.size = size if size else GRAPH_CACHE_SIZE
+        # {clé : (résultat de graphv, chemin, taille)}, le moins récemment utilisé en premier
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.collected = 0
+        self.lock = threading.Lock()
+
+    def path (self, key, name) :
+        """Le fichier d'un graphe : un hash de la clé et le nom du capteur (lisible)"""
+
+        digest = sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.directory, digest+"_"+safename(name)+".png")
+
+    def get (self, key, name, draw) :
+        """Renvoie le graphe key (à jour), généré par draw(chemin) si besoin"""
+
+        res = self.lookup(key)
+        if res is not None :
+            return res
+
+        path = self.path(key, name)
+        res = draw(path)
+        self.store(key, res, path)
+        return res
+
+    def lookup (self, key) :
+        """Renvoie le graphe key s'il est dans le cache, None sinon"""
+
+        with self.lock :
+            entry = self.entries.get(key)
+            if entry and os.path.isfile(entry[1]) :
+                self.entries.move_to_end(key)
+                GRAPH_CACHE_HITS.inc()
+                return entry[0]
+
+        GRAPH_CACHE_MISSES.inc()
+        return None
+
+    def read (self, key, name) :
+        """Le contenu (PNG) du graphe key, None si son fichier a disparu entre temps
+        (évincé ou supprimé par un autre processus) : il est alors oublié"""
+
+        try :
+            with open(self.path(key, name), 'rb') as f :
+                return f.read()
+        except FileNotFoundError :
+            with self.lock :
+                old = self.entries.pop(key, None)
+                if old :
+                    self.bytes -= old[2]
+            return None
+
+    def store (self, key, res, path) :
+        """Ajoute au cache le graphe key généré dans path"""
+
+        try :
+            size = os.path.getsize(path)
+        except OSError :
+            return None
+
+        with self.lock :
+            old = self.entries.pop(key, None)
+            if old :
+                self.bytes -= old[2]
+            self.entries[key] = (res, path, size)
+            self.bytes += size
+            removed = self.evict()
+
+        for p in removed :
+            self.remove(p)
+        if time.time() - self.collected > GRAPH_CACHE_GC_INTERVAL :
+            self.collect()
+        return None
+
+    def evict (self) :
+        """Oublie les graphes les moins récemment utilisés au delà des bornes
+        Renvoie les fichiers à supprimer (RQ : appelée avec self.lock)"""
+
+        removed = []
+        while len(self.entries) > 1 and (len(self.entries) > self.files or self.bytes > self.size) :
+            k, (res, p, size) = self.entries.popitem(last=False)
+            self.bytes -= size
+            removed.append(p)
+        return removed
+
+    def remove (self, path) :
+        try :
+            os.remove(path)
+        except OSError :
+            pass
+        return None
+
+    def collect (self, age=None) :
+        """Supprime les graphes orphelins (inconnus du cache et vieux de plus de age s)
+        Renvoie le nombre de fichiers supprimés"""
+
+        if age is None :
+            age = GRAPH_CACHE_ORPHAN_AGE
+        self.collected = time.time()
+        with self.lock :
+            known = set(p for res, p, size in self.entries.values())
+
+        removed = 0
+        try :
+            files = os.listdir(self.directory)
+        except OSError :
+            return 0
+        for f in files :
+            p = os.path.join(self.directory, f)
+            if not f.endswith(".png") or p in known :
+                continue
+            try :
+                if os.path.getmtime(p) < self.collected - age :
+                    os.remove(p)
+                    removed += 1
+            except OSError :
+                pass
+        return removed
+
+    def forget (self, filename) :
+        """Oublie (et supprime) les graphes d'une RRD (capteur supprimé, ...)"""
+
+        with self.lock :
+            # Les graphes de plusieurs RRD (cf graph_compare) ont le tuple de leurs RRD
+            keys = [k for k in self.entries if k[1] == filename or (isinstance(k[1], tuple) and filename in k[1])]
+            removed = [self.entries.pop(k) for k in keys]
+            self.bytes -= sum(size for res, p, size in removed)
+        for res, p, size in removed :
+            self.remove(p)
+        return None
+
+    def __len__ (self) :
+        return len(self.entries)
+
+# Le cache des graphes du processus
+GRAPHS = GraphCache()
+GRAPH_CACHE_COUNT.set_function(lambda : len(GRAPHS))
+
+def accueil_key(capteur_filename, capteur_name, start, end, width, height, now=None) :
+    return ("accueil", capteur_filename, capteur_name, width, height) + period_key(start, end, now)
+
+def graph_version(key, last) :
+    """Renvoie (ETag, date de modification, date d'expiration) d'un graphe du cache
+    pour le cache HTTP, last est la dernière mise à jour de la RRD. Un graphe qui va
+    jusqu'à maintenant ne change qu'au début de chaque tranche (cf period_key) : sa
+    version ne dépend que de la clé, pas de last qui bouge à chaque seconde reçue.
+    Un graphe passé change avec la RRD (sans date d'expiration, None)"""
+
+    if key[-2] == "live" :
+        b = bucket(key[-3])
+        etag = sha1(repr(key).encode("utf-8")).hexdigest()[:20]
+        return etag, key[-1]*b, (key[-1]+1)*b
+    etag = sha1((repr(key)+":"+str(last)).encode("utf-8")).hexdigest()[:20]
+    return etag, last, None
+
 def graph_accueil(capteur_filename, capteur_name, start='-7d', end='+0h', width=None, height=None):
-    date1=datetime.now().strftime("%y%m%d%H%M%S")
+    """Le graphe d'aperçu d'un capteur (puissance active et courant), via le cache des graphes"""
+
+    key = accueil_key(capteur_filename, capteur_name, start, end, width, height)
+    return GRAPHS.get(key, capteur_name,
+            lambda path : draw_accueil(path, capteur_filename, capteur_name, start, end, width, height))
+
+def graph_detail(capteur_filename, capteur_name, start, end, grandeurs, width=None, height=None):
+    """Le graphe détaillé des grandeurs d'un capteur, via le cache des graphes"""
+
+    key = ("detail", capteur_filename, capteur_name, tuple(g.name for g in grandeurs), width, height) + period_key(start, end)
+    return GRAPHS.get(key, capteur_name,
+            lambda path : draw_detail(path, capteur_filename, capteur_name, start, end, grandeurs, width, height))
+
+def graph_compare(capteurs, grandeur, start, end, width=None, height=None):
+    """Le graphe qui superpose une grandeur de plusieurs capteurs [(filename, name)], via le cache des graphes"""
+
+    key = ("compare", tuple(f for f, n in capteurs), tuple(n for f, n in capteurs), grandeur.name, width, height) + period_key(start, end)
+    return GRAPHS.get(key, "comparaison",
+            lambda path : draw_compare(path, capteurs, grandeur, start, end, width, height))
+
+def couleurs(capteur_filenames) :
+    """Les couleurs des courbes de plusieurs capteurs : un capteur garde la même couleur
+    d'un graphe à l'autre (choisie d'après son filename) sauf si elle est déjà prise
+    dans le graphe, il prend alors la suivante de PALETTE qui est libre"""
+
+    prises = set()
+    res = []
+    for f in capteur_filenames :
+        i = zlib.crc32(f.encode("utf-8")) % len(PALETTE)
+        # Au delà de len(PALETTE) capteurs les couleurs sont forcément réutilisées
+        if len(prises) < len(PALETTE) :
+            while i in prises :
+                i = (i+1) % len(PALETTE)
+        prises.add(i)
+        res.append(PALETTE[i])
+    return res
+
+def legende(name) :
+    """Le nom d'un capteur pour la légende : tronqué à NOM_LEGENDE caractères, aligné,
+    et échappé pour rrdtool (:) et pango (&, <, >)"""
+
+    if len(name) > NOM_LEGENDE :
+        name = name[:NOM_LEGENDE-1]+"…"
+    name = name.ljust(NOM_LEGENDE)
+    return name.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace(":", "\\:")
+
+def taille_legende(height) :
+    """Le nombre de capteurs dont la légende tient dans un graphe de height pixels
+    (la légende prend au plus le tiers de l'image, en-tête et date compris)"""
+
+    return max(1, int(height)//3//LIGNE_LEGENDE - 2)
+
+class GraphPool :
+    """Génère des graphes d'aperçu en parallèle dans GRAPH_WORKERS processus
+    (rrdtool.graphv utilise surtout le CPU, des threads n'iraient pas plus vite)
+
+    Les graphes déjà dans le cache ne sont pas regénérés. Un graphe en échec
+    ou qui prend plus de GRAPH_TIMEOUT s vaut None (la page affiche un message
+    à la place) : il est quand même ajouté au cache s'il finit plus tard.
+    RQ : un processus bloqué ne peut pas être interrompu, il occupe sa place
+    dans le pool jusqu'à la fin de son graphe."""
+
+    def __init__ (self, cache, workers=None, timeout=None, log=print) :
+        self.cache = cache
+        self.workers = workers if workers else GRAPH_WORKERS
+        self.timeout = timeout if timeout else GRAPH_TIMEOUT
+        self.log = log
+        # fork et pas spawn : un nouvel import de kerrucent relancerait toute l'appli
+        self.context = multiprocessing.get_context("fork")
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def submit (self, *args) :
+        """Lance draw_accueil(*args) dans le pool (recréé s'il a été cassé)"""
+
+        with self.lock :
+            if not self.executor :
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=self.context)
+            try :
+                return self.executor.submit(draw_accueil, *args)
+            except BrokenExecutor :
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=self.context)
+                return self.executor.submit(draw_accueil, *args)
+
+    def graphs_accueil (self, probes, start='-7d', end='+0h', width=None, height=None, now=None) :
+        """Les graphes d'aperçu de probes [(filename, name)] (période vue depuis now)
+        Renvoie {filename : résultat de graphv ou None}"""
+
+        results = {}
+        futures = {}
+        for filename, name in probes :
+            key = accueil_key(filename, name, start, end, width, height, now)
+            res = self.cache.lookup(key)
+            if res is not None :
+                results[filename] = res
+                continue
+            path = self.cache.path(key, name)
+            try :
+                f = self.submit(path, filename, name, start, end, width, height)
+            except Exception :
+                self.failed(filename, sys.exc_info()[1])
+                results[filename] = None
+                continue
+            f.add_done_callback(lambda f, key=key, path=path :
+                    self.cache.store(key, f.result(), path) if not f.cancelled() and not f.exception() else None)
+            futures[f] = filename
+
+        # Chaque graphe a GRAPH_TIMEOUT s à partir du moment où un processus le prend,
+        # ou depuis que ceux qui le précèdent dans la file auraient dû finir
+        # RQ : le pool annonce comme pris un graphe de plus que de processus
+        started = {}
+        begin = time.time()
+        deadlines = {f : begin + self.timeout*(i//self.workers + 1) for i, f in enumerate(futures)}
+        pending = set(futures)
+        while pending :
+            done, pending = wait(pending, timeout=0.05, return_when=FIRST_COMPLETED)
+            for f in done :
+                if f.exception() :
+                    self.failed(futures[f], f.exception())
+                results[futures[f]] = None if f.exception() else f.result()
+            now = time.time()
+            for f in list(pending) :
+                if f.running() :
+                    started.setdefault(f, now)
+                if now > max(deadlines[f], started.get(f, 0) + self.timeout) :
+                    f.cancel()
+                    pending.discard(f)
+                    self.failed(futures[f], "trop long (plus de "+str(self.timeout)+" s)")
+                    results[futures[f]] = None
+
+        return results
+
+    def failed (self, filename, error) :
+        GRAPH_FAILURES.inc()
+        self.log("Graphe de "+filename+" indisponible : "+str(error))
+        return None
+
+def draw_accueil(graph_filepath, capteur_filename, capteur_name, start='-7d', end='+0h', width=None, height=None):
     date2=datetime.now().strftime("%d/%m/%Y %Hh%M")
 
-    capteur_filepath = os.path.join(APP_ROOT, RRD_PATH, capteur_filename+".rrd")
-    graph_filepath = os.path.join(APP_ROOT, GRAPH_OUTPUT, date1+"_"+safename(capteur_name)+".png")
+    capteur_filepath = rrd_file(capteur_filename)
 
     if not width :
         width = WIDTH
     if not height :
         height = WIDTH/2
 
+    # La résolution des données et les pics (archives MIN et MAX) pour les longues durées
+    step, peaks = resolution(capteur_filename, start, end, width)
+    hi = "_hi" if peaks else ""
+    lo = "_lo" if peaks else ""
+
     width = str(int(width))
     height = str(int(height))
 
@@ -33,6 +467,8 @@ def graph_accueil(capteur_filename, capteur_name, start='-7d', end='+0h', width=
     params+=[graph_filepath, "--imgformat", "PNG"]
     # Divers paramètres (cf doc)
     params+=["--force-rules-legend", "--pango-markup"]
+    # Via rrdcached si besoin (qui écrit d'abord les données en attente de ce capteur)
+    params+=daemon_args()
     # La taille dde l'image (!= graphe)
     params+=["--full-size-mode", "--height", height, "--width", width]
     # Des infos HTML
@@ -40,24 +476,33 @@ def graph_accueil(capteur_filename, capteur_name, start='-7d', end='+0h', width=
     # Le titre du graphe
     params+=["--title", "<span size='xx-large'>Consommation de "+capteur_name+"</span>"]
     # Les paramètres temporels du graphe
-    params+=["--start", start, "--end", end]
+    params+=["--start", str(start), "--end", str(end)]
+    if step :
+        params+=["--step", str(step)]
     # Les paramètres des axes
     params+=["--vertical-label", "Puissance active (W)",
         "--right-axis", "0.01:0", "--right-axis-label", "Courant (A)"]
     # Les sources de données
     params+=["DEF:courant="+capteur_filepath+":courant:AVERAGE",
             "DEF:puiss_active="+capteur_filepath+":puiss_active:AVERAGE"]
+    if peaks :
+        params+=["DEF:courant_hi="+capteur_filepath+":courant:MAX",
+                "DEF:courant_lo="+capteur_filepath+":courant:MIN",
+                "DEF:puiss_active_hi="+capteur_filepath+":puiss_active:MAX",
+                "DEF:puiss_active_lo="+capteur_filepath+":puiss_active:MIN"]
     # Les données manipulées
     params+=["CDEF:courantx100=courant,100,*"]
+    if peaks :
+        params+=["CDEF:courant_hix100=courant_hi,100,*"]
     # Les fails
     params+=["CDEF:fail=courant,UN,puiss_active,UN,+,1,GE"]
     # Les variables des données
-    params+=["VDEF:courant_max=courant,MAXIMUM",
+    params+=["VDEF:courant_max=courant"+hi+",MAXIMUM",
             "VDEF:courant_avg=courant,AVERAGE",
-            "VDEF:courant_min=courant,MINIMUM",
-            "VDEF:puiss_active_max=puiss_active,MAXIMUM",
+            "VDEF:courant_min=courant"+lo+",MINIMUM",
+            "VDEF:puiss_active_max=puiss_active"+hi+",MAXIMUM",
             "VDEF:puiss_active_avg=puiss_active,AVERAGE",
-            "VDEF:puiss_active_min=puiss_active,MINIMUM"]
+            "VDEF:puiss_active_min=puiss_active"+lo+",MINIMUM"]
     # Affichage des échecs
     params+=["TICK:fail#FFFFa0:1.0"]
     # Légende de la légende
@@ -65,6 +510,10 @@ def graph_accueil(capteur_filename, capteur_name, start='-7d', end='+0h', width=
             "COMMENT:<b>Maximum</b>  ",
             "COMMENT:<b>Moyenne</b>  ",
             "COMMENT:<b>Minimum</b>  \l"]
+    # Affichage des pics
+    if peaks :
+        params+=["AREA:puiss_active_hi#58ACFA60",
+                "LINE1:courant_hix100#FF000060"]
     # Affichage des données et des valeurs
     params+=["AREA:puiss_active#58ACFA:Puissance active",
             "GPRINT:puiss_active_max:%6.2lf %sW",
@@ -78,20 +527,25 @@ def graph_accueil(capteur_filename, capteur_name, start='-7d', end='+0h', width=
     params+=["TEXTALIGN:right",
            "COMMENT:"+date2]
 
-    return rrdtool.graphv(*params)
+    res = rrdtool.graphv(*params)
+    res["step"] = step
+    return res
 
-def graph_detail(capteur_filename, capteur_name, duree, grandeurs, width=None, height=None):
-    date1=datetime.now().strftime("%y%m%d%H%M%S")
+def draw_detail(graph_filepath, capteur_filename, capteur_name, start, end, grandeurs, width=None, height=None):
     date2=datetime.now().strftime("%d/%m/%Y %Hh%M")
 
-    capteur_filepath = os.path.join(APP_ROOT, RRD_PATH, capteur_filename+".rrd")
-    graph_filepath = os.path.join(APP_ROOT, GRAPH_OUTPUT, date1+"_detail_"+safename(capteur_name)+".png")
+    capteur_filepath = rrd_file(capteur_filename)
 
     if not width :
         width = WIDTH
     if not height :
         height = WIDTH/2
 
+    # La résolution des données et les pics (archives MIN et MAX) pour les longues durées
+    step, peaks = resolution(capteur_filename, start, end, width)
+    hi = "_hi" if peaks else ""
+    lo = "_lo" if peaks else ""
+
     width = str(int(width))
     height = str(int(height))
 
@@ -100,6 +554,8 @@ def graph_detail(capteur_filename, capteur_name, duree, grandeurs, width=None, h
     params+=[graph_filepath, "--imgformat", "PNG"]
     # Divers paramètres (cf doc)
     params+=["--force-rules-legend", "--pango-markup"]
+    # Via rrdcached si besoin (qui écrit d'abord les données en attente de ce capteur)
+    params+=daemon_args()
     # La taille dde l'image (!= graphe)
     params+=["--full-size-mode", "--height", height, "--width", width]
     # Des infos HTML
@@ -107,14 +563,9 @@ def graph_detail(capteur_filename, capteur_name, duree, grandeurs, width=None, h
     # Le titre du graphe
     params+=["--title", "<span size='xx-large'>Consommation de "+capteur_name+"</span>"]
     # Les paramètres temporels du graphe
-    if duree == Duree.h1 :
-        params+=["--start", "-1h"]
-    elif duree == Duree.j1 :
-        params+=["--start", "-1d"]
-    elif duree == Duree.m1 :
-        params+=["--start", "-1mon"]
-    elif duree == Duree.a1 :
-        params+=["--start", "-1y"]
+    params+=["--start", str(start), "--end", str(end)]
+    if step :
+        params+=["--step", str(step)]
     # Les paramètres des axes
     y_axis_param=""
     size = 0
@@ -170,6 +621,12 @@ def graph_detail(capteur_filename, capteur_name, duree, grandeurs, width=None, h
         if size == 1 :
             params+=["DEF:pred="+capteur_filepath+":puiss_apparente:HWPREDICT",
                     "DEF:dev="+capteur_filepath+":puiss_apparente:DEVPREDICT"]
+    if peaks :
+        for g in grandeurs :
+            v, scale, colour = COURBES[g]
+            params+=["DEF:"+v+"_hi="+capteur_filepath+":"+g.name+":MAX",
+                    "DEF:"+v+"_lo="+capteur_filepath+":"+g.name+":MIN",
+                    "CDEF:"+v+"_hix="+v+"_hi,"+str(scale)+",*"]
     # Les données manipulées
     if Grandeur.courant in grandeurs :
         params+=["CDEF:courantx100=courant,100,*"]
@@ -207,29 +664,29 @@ def graph_detail(capteur_filename, capteur_name, duree, grandeurs, width=None, h
         params+=["CDEF:fail="+fail_param]
     # Les variables des données
     if Grandeur.courant in grandeurs :
-        params+=["VDEF:courant_max=courant,MAXIMUM",
+        params+=["VDEF:courant_max=courant"+hi+",MAXIMUM",
                "VDEF:courant_avg=courant,AVERAGE",
-                "VDEF:courant_min=courant,MINIMUM"]
+                "VDEF:courant_min=courant"+lo+",MINIMUM"]
     if Grandeur.tension in grandeurs :
-        params+=["VDEF:tension_max=tension,MAXIMUM",
+        params+=["VDEF:tension_max=tension"+hi+",MAXIMUM",
                 "VDEF:tension_avg=tension,AVERAGE",
-                "VDEF:tension_min=tension,MINIMUM"]
+                "VDEF:tension_min=tension"+lo+",MINIMUM"]
     if Grandeur.dephasage in grandeurs :
-        params+=["VDEF:dephasage_max=dephasage,MAXIMUM",
+        params+=["VDEF:dephasage_max=dephasage"+hi+",MAXIMUM",
                "VDEF:dephasage_avg=dephasage,AVERAGE",
-                "VDEF:dephasage_min=dephasage,MINIMUM"]
+                "VDEF:dephasage_min=dephasage"+lo+",MINIMUM"]
     if Grandeur.puiss_active in grandeurs :
-        params+=["VDEF:active_max=active,MAXIMUM",
+        params+=["VDEF:active_max=active"+hi+",MAXIMUM",
                 "VDEF:active_avg=active,AVERAGE",
-                "VDEF:active_min=active,MINIMUM"]
+                "VDEF:active_min=active"+lo+",MINIMUM"]
     if Grandeur.puiss_reactive in grandeurs :
-        params+=["VDEF:reactive_max=reactive,MAXIMUM",
+        params+=["VDEF:reactive_max=reactive"+hi+",MAXIMUM",
                "VDEF:reactive_avg=reactive,AVERAGE",
-                "VDEF:reactive_min=reactive,MINIMUM"]
+                "VDEF:reactive_min=reactive"+lo+",MINIMUM"]
     if Grandeur.puiss_apparente in grandeurs :
-        params+=["VDEF:apparente_max=apparente,MAXIMUM",
+        params+=["VDEF:apparente_max=apparente"+hi+",MAXIMUM",
                 "VDEF:apparente_avg=apparente,AVERAGE",
-                "VDEF:apparente_min=apparente,MINIMUM"]
+                "VDEF:apparente_min=apparente"+lo+",MINIMUM"]
     # Affichage des échecs
     params+=["TICK:fail#FFFFa0:1.0"]
     # Légende de la légende
@@ -237,6 +694,11 @@ def graph_detail(capteur_filename, capteur_name, duree, grandeurs, width=None, h
             "COMMENT:<b>Maximum</b>    ",
             "COMMENT:<b>Moyenne</b>    ",
             "COMMENT:<b>Minimum</b>    \\l"]
+    # Affichage des pics
+    if peaks :
+        for g in grandeurs :
+            v, scale, colour = COURBES[g]
+            params+=["LINE1:"+v+"_hix#"+colour+"60"]
     # Affichage des données et des valeurs
     if Grandeur.courant in grandeurs :
         params+=["LINE1:courantx100#FF0000:Courant            ",
@@ -276,7 +738,96 @@ def graph_detail(capteur_filename, capteur_name, duree, grandeurs, width=None, h
     params+=["TEXTALIGN:right",
            "COMMENT:"+date2 ]
 
-    return rrdtool.graphv(*params)
+    res = rrdtool.graphv(*params)
+    res["step"] = step
+    return res
+
+def draw_compare(graph_filepath, capteurs, grandeur, start, end, width=None, height=None):
+    """Superpose une grandeur de plusieurs capteurs [(filename, name)] en un seul appel à rrdtool.graphv
+    Toutes les courbes sont lues à la même résolution (la plus grossière des choix de
+    resolution) pour être alignées. Seuls les taille_legende(height) premiers capteurs
+    ont leur ligne de légende, les autres sont tracés et comptés à la fin de la légende"""
+
+    date2=datetime.now().strftime("%d/%m/%Y %Hh%M")
+
+    if not width :
+        width = WIDTH
+    if not height :
+        height = WIDTH/2
+
+    # Une seule résolution pour tous les capteurs
+    choices = [resolution(f, start, end, width) for f, n in capteurs]
+    steps = [st for st, pk in choices if st]
+    step = max(steps) if steps else None
+    # Les pics de chaque capteur à cette résolution (cf draw_detail)
+    peaks = [pk if st == step else bool(step) and peaks_at(f, step)
+            for (st, pk), (f, n) in zip(choices, capteurs)]
+
+    nom, unite = LEGENDES[grandeur]
+    # Pas de préfixe (k, M, ...) pour les degrés
+    unite = " "+unite if grandeur == Grandeur.dephasage else " %s"+unite
+    colours = couleurs([f for f, n in capteurs])
+    shown = taille_legende(height)
+
+    width = str(int(width))
+    height = str(int(height))
+
+    params=[]
+    # Le nom de l'image
+    params+=[graph_filepath, "--imgformat", "PNG"]
+    # Divers paramètres (cf doc)
+    params+=["--force-rules-legend", "--pango-markup"]
+    # Via rrdcached si besoin (qui écrit d'abord les données en attente de ces capteurs)
+    params+=daemon_args()
+    # La taille dde l'image (!= graphe)
+    params+=["--full-size-mode", "--height", height, "--width", width]
+    # Des infos HTML
+    params+=["--imginfo", "<img src=\"/"+GRAPH_OUTPUT+"%s\" width=%lu height=%lu alt=\"Comparaison de "+str(len(capteurs))+" capteurs\" />"]
+    # Le titre du graphe
+    params+=["--title", "<span size='xx-large'>Comparaison : "+nom.lower()+"</span>"]
+    # Les paramètres temporels du graphe
+    params+=["--start", str(start), "--end", str(end)]
+    if step :
+        params+=["--step", str(step)]
+    # Les paramètres des axes
+    params+=["--vertical-label", nom+" ("+LEGENDES[grandeur][1]+")"]
+    # Les sources de données et les variables (seulement pour la légende)
+    for i, (f, n) in enumerate(capteurs) :
+        v = "v"+str(i)
+        hi = "_hi" if peaks[i] else ""
+        lo = "_lo" if peaks[i] else ""
+        params+=["DEF:"+v+"="+rrd_file(f)+":"+grandeur.name+":AVERAGE"]
+        if i < shown :
+            if peaks[i] :
+                params+=["DEF:"+v+"_hi="+rrd_file(f)+":"+grandeur.name+":MAX",
+                        "DEF:"+v+"_lo="+rrd_file(f)+":"+grandeur.name+":MIN"]
+            params+=["VDEF:"+v+"_max="+v+hi+",MAXIMUM",
+                    "VDEF:"+v+"_avg="+v+",AVERAGE",
+                    "VDEF:"+v+"_min="+v+lo+",MINIMUM"]
+    # Légende de la légende
+    params+=["COMMENT:"+" "*(NOM_LEGENDE+4),
+            "COMMENT:<b>Maximum</b>    ",
+            "COMMENT:<b>Moyenne</b>    ",
+            "COMMENT:<b>Minimum</b>    \\l"]
+    # Affichage des données et des valeurs
+    for i, (f, n) in enumerate(capteurs) :
+        v = "v"+str(i)
+        if i < shown :
+            params+=["LINE1:"+v+"#"+colours[i]+":"+legende(n),
+                    "GPRINT:"+v+"_max:%6.2lf"+unite+"  ",
+                    "GPRINT:"+v+"_avg:%6.2lf"+unite+"  ",
+                    "GPRINT:"+v+"_min:%6.2lf"+unite+"  \\l"]
+        else :
+            params+=["LINE1:"+v+"#"+colours[i]]
+    if len(capteurs) > shown :
+        params+=["COMMENT:et "+str(len(capteurs) - shown)+" autres capteurs (sans légende)\\l"]
+    # Affichage de la date
+    params+=["TEXTALIGN:right",
+           "COMMENT:"+date2 ]
+
+    res = rrdtool.graphv(*params)
+    res["step"] = step
+    return res
 
 if __name__=="__main__":
-    print( graph_detail("test", "Frigo",Duree.j1,[Grandeur.tension])["image_info"] )
+    print( graph_detail("test", "Frigo", "-1d", "+0h", [Grandeur.tension])["image_info"] )
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import rrdtool
+from .constant import *
+from .graph import safename
+from .rrd import rrd_file, rrd_params, last_rrd, catch_up_rrd, STORAGE_PROFILES
+from .fetch import iter_fetch
+from .importer import format_updates
+
+# Les grandeurs additionnées sur les capteurs d'un groupe (cf combine pour les autres)
+GROUP_SUMS = ['courant', 'puiss_active', 'puiss_reactive', 'puiss_apparente']
+# Les bornes hautes des grandeurs d'un groupe : pas de borne pour les sommes
+GROUP_MAXIMA = ['U' if n in GROUP_SUMS else MAXIMA[i] for i, n in enumerate(DS_NAMES)]
+
+TENSION = DS_NAMES.index('tension')
+DEPHASAGE = DS_NAMES.index('dephasage')
+ACTIVE = DS_NAMES.index('puiss_active')
+REACTIVE = DS_NAMES.index('puiss_reactive')
+
+def group_filename(name) :
+    """Renvoie un nom de fichier (sans .rrd) libre pour le groupe name"""
+
+    filename = GROUP_PREFIX + safename(name)
+    final_filename = filename
+    i = 0
+    while os.path.isfile(rrd_file(final_filename)) :
+        i+=1
+        final_filename = filename + str(i).zfill(2)
+    return final_filename
+
+
+
+def group_params(path, profile=None, start=None) :
+    """Renvoie les paramètres de rrdtool.create de la RRD d'un groupe
+    Mêmes grandeurs que les capteurs (graphes, export et API la lisent pareil)
+    mais sans borne pour les sommes et sans prédiction"""
+
+    return rrd_params(path, profile, start, maxima=GROUP_MAXIMA, predict=False)
+
+
+
+def create_group_rrd(name, start=None, profile=None) :
+    """Crée la RRD d'un groupe de capteurs"""
+
+    if not start :
+        start = int(time.time())
+
+    return rrdtool.create(*group_params(rrd_file(name), profile, start))
+
+
+
+def accumulate(sums, counts, values) :
+    """Ajoute les valeurs d'un capteur (NaN pour inconnue) aux sommes et nombres de valeurs d'un groupe"""
+
+    known = ~np.isnan(values)
+    sums += np.where(known, values, 0)
+    counts += known
+    return None
+
+
+
+def combine(sums, counts) :
+    """Calcule les valeurs d'un groupe à partir des sommes et nombres de valeurs de ses capteurs :
+    courant et puissances additionnés, tension moyenne et déphasage de la somme des puissances
+    (NaN quand aucun capteur n'a de valeur)"""
+
+    res = np.where(counts > 0, sums, np.nan)
+    res[..., TENSION] = np.divide(sums[..., TENSION], counts[..., TENSION],
+            out=np.full(sums[..., TENSION].shape, np.nan), where=counts[..., TENSION] > 0)
+    res[..., DEPHASAGE] = np.degrees(np.arctan2(res[..., REACTIVE], res[..., ACTIVE])) % 360
+    return res
+
+
+
+class GroupAggregator :
+    """Tient à jour les RRD des groupes de capteurs à partir des secondes des capteurs
+    (celles émises par l'Aggregator)
+
+    Une seconde d'un groupe est calculée (cf combine) une fois que ses capteurs ont
+    envoyé GROUP_DELAY secondes plus récentes, ou que plus rien n'arrive depuis
+    GROUP_DELAY secondes. Chaque capteur y compte pour sa dernière valeur
+    d'au plus GROUP_HOLD secondes (un capteur en retard ou qui envoie moins
+    souvent ne fait pas chuter la somme). emit(filename du groupe, valeurs,
+    seconde) est appelé une fois par seconde calculée.
+
+    probes est le registre des capteurs (cf ProbeRegistry.groups et members)"""
+
+    def __init__ (self, probes, emit, delay=None, hold=None) :
+        self.probes = probes
+        self.emit = emit
+        self.delay = delay if delay is not None else GROUP_DELAY
+        self.hold = hold if hold is not None else GROUP_HOLD
+        # Les dernières secondes de chaque capteur {filename : deque([(seconde, valeurs), ...])}
+        self.recent = {}
+        # Pour chaque groupe [prochaine seconde à calculer, seconde la plus récente reçue,
+        # date de réception de cette seconde] {filename : [...]}
+        self.state = {}
+
+    def add (self, name, values, t) :
+        """Prend en compte la seconde t du capteur name"""
+
+        groups = getattr(self.probes, 'groups', {}).get(name)
+        if not groups :
+            return None
+
+        recent = self.recent.setdefault(name, deque())
+        recent.append((t, np.array([np.nan if v == 'U' else float(v) for v in values])))
+        # On garde toujours la dernière valeur connue
+        while len(recent) > 1 and recent[0][0] <= t - self.hold - self.delay :
+            recent.popleft()
+
+        now = time.time()
+        for group in groups :
+            state = self.state.get(group)
+            if state is None :
+                state = self.state[group] = [t, t, now]
+            if t >= state[1] :
+                state[1] = t
+                state[2] = now
+            self.seal(group, state[1] - self.delay)
+        return None
+
+    def value (self, name, s) :
+        """La dernière valeur du capteur name pour la seconde s (None si trop vieille)"""
+
+        for t, values in reversed(self.recent.get(name, ())) :
+            if t <= s :
+                return values if t > s - self.hold else None
+        return None
+
+    def seal (self, group, until) :
+        """Calcule et émet les secondes d'un groupe jusqu'à until (comprise)
+        RQ : jamais au delà de maintenant, et au plus GROUP_SEAL_MAX secondes d'un coup
+        (les dates viennent des capteurs, un capteur revenu après des jours ne doit
+        pas bloquer l'écoute)"""
+
+        state = self.state[group]
+        members = getattr(self.probes, 'members', {}).get(group, [])
+        recent = [self.recent[m] for m in members if self.recent.get(m)]
+        if not recent :
+            return None
+        # Rien avant la plus vieille valeur connue
+        state[0] = max(state[0], min(r[0][0] for r in recent))
+        until = min(until, int(time.time()), state[0] + GROUP_SEAL_MAX - 1)
+
+        while state[0] <= until :
+            s = state[0]
+            state[0] += 1
+            sums = np.zeros(len(DS_NAMES))
+            counts = np.zeros(len(DS_NAMES), dtype=np.int64)
+            for m in members :
+                values = self.value(m, s)
+                if values is not None :
+                    accumulate(sums, counts, values)
+            if counts.any() :
+                self.emit(group, ['U' if v != v else float(v) for v in combine(sums, counts)], s)
+            else :
+                # Aucun capteur n'a de valeur avant sa prochaine seconde reçue
+                later = [t for r in recent for t, values in r if t > s]
+                state[0] = min(later) if later else until + 1
+        return None
+
+    def seal_due (self, now=None) :
+        """Calcule les secondes des groupes dont les capteurs n'envoient plus rien depuis GROUP_DELAY s"""
+
+        if not now :
+            now = time.time()
+
+        members = getattr(self.probes, 'members', {})
+        for group in list(self.state.keys()) :
+            # Groupe supprimé entre temps
+            if not group in members :
+                del self.state[group]
+                continue
+            if now - self.state[group][2] >= self.delay :
+                self.seal(group, self.state[group][1])
+        return None
+
+    def seal_all (self) :
+        """Calcule toutes les secondes en attente (avant un arrêt)"""
+
+        for group, state in list(self.state.items()) :
+            self.seal(group, state[1])
+        return None
+
+    def forget (self, name) :
+        """Oublie les dernières secondes d'un capteur et l'état d'un groupe (supprimés)"""
+
+        self.recent.pop(name, None)
+        self.state.pop(name, None)
+        return None
+
+
+
+##########################
+## Recalcul d'un groupe ##
+##########################
+
+def regrid(series, start, step, rows) :
+    """Ramène une Series sur la grille de rows lignes de step secondes qui suit start
+    (moyenne des lignes plus fines, répétition des lignes plus grossières)"""
+
+    grid = start + step*np.arange(1, rows+1, dtype=np.int64)
+    out = np.full((rows, len(DS_NAMES)), np.nan)
+    if not len(series) :
+        return out
+
+    times = series.times
+    if series.step >= step :
+        # La ligne qui couvre chaque date de la grille
+        idx = np.minimum(np.searchsorted(times, grid), len(times) - 1)
+        ok = (times[idx] >= grid) & (times[idx] - series.step < grid)
+        out[ok] = series.values[idx[ok]]
+        return out
+
+    # La ligne de la grille qui contient chaque ligne de la série
+    cells = (times - start - 1)//step
+    ok = (cells >= 0) & (cells < rows)
+    sums = np.zeros(out.shape)
+    counts = np.zeros(out.shape, dtype=np.int64)
+    known = ~np.isnan(series.values[ok])
+    np.add.at(sums, cells[ok], np.where(known, series.values[ok], 0))
+    np.add.at(counts, cells[ok], known)
+    np.divide(sums, counts, out=out, where=counts > 0)
+    return out
+
+
+
+def read_member(filename, start, step, rows) :
+    """Lit (dans un processus du pool) les rows lignes de step secondes d'un capteur
+    qui suivent start, ramenées sur la grille du groupe (cf regrid)"""
+
+    out = np.full((rows, len(DS_NAMES)), np.nan)
+    for series in iter_fetch(filename, 'AVERAGE', start, start + step*rows, step) :
+        part = regrid(series, start, step, rows)
+        out = np.where(np.isnan(out), part, out)
+    return out
+
+
+
+def rebuild_group(filename, members, profile=None, start=None, end=None, workers=None, log=print) :
+    """Recalcule la RRD d'un groupe à partir de l'historique de ses capteurs (filenames)
+
+    La période est lue par morceaux de FETCH_CHUNK lignes, les capteurs de chaque
+    morceau étant lus en parallèle par workers processus. La nouvelle RRD est
+    écrite à côté de l'ancienne puis mise à sa place une fois les secondes
+    reçues entre temps recopiées (cf catch_up_rrd) : l'écoute continue pendant
+    le recalcul. Par défaut, la période est celle de l'archive la plus fine du profil.
+    La nouvelle RRD part de l'ancienne (create --source, rrdtool >= 1.5) : ses
+    lignes antérieures à la période, consolidées comprises, sont gardées.
+    Renvoie le nombre de lignes écrites"""
+
+    p = STORAGE_PROFILES[profile if profile else DEFAULT_STORAGE_PROFILE]
+    step = p['step']
+    path = rrd_file(filename)
+
+    # On s'arrête à la dernière mise à jour de la RRD actuelle, la suite est recopiée
+    if not end :
+        end = int(time.time())
+        if os.path.isfile(path) :
+            end = min(end, last_rrd(filename))
+    if not start :
+        start = end - p['rras'][0][0]*p['rras'][0][1]
+    start = (start//step)*step
+    end = (end//step)*step
+    if end <= start :
+        return 0
+
+    tmp = path+'.rebuild'
+    written = 0
+    # fork et pas spawn : un nouvel import de kerrucent relancerait toute l'appli
+    executor = ProcessPoolExecutor(workers if workers else REBUILD_WORKERS, mp_context=multiprocessing.get_context('fork'))
+    try :
+        params = group_params(tmp, profile, start - 1)
+        if os.path.isfile(path) :
+            params += ['--source', path]
+        rrdtool.create(*params)
+
+        for first in range(start, end, FETCH_CHUNK*step) :
+            rows = min(FETCH_CHUNK, (end - first)//step)
+            sums = np.zeros((rows, len(DS_NAMES)))
+            counts = np.zeros((rows, len(DS_NAMES)), dtype=np.int64)
+            futures = [(m, executor.submit(read_member, m, first, step, rows)) for m in members]
+            for m, future in futures :
+                try :
+                    accumulate(sums, counts, future.result())
+                except Exception as e :
+                    log('Lecture de '+m+'.rrd impossible : '+str(e))
+
+            # On n'écrit que les lignes où au moins un capteur a une valeur
+            values = combine(sums, counts)
+            t = first + step*np.arange(1, rows+1, dtype=np.int64)
+            keep = counts.any(axis=1)
+            t, values = t[keep], values[keep]
+            for i in range(0, len(t), IMPORT_BATCH) :
+                rrdtool.update(tmp, *format_updates(t[i:i+IMPORT_BATCH], values[i:i+IMPORT_BATCH]))
+            written += len(t)
+
+        if os.path.isfile(path) :
+            catch_up_rrd(filename, tmp)
+        else :
+            os.replace(tmp, path)
+    finally :
+        executor.shutdown()
+        if os.path.exists(tmp) :
+            os.remove(tmp)
+
+    return written
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import itertools
+import os
+import time
+import warnings
+import numpy as np
+from .constant import *
+from .data import WIRE_SAMPLE
+from .registry import normalize_mac
+from .rrd import rrd_file, daemon_args, last_rrd, timed_update, catch_up_rrd, backfill_limit
+
+_MINIMA = np.array(MINIMA, dtype=np.float64)
+_MAXIMA = np.array(MAXIMA, dtype=np.float64)
+
+def read_csv(f, chunk, mac=None) :
+    """Lit un fichier CSV d'échantillons par morceaux de chunk lignes
+    Colonnes : mac, timestamp, les 6 valeurs (sans la colonne mac si mac est donnée)
+    Une ligne d'en-tête est ignorée, les valeurs vides ou 'U' sont inconnues
+    Génère des (macs, timestamps, valeurs, lignes illisibles)"""
+
+    first = 0 if mac else 1
+    reader = csv.reader(f)
+    rows = list(itertools.islice(reader, chunk))
+
+    # L'en-tête éventuel (timestamp illisible sur la 1ère ligne)
+    if rows :
+        try :
+            float(rows[0][first])
+        except (ValueError, IndexError) :
+            rows = rows[1:]
+
+    while rows :
+        yield parse_rows(rows, first, mac)
+        rows = list(itertools.islice(reader, chunk))
+
+
+
+def parse_rows(rows, first, mac=None) :
+    """Convertit des lignes CSV en tableaux NumPy (cf read_csv)"""
+
+    width = first + 1 + len(DS_NAMES)
+    good = [r for r in rows if len(r) == width]
+    invalid = len(rows) - len(good)
+
+    numbers, ok = to_numbers(good, first)
+    invalid += int((~ok).sum())
+
+    macs = np.full(len(good), mac) if mac else np.array([r[0] for r in good], dtype=str)
+    return macs[ok], numbers[ok, 0], numbers[ok, 1:], invalid
+
+
+
+def to_numbers(rows, first) :
+    """Convertit les champs (à partir de first) de lignes CSV en tableau float64
+    Renvoie (nombres, lignes lisibles) : le texte est converti d'un coup par NumPy,
+    en cas d'erreur on coupe en deux pour isoler les lignes illisibles"""
+
+    width = len(rows[0]) - first if rows else 0
+    flat = [x if x and x != 'U' else 'nan' for r in rows for x in r[first:]]
+    try :
+        # fromstring s'arrête (avec un avertissement) au premier champ illisible
+        with warnings.catch_warnings() :
+            warnings.simplefilter('error')
+            numbers = np.fromstring(','.join(flat), sep=',') if flat else np.empty(0)
+        if len(numbers) != len(flat) :
+            raise ValueError
+        return numbers.reshape(len(rows), width), np.ones(len(rows), dtype=bool)
+    except (ValueError, DeprecationWarning) :
+        if len(rows) == 1 :
+            return np.full((1, width), np.nan), np.zeros(1, dtype=bool)
+        half = len(rows)//2
+        a, ok_a = to_numbers(rows[:half], first)
+        b, ok_b = to_numbers(rows[half:], first)
+        return np.concatenate([a, b]), np.concatenate([ok_a, ok_b])
+
+
+
+def format_updates(t, values) :
+    """Renvoie les paramètres de rrdtool.update : <timestamp>:<v1>:...:<v6> (U pour inconnu)
+    RQ : un seul formatage pour toutes les lignes, bien plus rapide que ligne par ligne"""
+
+    fmt = '%d' + ':%.6g'*values.shape[1]
+    flat = np.column_stack([t, values]).ravel().tolist()
+    return ('\n'.join([fmt]*len(t)) % tuple(flat)).replace('nan', 'U').split('\n')
+
+
+
+def read_binary(f, chunk) :
+    """Lit un fichier binaire d'échantillons par morceaux de chunk échantillons
+    Le fichier est une suite d'échantillons au format des paquets (WIRE_SAMPLE, sans en-tête)
+    Génère des (macs, timestamps, valeurs, échantillons illisibles)"""
+
+    while True :
+        arr = np.fromfile(f, dtype=WIRE_SAMPLE, count=chunk)
+        if not len(arr) :
+            break
+        # RQ : numpy retire les \x00 de fin des champs 'S', on complète
+        raw, inverse = np.unique(arr['mac'], return_inverse=True)
+        names = np.array([':'.join('%02X' % b for b in m.ljust(6, b'\x00')) for m in raw.tolist()], dtype=str)
+        yield names[inverse], arr['t'].astype(np.float64), arr['v'].astype(np.float64), 0
+
+
+
+class Importer :
+    """Écrit dans les RRD des échantillons datés de plusieurs capteurs (historique, migration)
+
+    probes est le dictionnaire {mac : filename} des capteurs connus.
+    Chaque morceau lu est vérifié (valeurs hors de [MINIMA, MAXIMA] inconnues),
+    trié par capteur et par date puis écrit par appels à rrdtool.update de
+    IMPORT_BATCH échantillons. rrdtool n'accepte que des dates postérieures
+    à la dernière mise à jour de la RRD : le fichier doit être trié par date
+    (au moins à l'échelle d'un morceau), les échantillons plus vieux sont ignorés.
+
+    Pour reprendre un historique antérieur à la RRD d'un capteur, create(filename,
+    chemin, start) crée une RRD vide équivalente : la RRD est alors reconstruite à
+    côté de l'actuelle à partir du premier échantillon lu, puis mise à sa place à la
+    fin de l'import une fois toutes les données de l'actuelle recopiées (cf catch_up_rrd).
+    Les données de la RRD actuelle priment : les échantillons importés qui tombent
+    après sa première donnée sont ignorés. Pour ne rien perdre, la reconstruction est
+    refusée (stats['refused']) si la RRD a des données avant le premier échantillon
+    ou plus d'historique que son archive la plus fine (cf backfill_limit).
+    Sans create, ou si elle est refusée, cet historique est ignoré."""
+
+    def __init__ (self, probes, batch=None, progress=None, create=None) :
+        self.probes = {normalize_mac(mac) : filename for mac, filename in probes.items()}
+        self.batch = batch if batch else IMPORT_BATCH
+        self.progress = progress
+        self.create = create
+        # La dernière date écrite dans chaque RRD {filename : timestamp}
+        self.last = {}
+        # Les RRD en cours de reconstruction {filename : [chemin de la nouvelle RRD,
+        # échantillons écrits, première seconde couverte par la RRD actuelle (ou None)]}
+        self.rebuilt = {}
+        self.stats = {'read' : 0, 'written' : 0, 'invalid' : 0, 'unknown' : 0, 'rejected' : 0, 'skipped' : 0,
+                'errors' : 0, 'rebuilt' : 0, 'refused' : 0}
+        self.start = None
+
+    def add (self, macs, t, values, invalid=0) :
+        """Vérifie, trie et écrit un morceau d'échantillons"""
+
+        self.stats['read'] += len(t) + invalid
+        self.stats['invalid'] += invalid
+
+        # Les valeurs hors plage deviennent inconnues (NaN est toujours hors plage)
+        rejected = ~((values >= _MINIMA) & (values <= _MAXIMA))
+        self.stats['rejected'] += int((rejected & ~np.isnan(values)).sum())
+        values = np.where(rejected, np.nan, values)
+
+        # Les dates illisibles ou nulles sont ignorées
+        ok = np.isfinite(t) & (t > 0)
+        self.stats['invalid'] += int((~ok).sum())
+        macs, t, values = macs[ok], t[ok].astype(np.int64), values[ok]
+
+        # On traite les capteurs un par un
+        unique, inverse = np.unique(macs, return_inverse=True)
+        for k, mac in enumerate(unique.tolist()) :
+            filename = self.probes.get(normalize_mac(mac))
+            selected = np.nonzero(inverse == k)[0]
+            if not filename :
+                self.stats['unknown'] += len(selected)
+                continue
+            self.write(filename, t[selected], values[selected])
+
+        if self.progress :
+            self.progress(self.stats, time.time() - self.start)
+        return None
+
+    def write (self, filename, t, values) :
+        """Écrit les échantillons d'une RRD (dans le désordre, doublons possibles)"""
+
+        if not filename in self.last :
+            try :
+                self.last[filename] = last_rrd(filename)
+            except Exception :
+                self.stats['errors'] += len(t)
+                return None
+            # Historique antérieur à la RRD : on la reconstruit
+            if self.create and len(t) and int(t.min()) <= self.last[filename] :
+                try :
+                    self.backfill(filename, int(t.min()))
+                except ValueError :
+                    self.stats['refused'] += 1
+                except Exception :
+                    self.stats['errors'] += len(t)
+                    return None
+
+        # Tri par date, une seule valeur par seconde et seulement après la dernière mise à jour
+        order = np.argsort(t, kind='stable')
+        t, values = t[order], values[order]
+        keep = np.ones(len(t), dtype=bool)
+        keep[1:] = t[1:] != t[:-1]
+        keep &= t > self.last[filename]
+        # Les données de la RRD actuelle priment sur celles importées
+        rebuilt = self.rebuilt.get(filename)
+        if rebuilt and rebuilt[2] is not None :
+            keep &= t < rebuilt[2]
+        self.stats['skipped'] += int((~keep).sum())
+        t, values = t[keep], values[keep]
+        if not len(t) :
+            return None
+
+        # La RRD en reconstruction n'est pas connue de rrdcached
+        target = [rebuilt[0]] if rebuilt else daemon_args() + [rrd_file(filename)]
+        for i in range(0, len(t), self.batch) :
+            block = format_updates(t[i:i+self.batch], values[i:i+self.batch])
+            try :
+                timed_update(filename, target + block, len(block))
+            except Exception :
+                self.stats['errors'] += len(block)
+            else :
+                self.stats['written'] += len(block)
+                if rebuilt :
+                    rebuilt[1] += len(block)
+
+        self.last[filename] = int(t[-1])
+        return None
+
+    def backfill (self, filename, first) :
+        """Commence la reconstruction de la RRD de filename à partir de la date first
+        (ValueError si elle perdrait des données, cf backfill_limit)"""
+
+        limit = backfill_limit(filename, first)
+        tmp = rrd_file(filename)+'.import'
+        if os.path.exists(tmp) :
+            os.remove(tmp)
+        self.create(filename, tmp, first - 1)
+        self.rebuilt[filename] = [tmp, 0, limit]
+        self.last[filename] = first - 1
+        return None
+
+    def finish (self) :
+        """Met les RRD reconstruites à la place des actuelles"""
+
+        for filename, (tmp, written, limit) in self.rebuilt.items() :
+            try :
+                catch_up_rrd(filename, tmp)
+            except Exception :
+                self.stats['written'] -= written
+                self.stats['errors'] += written
+            else :
+                self.stats['rebuilt'] += 1
+            finally :
+                if os.path.exists(tmp) :
+                    os.remove(tmp)
+        self.rebuilt = {}
+        return None
+
+    def discard (self) :
+        """Abandonne les reconstructions en cours (import interrompu)"""
+
+        for tmp, written, limit in self.rebuilt.values() :
+            if os.path.exists(tmp) :
+                os.remove(tmp)
+        self.rebuilt = {}
+        return None
+
+    def run (self, path, format='csv', mac=None) :
+        """Importe un fichier (format 'csv' ou 'binary') et renvoie les statistiques"""
+
+        self.start = time.time()
+        try :
+            if format == 'binary' :
+                with open(path, 'rb') as f :
+                    for chunk in read_binary(f, IMPORT_CHUNK) :
+                        self.add(*chunk)
+            else :
+                with open(path, newline='') as f :
+                    for chunk in read_csv(f, IMPORT_CHUNK, mac) :
+                        self.add(*chunk)
+        except BaseException :
+            self.discard()
+            raise
+
+        self.finish()
+        return self.stats
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import itertools
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, BrokenExecutor
+from .constant import *
+from .graph import safename
+from .registry import normalize_mac
+from .rrd import rrd_file, create_rrd, del_rrd
+
+class Job :
+    """La création en tâche de fond de la RRD d'un nouveau capteur
+
+    status vaut 'pending' (en attente d'un processus), 'running', 'done'
+    (RRD créée et capteur ajouté à la BDD) ou 'error' (cf error).
+    batch regroupe les créations d'un même ajout en masse."""
+
+    def __init__ (self, id, name, filename, mac, alpha, beta, period, profile, batch=None) :
+        self.id = id
+        self.name = name
+        self.filename = filename
+        self.mac = mac
+        self.alpha = alpha
+        self.beta = beta
+        self.period = period
+        self.profile = profile
+        self.batch = batch
+        self.status = 'pending'
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+        self.future = None
+        # Levé une fois le capteur ajouté à la BDD (ou en échec)
+        self.done = threading.Event()
+
+    def state (self) :
+        """Le statut, 'running' dès qu'un processus a pris la création"""
+
+        if self.status == 'pending' and self.future and self.future.running() :
+            return 'running'
+        return self.status
+
+    def as_dict (self) :
+        return {
+            'id' : self.id,
+            'name' : self.name,
+            'filename' : self.filename,
+            'mac' : self.mac,
+            'profile' : self.profile,
+            'batch' : self.batch,
+            'status' : self.state(),
+            'error' : self.error,
+            'duration' : (self.finished if self.finished else time.time()) - self.submitted,
+        }
+
+
+
+class ProvisionQueue :
+    """La file des créations de RRD des nouveaux capteurs
+
+    La création d'une RRD (préallouée, cf STORAGE_PROFILES) peut être longue :
+    elle est faite par un des PROVISION_WORKERS processus, puis register(job)
+    ajoute le capteur à la BDD (dans un thread du processus courant).
+    Les noms de fichier sont réservés dès l'ajout à la file pour que deux
+    capteurs de même nom n'obtiennent pas le même fichier.
+
+    Les processus sont créés par fork : start() doit être appelé avant que le
+    processus courant ait lancé le moindre thread (cf kerrucent.py). Si le pool
+    est cassé (processus tué), les RRD sont ensuite créées dans des threads :
+    un fork depuis un processus qui a des threads peut bloquer le processus créé."""
+
+    def __init__ (self, register, workers=None, log=print) :
+        self.register = register
+        self.workers = workers if workers else PROVISION_WORKERS
+        self.log = log
+        # Toutes les créations (en cours et PROVISION_HISTORY terminées) {id : Job}
+        self.jobs = OrderedDict()
+        self.reserved = set()
+        self.ids = itertools.count(1)
+        self.batches = itertools.count(1)
+        self.lock = threading.Lock()
+        # fork et pas spawn : un nouvel import de kerrucent relancerait toute l'appli
+        self.context = multiprocessing.get_context('fork')
+        self.executor = None
+
+    def start (self) :
+        """Lance les processus du pool"""
+
+        with self.lock :
+            if self.executor :
+                return None
+            self.executor = ProcessPoolExecutor(self.workers, mp_context=self.context)
+            # Les processus ne sont créés qu'à la 1re tâche
+            self.executor.submit(os.getpid).result()
+        return None
+
+    def reserve (self, name) :
+        """Réserve et renvoie un nom de fichier (sans .rrd) libre pour le capteur name"""
+
+        filename = safename(name)
+        final_filename = filename
+        i = 0
+        with self.lock :
+            while final_filename in self.reserved or os.path.isfile(rrd_file(final_filename)) :
+                i+=1
+                final_filename = filename + str(i).zfill(2)
+            self.reserved.add(final_filename)
+        return final_filename
+
+    def new_batch (self) :
+        """Renvoie un nouveau numéro d'ajout en masse"""
+
+        with self.lock :
+            return next(self.batches)
+
+    def submit (self, name, mac, alpha=None, beta=None, period=None, profile=None, batch=None) :
+        """Ajoute la création d'un capteur à la file et renvoie le Job correspondant"""
+
+        job = Job(next(self.ids), name, self.reserve(name), mac,
+                alpha if alpha is not None else DEFAULT_ALPHA,
+                beta if beta is not None else DEFAULT_BETA,
+                period if period is not None else DEFAULT_PERIOD,
+                profile if profile else DEFAULT_STORAGE_PROFILE, batch)
+
+        # RQ : sans start(), les processus sont lancés ici (commandes flask, sans threads)
+        if not self.executor :
+            self.start()
+
+        with self.lock :
+            self.jobs[job.id] = job
+            self.forget()
+            try :
+                job.future = self.executor.submit(create_rrd, job.filename,
+                        alpha=job.alpha, beta=job.beta, period=job.period, profile=job.profile)
+            except BrokenExecutor :
+                self.log('Pool de création des RRD cassé, les RRD sont maintenant créées dans des threads')
+                self.executor = ThreadPoolExecutor(self.workers)
+                job.future = self.executor.submit(create_rrd, job.filename,
+                        alpha=job.alpha, beta=job.beta, period=job.period, profile=job.profile)
+        job.future.add_done_callback(lambda f : self.finish(job))
+        return job
+
+    def finish (self, job) :
+        """Ajoute à la BDD le capteur dont la RRD vient d'être créée"""
+
+        try :
+            error = job.future.exception()
+            if error :
+                job.error = 'Une erreur est survenue lors de la création de la RRD ('+str(error)+')'
+            else :
+                try :
+                    self.register(job)
+                except :
+                    job.error = 'Une erreur est survenue lors de l\'ajout de la sonde à la base de donnée. Suppression de '+job.filename+'.rrd'
+                    # Si il y a une erreur on supprime la RRD qu'on vient de créer
+                    del_rrd(job.filename)
+                    print(sys.exc_info())
+        except :
+            job.error = 'Une erreur est survenue lors de l\'ajout de la sonde ('+str(sys.exc_info()[1])+')'
+        finally :
+            job.status = 'error' if job.error else 'done'
+            job.finished = time.time()
+            with self.lock :
+                self.reserved.discard(job.filename)
+            if job.error :
+                self.log('Échec de l\'ajout du capteur '+job.name+' : '+job.error)
+            job.done.set()
+        return None
+
+    def forget (self) :
+        """Oublie les créations terminées les plus anciennes (au delà de PROVISION_HISTORY)
+        RQ : appelée avec self.lock"""
+
+        finished = [id for id, job in self.jobs.items() if job.done.is_set()]
+        for id in finished[:max(0, len(finished) - PROVISION_HISTORY)] :
+            del self.jobs[id]
+        return None
+
+    def get (self, id) :
+        return self.jobs.get(id)
+
+    def list (self, batch=None) :
+        """Les créations connues (d'un ajout en masse si batch est donné), les plus récentes en dernier"""
+
+        with self.lock :
+            jobs = list(self.jobs.values())
+        return [j for j in jobs if batch is None or j.batch == batch]
+
+    def active (self) :
+        """Les créations pas encore terminées"""
+
+        return [j for j in self.list() if not j.done.is_set()]
+
+    def wait (self, jobs, timeout=None) :
+        """Attend la fin de jobs, renvoie True si toutes les créations sont terminées"""
+
+        end = time.time() + timeout if timeout is not None else None
+        for job in jobs :
+            if not job.done.wait(None if end is None else max(0, end - time.time())) :
+                return False
+        return True
+
+
+
+def parse_onboarding(f) :
+    """Lit le CSV d'un ajout en masse de capteurs : name,mac[,alpha,beta,period]
+    Une ligne d'en-tête (name,mac,...) et les lignes vides sont ignorées
+    Renvoie (capteurs, erreurs) : des dicos (name, mac, alpha, beta, period)
+    et des messages pour les lignes incorrectes (avec leur numéro)"""
+
+    probes = []
+    errors = []
+    macs = set()
+    for n, row in enumerate(csv.reader(f), 1) :
+        row = [x.strip() for x in row]
+        if not any(row) :
+            continue
+        if n == 1 and row[:2] == ['name', 'mac'] :
+            continue
+
+        if len(row) < 2 or len(row) > 5 or not row[0] or not row[1] :
+            errors.append('Ligne '+str(n)+' : il faut name,mac[,alpha,beta,period]')
+            continue
+        if not re.match('([0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}', row[1]) :
+            errors.append('Ligne '+str(n)+' : '+row[1]+' n\'est pas une addresse MAC au format correct')
+            continue
+
+        if normalize_mac(row[1]) in macs :
+            errors.append('Ligne '+str(n)+' : la MAC '+row[1]+' apparaît déjà plus haut')
+            continue
+
+        row += ['']*(5 - len(row))
+        try :
+            alpha = float(row[2]) if row[2] else None
+            beta = float(row[3]) if row[3] else None
+            period = int(row[4]) if row[4] else None
+        except ValueError :
+            errors.append('Ligne '+str(n)+' : les paramètres de prédiction doivent être des nombres')
+            continue
+
+        macs.add(normalize_mac(row[1]))
+        probes.append({'name' : row[0], 'mac' : normalize_mac(row[1]), 'alpha' : alpha, 'beta' : beta, 'period' : period})
+
+    return probes, errors
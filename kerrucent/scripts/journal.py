@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+import mmap
+import os
+import threading
+import numpy as np
+from .constant import *
+from .batch import Batcher
+from .rrd import rrd_file
+
+# L'en-tête du journal : les positions d'écriture et de lecture sont des numéros
+# d'échantillon qui ne font que croître (case = numéro % capacité)
+JOURNAL_HEADER = np.dtype([('magic', 'S8'), ('version', '<u4'), ('capacity', '<u4'),
+        ('write', '<u8'), ('read', '<u8')])
+JOURNAL_HEADER_SIZE = 64
+# Un échantillon : filename de la RRD, timestamp et les 6 valeurs (NaN pour inconnue)
+JOURNAL_RECORD = np.dtype([('name', 'S64'), ('t', '<i8'), ('v', '<f8', (6,))])
+JOURNAL_MAGIC = b'KRJOURNL'
+JOURNAL_VERSION = 1
+
+# Les politiques quand le journal est plein
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+
+class Journal :
+    """Journal circulaire de taille fixe des échantillons reçus, dans un fichier mappé en mémoire
+
+    La réception y ajoute les échantillons (append) et un consommateur les relit
+    (read) puis valide sa position (commit) une fois les données écrites dans
+    les RRD. Les deux positions sont dans le fichier : après un redémarrage,
+    la relecture reprend là où elle s'était arrêtée.
+
+    Quand le journal est plein, policy décide : DROP_OLDEST écrase les plus
+    vieux échantillons non relus, DROP_NEWEST refuse les nouveaux et BLOCK
+    attend que le consommateur libère de la place. Attention, avec BLOCK
+    l'attente se fait dans append, donc dans la réception : la boucle asyncio
+    du serveur d'écoute est bloquée (plus aucun paquet lu) tant que la relecture
+    n'a pas libéré de place"""
+
+    def __init__ (self, path, capacity=None, policy=None) :
+        self.path = path
+        self.policy = policy if policy else JOURNAL_POLICY
+        if not self.policy in (DROP_OLDEST, DROP_NEWEST, BLOCK) :
+            raise ValueError('Politique de journal inconnue : '+str(self.policy))
+
+        # Le nombre d'échantillons perdus car le journal était plein
+        self.dropped = 0
+        self.cond = threading.Condition()
+
+        capacity = capacity if capacity else JOURNAL_CAPACITY
+        size = JOURNAL_HEADER_SIZE + capacity*JOURNAL_RECORD.itemsize
+
+        # On crée le fichier s'il n'existe pas (un journal existant garde sa capacité)
+        new = not os.path.isfile(path)
+        if new :
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'wb') as f :
+                f.truncate(size)
+
+        self.file = open(path, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        self.header = np.ndarray((), dtype=JOURNAL_HEADER, buffer=self.mm)
+
+        if new :
+            self.header['magic'] = JOURNAL_MAGIC
+            self.header['version'] = JOURNAL_VERSION
+            self.header['capacity'] = capacity
+        elif self.header['magic'] != JOURNAL_MAGIC or self.header['version'] != JOURNAL_VERSION :
+            self.close()
+            raise ValueError(path+' n\'est pas un journal Kerrucent valide')
+
+        self.capacity = int(self.header['capacity'])
+        self.records = np.ndarray((self.capacity,), dtype=JOURNAL_RECORD, buffer=self.mm, offset=JOURNAL_HEADER_SIZE)
+
+    def pending (self) :
+        """Renvoie le nombre d'échantillons pas encore relus"""
+
+        return int(self.header['write']) - int(self.header['read'])
+
+    def append (self, name, values, t) :
+        """Ajoute un échantillon au journal
+        Renvoie False s'il a été refusé (journal plein avec DROP_NEWEST)"""
+
+        name = name.encode('utf-8')
+        if len(name) > JOURNAL_RECORD['name'].itemsize :
+            raise ValueError('Nom de RRD trop long pour le journal : '+name.decode('utf-8'))
+
+        with self.cond :
+            while self.pending() >= self.capacity :
+                if self.policy == DROP_NEWEST :
+                    self.dropped += 1
+                    return False
+                if self.policy == DROP_OLDEST :
+                    self.header['read'] += 1
+                    self.dropped += 1
+                    break
+                self.cond.wait()
+
+            self.put(name, values, t)
+            self.cond.notify_all()
+
+        return True
+
+    def put (self, name, values, t) :
+        """Écrit un échantillon (nom encodé) à la position d'écriture (verrou pris, place libre)"""
+
+        write = int(self.header['write'])
+        record = self.records[write % self.capacity]
+        record['name'] = name
+        record['t'] = t
+        record['v'] = [float('nan') if v == 'U' else float(v) for v in values]
+        # On n'avance la position qu'une fois l'échantillon complet
+        self.header['write'] = write + 1
+        return None
+
+    def read (self, count) :
+        """Renvoie (position, échantillons) pour au plus count échantillons non relus
+        à partir de la position de lecture (sans la modifier, cf commit)"""
+
+        with self.cond :
+            start = int(self.header['read'])
+            n = min(count, int(self.header['write']) - start)
+            # On copie les échantillons : la réception peut réécrire les cases ensuite
+            records = self.records[(start + np.arange(n)) % self.capacity]
+
+        samples = []
+        for name, t, values in zip(records['name'].tolist(), records['t'].tolist(), records['v'].tolist()) :
+            samples.append((name.decode('utf-8'), [x if x == x else 'U' for x in values], t))
+
+        return start, samples
+
+    def commit (self, position) :
+        """Valide la relecture de tous les échantillons avant position"""
+
+        with self.cond :
+            # Avec DROP_OLDEST, la réception a pu avancer la position entre temps
+            if position > int(self.header['read']) :
+                self.header['read'] = position
+            self.cond.notify_all()
+
+        return None
+
+    def requeue (self, position, samples) :
+        """Valide la relecture jusqu'à position et remet d'un coup les échantillons
+        samples [(name, values, t)] (relus mais pas écrits) à la fin du journal
+        Renvoie le nombre d'échantillons perdus faute de place"""
+
+        lost = 0
+        with self.cond :
+            if position > int(self.header['read']) :
+                self.header['read'] = position
+            for name, values, t in samples :
+                # La place libérée par la validation a pu être reprise (cf DROP_OLDEST)
+                if self.pending() >= self.capacity :
+                    if self.policy != DROP_OLDEST :
+                        lost += 1
+                        continue
+                    self.header['read'] += 1
+                    lost += 1
+                self.put(name.encode('utf-8'), values, t)
+            self.dropped += lost
+            self.cond.notify_all()
+
+        return lost
+
+    def flush (self) :
+        """Force l'écriture du journal sur le disque"""
+
+        self.mm.flush()
+        return None
+
+    def close (self) :
+        # Les vues numpy doivent disparaître avant de fermer le mmap
+        self.records = None
+        self.header = None
+        self.mm.close()
+        self.file.close()
+        return None
+
+
+
+class JournalReplayer :
+    """Relit le journal en tâche de fond et écrit les échantillons dans les RRD
+
+    Chaque passe relit au plus JOURNAL_CHUNK échantillons, les écrit par paquets
+    (un appel à rrdtool.update par RRD) puis valide la position de lecture.
+    Un échantillon relu deux fois (arrêt brutal entre l'écriture et la
+    validation) est ignoré par le Batcher car plus vieux que la RRD.
+
+    Si l'écriture dans une RRD échoue (RRD verrouillée par tune, reshape, ...),
+    les autres RRD ne sont pas retenues : toute la passe est validée et les
+    échantillons de cette RRD sont remis à la fin du journal (dans l'ordre,
+    cf Journal.requeue) pour la passe suivante. Après JOURNAL_RETRIES passes
+    en échec d'affilée, ses échantillons en attente sont abandonnés. Ceux d'une
+    RRD supprimée entre temps sont abandonnés tout de suite."""
+
+    def __init__ (self, journal, batcher=None, log=print) :
+        self.journal = journal
+        self.batcher = batcher if batcher else Batcher()
+        self.log = log
+        # Le nombre de passes consécutives en échec de chaque RRD {filename : passes}
+        self.failures = {}
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def replay (self) :
+        """Fait une passe de relecture et renvoie le nombre d'échantillons relus"""
+
+        start, samples = self.journal.read(JOURNAL_CHUNK)
+        if not samples :
+            return 0
+
+        for name, values, t in samples :
+            self.batcher.add(name, values, t)
+
+        failed = set()
+        for name, e in self.batcher.flush(force=True) :
+            # Le Batcher repartira de la dernière mise à jour de la RRD
+            self.batcher.forget(name)
+            if not os.path.isfile(rrd_file(name)) :
+                self.log('Échantillons de '+name+'.rrd abandonnés (RRD supprimée)')
+                self.failures.pop(name, None)
+                continue
+            self.failures[name] = self.failures.get(name, 0) + 1
+            if self.failures[name] >= JOURNAL_RETRIES :
+                self.log('Échantillons de '+name+'.rrd abandonnés après '+str(self.failures[name])
+                        +' passes en échec : '+str(e))
+                del self.failures[name]
+                continue
+            self.log('Erreur lors de l\'écriture dans '+name+'.rrd : '+str(e))
+            failed.add(name)
+
+        for name in set(name for name, values, t in samples) - failed :
+            self.failures.pop(name, None)
+
+        retry = [s for s in samples if s[0] in failed]
+        lost = self.journal.requeue(start + len(samples), retry)
+        if lost :
+            self.log(str(lost)+' échantillons à réécrire perdus (journal plein)')
+        self.journal.flush()
+        # Les échantillons remis dans le journal ne comptent pas (cf run)
+        return len(samples) - len(retry)
+
+    def run (self) :
+        while True :
+            n = self.replay()
+            # On ne s'arrête qu'une fois le journal vidé
+            if self.stopping.is_set() and not n :
+                break
+            # Moins d'une passe complète : on laisse les données s'accumuler
+            if n < JOURNAL_CHUNK :
+                self.stopping.wait(JOURNAL_REPLAY_INTERVAL)
+
+    def start (self) :
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+        return None
+
+    def stop (self) :
+        """Arrête la relecture une fois le journal vidé"""
+
+        self.stopping.set()
+        if self.thread :
+            self.thread.join()
+            self.thread = None
+        return None
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import random
+import socket
+import threading
+import time
+from collections import deque
+from math import sin, pi
+import numpy as np
+from .constant import *
+from .data import encode
+from .rrd import last_rrd
+from .fetch import fetch_array
+
+##############################################
+## Les profils de consommation (cf rrd/up*) ##
+##############################################
+
+def profile_random(t) :
+    """Valeurs complètement aléatoires (rrd/up.py)"""
+
+    return [random.randint(0,30), random.randint(0,300), random.randint(0,360),
+            random.randint(0,3000), random.randint(0,3000), random.randint(0,3000)]
+
+def profile_sine(t) :
+    """Sinusoïdes de période 864 s avec du bruit (rrd/up2.py)"""
+
+    return [random.randint(-5,5)+10*sin(2*pi*(1/864)*t+0)+15,
+            random.randint(-50,50)+100*sin(2*pi*(1/864)*t+pi/2)+150,
+            random.randint(-30,30)+150*sin(2*pi*(1/864)*t+pi/3)+180,
+            random.randint(-400,400)+1100*sin(2*pi*(1/864)*t+pi/4)+1500,
+            random.randint(-200,200)+1300*sin(2*pi*(1/864)*t+pi/6)+1500,
+            random.randint(-100,100)+800*sin(2*pi*(1/864)*t-pi/2)+1500]
+
+def profile_daily(t) :
+    """Cycle journalier plus un cycle de 15 min avec du bruit (rrd/up3.py)"""
+
+    return [random.randint(-5,5)+8*sin(2*pi*(1/86400)*t+0)+2*sin(2*pi*(1/900)*t+0)+15,
+            random.randint(-50,50)+90*sin(2*pi*(1/86400)*t+pi/2)+10*sin(2*pi*(1/900)*t+0)+150,
+            random.randint(-30,30)+100*sin(2*pi*(1/86400)*t+pi/3)+50*sin(2*pi*(1/900)*t+0)+180,
+            random.randint(-400,400)+900*sin(2*pi*(1/86400)*t+pi/4)+200*sin(2*pi*(1/900)*t+0)+1500,
+            random.randint(-200,200)+1200*sin(2*pi*(1/86400)*t+pi/6)+100*sin(2*pi*(1/900)*t+0)+1500,
+            random.randint(-100,100)+500*sin(2*pi*(1/86400)*t-pi/2)+300*sin(2*pi*(1/900)*t+0)+1500]
+
+PROFILES = {'random' : profile_random, 'sine' : profile_sine, 'daily' : profile_daily}
+
+def random_mac(i) :
+    """Une mac (localement administrée) pour le ième capteur simulé"""
+
+    return '02:4B:%02X:%02X:%02X:%02X' % ((i >> 24) & 255, (i >> 16) & 255, (i >> 8) & 255, i & 255)
+
+
+
+def percentile(values, p) :
+    if not values :
+        return None
+    values = sorted(values)
+    return values[min(len(values)-1, int(p*len(values)))]
+
+
+
+class LoadGenerator :
+    """Simule des capteurs qui envoient leurs données au serveur
+
+    probes est la liste des (mac, filename, profil) des capteurs simulés :
+    ceux qui ont un filename (capteurs existants dans la BDD) servent à
+    mesurer les pertes et la latence de bout en bout en relisant leur RRD.
+    rate est le débit total (paquets par seconde) réparti entre les capteurs."""
+
+    def __init__ (self, probes, rate, duration, host='127.0.0.1', port=None, binary=False) :
+        self.probes = probes
+        self.rate = rate
+        self.duration = duration
+        self.address = (host, port if port else SERVER_PORT)
+        self.binary = binary
+
+        # Les envois des capteurs qui ont une RRD {filename : {timestamp : date d'envoi}}
+        self.sent = {filename : {} for mac, filename, profile in probes if filename}
+        # Les envois dont on attend l'arrivée dans la RRD {filename : deque((timestamp, date d'envoi))}
+        self.waiting = {filename : deque() for filename in self.sent}
+        # Les latences de bout en bout mesurées (en s)
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def packet (self, mac, t, profile) :
+        values = PROFILES[profile](t)
+        if self.binary :
+            return encode([(mac, t, values)])
+        return ('/'.join([mac] + ['%.2f' % v for v in values])).encode('utf-8')
+
+    def send (self) :
+        """Envoie les paquets au débit demandé et renvoie (paquets envoyés, durée)"""
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        count = 0
+        i = 0
+        start = time.time()
+        end = start + self.duration
+
+        while True :
+            now = time.time()
+            if now >= end :
+                break
+            # On rattrape le nombre de paquets qu'on aurait dû envoyer depuis le début
+            while count < self.rate*(now - start) :
+                mac, filename, profile = self.probes[i]
+                t = int(now)
+                sock.sendto(self.packet(mac, t, profile), self.address)
+                if filename and not t in self.sent[filename] :
+                    with self.lock :
+                        self.sent[filename][t] = now
+                        self.waiting[filename].append((t, now))
+                count += 1
+                i = (i+1) % len(self.probes)
+            time.sleep(0.005)
+
+        sock.close()
+        return count, time.time() - start
+
+    def watch (self) :
+        """Mesure la latence : date à laquelle la RRD contient un échantillon envoyé"""
+
+        files = list(self.sent.keys())
+        k = 0
+        while files and not self.done.is_set() :
+            filename = files[k % len(files)]
+            k += 1
+            time.sleep(0.1/len(files))
+            try :
+                last = last_rrd(filename)
+            except Exception :
+                continue
+            now = time.time()
+            with self.lock :
+                waiting = self.waiting[filename]
+                while waiting and waiting[0][0] <= last :
+                    t, date = waiting.popleft()
+                    self.latencies.append(now - date)
+
+    def stored (self, filename, start, end) :
+        """Renvoie les timestamps pour lesquels la RRD contient une valeur"""
+
+        series = fetch_array(filename, 'AVERAGE', start-1, end, 1)
+        # Une ligne couvre les step secondes qui la précèdent (profils à step > 1)
+        known = series.times[~np.isnan(series.values[:, 0])]
+        return set(int(t) - k for t in known for k in range(series.step))
+
+    def run (self, settle=None) :
+        """Lance la simulation et renvoie un rapport (dict)"""
+
+        watcher = threading.Thread(target=self.watch)
+        watcher.start()
+
+        start = int(time.time())
+        count, elapsed = self.send()
+        end = int(time.time())
+
+        # On laisse la chaîne d'écoute écrire ses données en attente
+        time.sleep(settle if settle is not None else BATCH_MAX_AGE + 2*SERVER_TIMEOUT)
+        self.done.set()
+        watcher.join()
+
+        sent = 0
+        received = 0
+        for filename, dates in self.sent.items() :
+            try :
+                stored = self.stored(filename, start, end)
+            except Exception :
+                continue
+            sent += len(dates)
+            received += len(stored & set(dates.keys()))
+
+        return {
+            'packets' : count,
+            'duration' : elapsed,
+            'rate' : count/elapsed if elapsed else 0,
+            'checked' : sent,
+            'loss' : 1 - received/sent if sent else None,
+            'latency_p50' : percentile(self.latencies, 0.5),
+            'latency_p95' : percentile(self.latencies, 0.95),
+            'latency_max' : max(self.latencies) if self.latencies else None,
+        }
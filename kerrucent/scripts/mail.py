@@ -1,7 +1,7 @@
 import smtplib
 import time
 from email.mime.text import MIMEText
-from .rrd import has_error
+from .fetch import has_error
 
 FROM = "alertes-kerrucent@gmail.com (Alertes Kerrucent)"
 
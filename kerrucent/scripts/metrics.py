@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import threading
+
+# Les bornes par défaut des histogrammes de durée (en s)
+DEFAULT_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# Toutes les métriques du processus, dans l'ordre de création
+METRICS = []
+# Les dernières métriques reçues d'autres processus (cf snapshot), ajoutées par render
+# avec le label shard {numéro du processus : [(nom de la métrique, [(nom, labels, valeur)])]}
+REMOTE = {}
+
+def escape(value) :
+    """Échappe une valeur de label pour le format texte de Prometheus"""
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+
+def format_labels(names, values, extra='') :
+    labels = ['%s="%s"' % (n, escape(v)) for n, v in zip(names, values)]
+    if extra :
+        labels.append(extra)
+    return '{'+','.join(labels)+'}' if labels else ''
+
+
+
+def add_label(labels, extra) :
+    """Ajoute un label (déjà formaté) à des labels formatés par format_labels"""
+
+    return labels[:-1]+','+extra+'}' if labels else '{'+extra+'}'
+
+
+
+def format_value(value) :
+    if value == float('inf') :
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+
+class Metric :
+    """Une métrique, éventuellement déclinée selon des labels
+    Les valeurs sont indexées par le tuple des valeurs de labels"""
+
+    kind = 'untyped'
+
+    def __init__ (self, name, help, labels=()) :
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def samples (self) :
+        """Renvoie les lignes (nom, labels, valeur) de la métrique"""
+
+        with self.lock :
+            values = list(self.values.items())
+        return [(self.name, format_labels(self.labels, k), v) for k, v in values]
+
+    def render (self, extra=()) :
+        """Le texte de la métrique, suivi des lignes extra (nom, labels, valeur)"""
+
+        lines = ['# HELP '+self.name+' '+self.help, '# TYPE '+self.name+' '+self.kind]
+        for name, labels, value in self.samples() + list(extra) :
+            lines.append(name+labels+' '+format_value(value))
+        return '\n'.join(lines)
+
+
+
+class Counter (Metric) :
+    """Un compteur qui ne fait qu'augmenter"""
+
+    kind = 'counter'
+
+    def __init__ (self, name, help, labels=()) :
+        Metric.__init__(self, name, help, labels)
+        # Un compteur sans label vaut 0 tant qu'il n'a pas bougé
+        if not self.labels :
+            self.values[()] = 0
+
+    def inc (self, amount=1, *labels) :
+        with self.lock :
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+
+class Gauge (Metric) :
+    """Une valeur instantanée, fixée (set) ou calculée au moment de la lecture (function)"""
+
+    kind = 'gauge'
+
+    def __init__ (self, name, help, labels=()) :
+        Metric.__init__(self, name, help, labels)
+        self.functions = {}
+
+    def set (self, value, *labels) :
+        with self.lock :
+            self.values[labels] = value
+
+    def set_function (self, function, *labels) :
+        with self.lock :
+            self.functions[labels] = function
+
+    def samples (self) :
+        with self.lock :
+            values = dict(self.values)
+            functions = list(self.functions.items())
+        for k, f in functions :
+            try :
+                values[k] = f()
+            except Exception :
+                pass
+        return [(self.name, format_labels(self.labels, k), v) for k, v in values.items()]
+
+
+
+class Histogram (Metric) :
+    """La répartition d'une grandeur (typiquement une durée) dans des intervalles fixes"""
+
+    kind = 'histogram'
+
+    def __init__ (self, name, help, labels=(), buckets=None) :
+        Metric.__init__(self, name, help, labels)
+        self.buckets = sorted(buckets if buckets else DEFAULT_BUCKETS)
+
+    def observe (self, value, *labels) :
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock :
+            h = self.values.get(labels)
+            if h is None :
+                # [nombre par intervalle (le dernier pour +Inf), somme]
+                h = self.values[labels] = [[0]*(len(self.buckets)+1), 0]
+            h[0][i] += 1
+            h[1] += value
+
+    def samples (self) :
+        with self.lock :
+            values = [(k, list(h[0]), h[1]) for k, h in self.values.items()]
+
+        res = []
+        for k, counts, total in values :
+            cumul = 0
+            for bound, n in zip(self.buckets + [float('inf')], counts) :
+                cumul += n
+                res.append((self.name+'_bucket', format_labels(self.labels, k, 'le="'+format_value(bound)+'"'), cumul))
+            res.append((self.name+'_sum', format_labels(self.labels, k), total))
+            res.append((self.name+'_count', format_labels(self.labels, k), cumul))
+        return res
+
+
+
+def snapshot() :
+    """Les lignes de toutes les métriques du processus, pour un autre processus (cf REMOTE)"""
+
+    return [(m.name, m.samples()) for m in METRICS]
+
+
+
+def render() :
+    """Renvoie toutes les métriques du processus au format texte de Prometheus
+    (et celles reçues d'autres processus, avec leur label shard)"""
+
+    remote = {}
+    for shard, metrics in list(REMOTE.items()) :
+        label = 'shard="'+escape(shard)+'"'
+        for metric, samples in metrics :
+            remote.setdefault(metric, []).extend((n, add_label(l, label), v) for n, l, v in samples)
+    return '\n'.join(m.render(remote.get(m.name, ())) for m in METRICS)+'\n'
+
+
+
+#########################################
+## Les métriques de la chaîne d'écoute ##
+#########################################
+
+PACKETS = Counter('kerrucent_packets_received_total', 'Paquets UDP reçus des capteurs')
+BYTES = Counter('kerrucent_bytes_received_total', 'Octets reçus des capteurs')
+SAMPLES = Counter('kerrucent_samples_received_total', 'Échantillons décodés')
+REJECTED = Counter('kerrucent_samples_rejected_total', 'Valeurs rejetées (hors de [MINIMA, MAXIMA] ou illisibles)', ['field'])
+BAD_TIMESTAMPS = Counter('kerrucent_samples_bad_timestamp_total', 'Échantillons datés trop loin de leur réception (cf SAMPLE_MAX_AHEAD et SAMPLE_MAX_AGE)')
+UNKNOWN_MACS = Counter('kerrucent_unknown_mac_total', 'Échantillons de capteurs inconnus')
+DROPPED = Counter('kerrucent_samples_dropped_total', 'Échantillons perdus (file ou journal plein)')
+FORWARDED = Counter('kerrucent_packets_forwarded_total', 'Paquets transmis à un autre processus d\'écoute')
+LATE = Counter('kerrucent_samples_late_total', 'Échantillons arrivés pour une seconde déjà écrite')
+BUCKET_SAMPLES = Histogram('kerrucent_bucket_samples', 'Échantillons regroupés dans une même seconde', buckets=[1, 2, 5, 10, 20, 50, 100])
+QUEUE_DEPTH = Gauge('kerrucent_queue_depth', 'Échantillons en attente d\'écriture', ['stage'])
+PROBES = Gauge('kerrucent_probes', 'Capteurs connus de la chaîne d\'écoute')
+RRD_UPDATE = Histogram('kerrucent_rrd_update_seconds', 'Durée des appels à rrdtool.update', ['file'])
+RRD_UPDATE_SAMPLES = Counter('kerrucent_rrd_update_samples_total', 'Échantillons écrits dans les RRD', ['file'])
+RRD_UPDATE_ERRORS = Counter('kerrucent_rrd_update_errors_total', 'Appels à rrdtool.update en échec', ['file'])
+ALERT_CHECK = Histogram('kerrucent_alert_check_seconds', 'Durée de la vérification d\'erreur d\'un capteur', ['file'])
+ALERT_MISSED = Counter('kerrucent_alert_missed_cycles_total', 'Cycles de vérification d\'erreur manqués')
+ALERT_TIMEOUTS = Counter('kerrucent_alert_timeouts_total', 'Vérifications d\'erreur plus longues que ALERT_TIMEOUT')
+ALERT_RUNNING = Gauge('kerrucent_alert_checks_running', 'Vérifications d\'erreur en cours')
+ALERT_LAG = Gauge('kerrucent_alert_lag_seconds', 'Retard maximal des vérifications d\'erreur lancées au dernier tour')
+
+
+
+################################
+## Les métriques des lectures ##
+################################
+
+FETCH_CACHE_HITS = Counter('kerrucent_fetch_cache_hits_total', 'Blocs de RRD lus depuis le cache')
+FETCH_CACHE_MISSES = Counter('kerrucent_fetch_cache_misses_total', 'Blocs de RRD lus sur le disque')
+FETCH_CACHE_BYTES = Gauge('kerrucent_fetch_cache_bytes', 'Taille des données du cache des lectures de RRD')
+GRAPH_CACHE_HITS = Counter('kerrucent_graph_cache_hits_total', 'Graphes servis depuis le cache')
+GRAPH_CACHE_MISSES = Counter('kerrucent_graph_cache_misses_total', 'Graphes générés par rrdtool.graphv')
+GRAPH_CACHE_COUNT = Gauge('kerrucent_graph_cache_files', 'Graphes gardés par le cache')
+GRAPH_FAILURES = Counter('kerrucent_graph_failures_total', 'Graphes d\'aperçu en échec ou trop longs')
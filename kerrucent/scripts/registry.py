@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import zlib
+from .constant import *
+
+def normalize_mac(mac) :
+    """Renvoie la mac sous sa forme normalisée AA:BB:CC:DD:EE:FF"""
+
+    return mac.strip().upper().replace('-', ':')
+
+
+
+def shard_of(mac, shards) :
+    """Renvoie le numéro du processus d'écoute propriétaire d'un capteur
+    (toujours le même pour une mac donnée, quel que soit le processus qui calcule)"""
+
+    return zlib.crc32(normalize_mac(mac).encode('utf-8')) % shards
+
+
+
+class ProbeRegistry :
+    """Les capteurs à remplir, en mémoire : {mac normalisée : filename}
+
+    Les pages de gestion des capteurs le modifient directement (set, discard)
+    ce qui prend effet immédiatement pour la réception des données.
+    Pour les autres processus, chaque modification de la table probes
+    incrémente probes_version (triggers SQLite) : refresh() ne lit que
+    ce compteur et ne recharge les capteurs que s'il a changé.
+
+    shard et shards limitent le registre aux capteurs d'un processus d'écoute
+
+    Le registre connaît aussi les groupes de capteurs (tables probe_groups et
+    probe_group_members, qui incrémentent le même compteur) : groups donne les
+    groupes de chaque capteur et members les capteurs de chaque groupe
+    (par filename), cf GroupAggregator
+
+    watch(callback) fait appeler callback(filename) pour chaque capteur ou
+    groupe retiré ou ajouté (discard, set ou rechargement), par exemple pour
+    oublier les données en attente d'une RRD supprimée ou recréée"""
+
+    def __init__ (self, database, shard=0, shards=1) :
+        self.database = database
+        self.shard = shard
+        self.shards = shards
+        self.probes = {}
+        self.groups = {}
+        self.members = {}
+        self.version = None
+        self.watchers = []
+
+    def watch (self, callback) :
+        """Fait appeler callback(filename) quand un capteur ou un groupe est retiré ou ajouté"""
+
+        self.watchers.append(callback)
+        return None
+
+    def changed (self, filenames) :
+        """Prévient les watchers des filenames retirés ou ajoutés"""
+
+        for filename in filenames :
+            for callback in self.watchers :
+                callback(filename)
+        return None
+
+    def connect (self) :
+        return sqlite3.connect(self.database)
+
+    def load (self) :
+        """Recharge tous les capteurs depuis la BDD"""
+
+        db = self.connect()
+        try :
+            version = self.read_version(db)
+            probes = db.execute('SELECT filename, mac FROM probes').fetchall()
+            links = self.read_groups(db)
+        finally :
+            db.close()
+
+        groups = {}
+        members = {}
+        for group, probe in links :
+            groups.setdefault(probe, []).append(group)
+            members.setdefault(group, []).append(probe)
+
+        # On remplace les dictionnaires d'un coup (jamais de dico à moitié rempli pour les lecteurs)
+        before = set(self.probes.values()) | set(self.members.keys())
+        self.probes = {normalize_mac(mac) : filename for filename, mac in probes if self.owns(mac)}
+        self.groups = groups
+        self.members = members
+        self.version = version
+        self.changed(before ^ (set(self.probes.values()) | set(members.keys())))
+        return None
+
+    def read_groups (self, db) :
+        """Renvoie les couples (filename du groupe, filename du capteur)
+        (aucun pour une BDD créée avant l'introduction des groupes)"""
+
+        try :
+            return db.execute('SELECT probe_groups.filename, probes.filename FROM probe_group_members '
+                    +'JOIN probe_groups ON probe_groups.id=probe_group_members.group_id '
+                    +'JOIN probes ON probes.id=probe_group_members.probe_id').fetchall()
+        except sqlite3.OperationalError :
+            return []
+
+    def read_version (self, db) :
+        """Renvoie le compteur de modifications de la table probes
+        (None pour une BDD créée avant son introduction)"""
+
+        try :
+            return db.execute('SELECT version FROM probes_version').fetchone()[0]
+        except sqlite3.OperationalError :
+            return None
+
+    def refresh (self) :
+        """Recharge les capteurs seulement si la table probes a changé
+        Renvoie True si un rechargement a eu lieu"""
+
+        db = self.connect()
+        try :
+            version = self.read_version(db)
+        finally :
+            db.close()
+
+        # Sans compteur, on ne peut pas savoir : on recharge
+        if version is not None and version == self.version :
+            return False
+
+        self.load()
+        return True
+
+    def owns (self, mac) :
+        return self.shards <= 1 or shard_of(mac, self.shards) == self.shard
+
+    def get (self, mac, default=None) :
+        """Renvoie le filename du capteur de mac donnée"""
+
+        name = self.probes.get(mac)
+        if name :
+            return name
+        return self.probes.get(normalize_mac(mac), default)
+
+    def set (self, mac, filename) :
+        """Ajoute (ou modifie) un capteur"""
+
+        if self.owns(mac) :
+            new = not filename in self.probes.values()
+            self.probes[normalize_mac(mac)] = filename
+            # Une RRD recréée sous le nom d'une ancienne ne doit rien en hériter
+            if new :
+                self.changed([filename])
+        return None
+
+    def discard (self, mac) :
+        """Retire un capteur"""
+
+        filename = self.probes.pop(normalize_mac(mac), None)
+        # Une même RRD peut être remplie sous une autre mac (changement de mac)
+        if filename and not filename in self.probes.values() :
+            self.changed([filename])
+        return None
+
+    def __len__ (self) :
+        return len(self.probes)
@@ -4,50 +4,345 @@ import rrdtool
 import random
 import time
 import os
+import subprocess
+import threading
 from math import sin, pi
 from .constant import *
+from .metrics import RRD_UPDATE, RRD_UPDATE_SAMPLES, RRD_UPDATE_ERRORS
 
-def create_rrd(name, start=None, alpha=0.000192522, beta=0.00000802250, period=86400) :
-    """Crée une base de donnée rrd avec des paramètres adaptés aux capteurs"""
+def rrd_file(name) :
+    """Renvoie le chemin complet du fichier RRD d'un capteur"""
 
-    if not start :
-        start = int(time.time())
+    return os.path.join(APP_ROOT, RRD_PATH, name+'.rrd')
+
+
+
+def daemon_args() :
+    """Renvoie les paramètres rrdtool pour passer par rrdcached (vide si désactivé)
+    En lecture (fetch, graph, ...) rrdcached écrit d'abord les données en attente
+    des seuls fichiers concernés"""
+
+    if not RRDCACHED :
+        return []
+    return ['--daemon', RRDCACHED]
+
+
+
+def flush_rrd(name) :
+    """Demande à rrdcached d'écrire sur le disque les données en attente d'une RRD"""
+
+    if RRDCACHED :
+        rrdtool.flushcached('--daemon', RRDCACHED, rrd_file(name))
+    return None
+
+
+
+# Les profils de stockage des RRD, chacun donne :
+#   step      : la résolution de base (en s) de la RRD
+#   heartbeat : le délai (en s) sans valeur au delà duquel la grandeur devient inconnue
+#   rras      : les archives (résolution en s, nombre de lignes), en AVERAGE
+#               et aussi en MIN et MAX au delà de la résolution de base
+#   hw_rows   : le nombre de lignes de la prédiction (HWPREDICT et DEVPREDICT)
+STORAGE_PROFILES = {
+    # Une valeur par seconde pendant 10 jours, par minute pendant 90 jours,
+    # par heure pendant 18 mois et par jour pendant 10 ans (l'ancien format unique)
+    'dense' : {'step' : 1, 'heartbeat' : 1,
+            'rras' : [(1, 864000), (60, 129600), (3600, 13392), (86400, 3660)],
+            'hw_rows' : 864000},
+    # Une valeur par seconde pendant 1 jour, par minute pendant 30 jours,
+    # par heure pendant 18 mois et par jour pendant 10 ans
+    'standard' : {'step' : 1, 'heartbeat' : 1,
+            'rras' : [(1, 86400), (60, 43200), (3600, 13392), (86400, 3660)],
+            'hw_rows' : 86400},
+    # Une valeur toutes les 10 s pendant 2 jours, toutes les 5 min pendant 90 jours,
+    # par heure pendant 18 mois et par jour pendant 10 ans
+    'compact' : {'step' : 10, 'heartbeat' : 20,
+            'rras' : [(10, 17280), (300, 25920), (3600, 13392), (86400, 3660)],
+            'hw_rows' : 8640},
+}
+
+def rrd_params(path, profile=None, start=None, alpha=0.000192522, beta=0.00000802250, period=86400,
+        maxima=None, predict=True) :
+    """Renvoie les paramètres de rrdtool.create pour un profil de stockage
+    maxima remplace les bornes hautes des grandeurs (MAXIMA, 'U' pour aucune)
+    et predict à False retire les archives de prédiction"""
+
+    if not maxima :
+        maxima = MAXIMA
+
+    p = STORAGE_PROFILES[profile if profile else DEFAULT_STORAGE_PROFILE]
+    step = p['step']
 
     params = []
 
     # Le nom du fichier
-    params += [os.path.join(APP_ROOT, RRD_PATH, name+'.rrd')]
+    params += [path]
     # Les paramètres temporels
-    params += ['--start', str(start), '--step', '1']
+    if start :
+        params += ['--start', str(int(start))]
+    params += ['--step', str(step)]
     # Les Data Sources DS:<name>:<source_type>:<heartbeat>:<min>:<max>
-    # Les 6 grandeurs qui stockent une valeur par seconde
-    params += ['DS:courant:GAUGE:1:'+str(MINIMA[0])+':'+str(MAXIMA[0]),
-            'DS:tension:GAUGE:1:'+str(MINIMA[1])+':'+str(MAXIMA[1]),
-            'DS:dephasage:GAUGE:1:'+str(MINIMA[1])+':'+str(MAXIMA[1]),
-            'DS:puiss_active:GAUGE:1:'+str(MINIMA[1])+':'+str(MAXIMA[1]),
-            'DS:puiss_reactive:GAUGE:1:'+str(MINIMA[1])+':'+str(MAXIMA[1]),
-            'DS:puiss_apparente:GAUGE:1:'+str(MINIMA[1])+':'+str(MAXIMA[1])]
+    # Les 6 grandeurs qui stockent une valeur par step
+    params += ['DS:'+n+':GAUGE:'+str(p['heartbeat'])+':'+str(MINIMA[i])+':'+str(maxima[i])
+            for i, n in enumerate(DS_NAMES)]
     # Les Round Robin Archives standard RRA:<aggregation_type>:<percentage_for_unknwon>:<steps>:<row>
-    # On garde une valeur par seconde pendant 10 jours
-    #          une valeur par minute pendant 90 jours
-    #          une valeur par heure pendant 18 mois
-    #          une valeur par jour pendant 10 ans
-    params += ['RRA:AVERAGE:0.5:1:864000',
-            'RRA:AVERAGE:0.5:60:129600',
-            'RRA:AVERAGE:0.5:3600:13392',
-            'RRA:AVERAGE:0.5:86400:3660']
+    params += ['RRA:AVERAGE:0.5:'+str(res//step)+':'+str(rows) for res, rows in p['rras']]
+    # Les archives MIN et MAX gardent les pics à chaque niveau de consolidation
+    params += peak_rras(p)
     # Les Round Robin Archives de prédiction RRA:HWPREDICT:<rows>:<alpha>:<beta>:<seasonal_period>
     # Crée automatiquement RRA:HWPREDICT, RRA:SEASONAL, RRA:DEVPREDICT, RRA:DEVSEASONAL, RRA:FAILURES
-    params += ['RRA:HWPREDICT:864000:'+str(alpha)+':'+str(beta)+':'+str(period)]
+    # RQ : la période est exprimée en nombre de steps
+    if predict :
+        params += ['RRA:HWPREDICT:'+str(p['hw_rows'])+':'+str(alpha)+':'+str(beta)+':'+str(int(period)//step)]
+
+    return params
+
+
+
+def peak_rras(p) :
+    """Renvoie les archives MIN et MAX d'un profil (dict de STORAGE_PROFILES)
+    RQ : à la résolution de base elles vaudraient AVERAGE, on ne les crée pas"""
+
+    step = p['step']
+    return ['RRA:'+cf+':0.5:'+str(res//step)+':'+str(rows)
+            for res, rows in p['rras'] if res > step for cf in ['MIN', 'MAX']]
+
+
+
+def subsecond_name(name, cf) :
+    """Le nom de la RRD des pics (cf 'MIN' ou 'MAX') à l'intérieur des secondes d'une RRD
+    RQ : dans son propre dossier, il ne peut pas croiser le filename d'un capteur (cf safename)"""
+
+    return SUBSECOND_PATH + name + '.' + cf.lower()
+
+
+
+def has_subsecond(name) :
+    """Indique si une RRD a ses RRD de pics à l'intérieur des secondes"""
+
+    return os.path.isfile(rrd_file(subsecond_name(name, 'MAX')))
+
+
+
+def create_subsecond_rrd(name, start=None) :
+    """Crée les RRD des pics MIN et MAX à l'intérieur des secondes d'une RRD (cf Aggregator)
+    Une ligne par seconde, consolidée aux résolutions des archives AVERAGE de la RRD.
+    Seules les secondes qui ont reçu plusieurs échantillons y sont écrites : une
+    ligne consolidée garde donc son pic dès qu'une seule de ses secondes est connue"""
+
+    archives, last = rrd_archives(name)
+    if not start :
+        start = last
+
+    os.makedirs(os.path.dirname(rrd_file(subsecond_name(name, 'MIN'))), exist_ok=True)
+    # MAX en dernier : c'est lui qui indique que les deux RRD sont prêtes (cf has_subsecond)
+    for cf in ['MIN', 'MAX'] :
+        params = [rrd_file(subsecond_name(name, cf)), '--start', str(int(start)), '--step', '1']
+        params += ['DS:'+n+':GAUGE:1:'+str(MINIMA[i])+':'+str(MAXIMA[i]) for i, n in enumerate(DS_NAMES)]
+        params += ['RRA:'+cf+':0.99:'+str(res)+':'+str(rows) for res, rows in archives['AVERAGE']]
+        rrdtool.create(*params)
+    return None
+
+
+
+def rrd_size(profile=None, period=86400, predict=True) :
+    """Estime la taille (en octets) d'une RRD créée avec un profil de stockage
+    8 octets par grandeur et par ligne d'archive, plus l'en-tête"""
+
+    p = STORAGE_PROFILES[profile if profile else DEFAULT_STORAGE_PROFILE]
+    seasonal = int(period)//p['step']
+
+    # AVERAGE, MIN et MAX, puis HWPREDICT et DEVPREDICT, puis SEASONAL, DEVSEASONAL et FAILURES
+    peaks = [r for res, r in p['rras'] if res > p['step']]
+    rows = sum(r for res, r in p['rras']) + 2*sum(peaks)
+    rras = len(p['rras']) + 2*len(peaks)
+    if predict :
+        rows += 2*p['hw_rows'] + 3*seasonal
+        rras += 5
+
+    return rows*len(DS_NAMES)*8 + rras*len(DS_NAMES)*128 + 4096
+
+
+
+def human_size(size) :
+    """Affiche une taille en octets de façon lisible (ex : 27.8 Mo)"""
+
+    for unit in ['o', 'ko', 'Mo'] :
+        if size < 1000 :
+            return '%.1f %s' % (size, unit)
+        size /= 1000
+    return '%.1f Go' % size
+
+
+
+def create_rrd(name, start=None, alpha=0.000192522, beta=0.00000802250, period=86400, profile=None, path=None) :
+    """Crée une base de donnée rrd avec des paramètres adaptés aux capteurs
+    La taille des archives dépend du profil de stockage (cf STORAGE_PROFILES)
+    path remplace le chemin de la RRD (nouvelle RRD créée à côté de l'actuelle)"""
+
+    if not start :
+        start = int(time.time())
+
+    return rrdtool.create(*rrd_params(path if path else rrd_file(name), profile, start, alpha, beta, period))
+
+
+
+def reshape_rrd(name, profile, alpha=0.000192522, beta=0.00000802250, period=86400) :
+    """Passe une RRD existante à un autre profil de stockage sans arrêter l'écoute
 
-    return rrdtool.create(*params)
+    La nouvelle RRD est créée à côté de l'ancienne et pré-remplie par rrdtool
+    (create --source, rrdtool >= 1.5), puis on y recopie les secondes écrites
+    entre temps dans l'ancienne et on la met à la place (os.replace, atomique)
+    RQ : les prédictions (HWPREDICT, ...) repartent de zéro"""
+
+    path = rrd_file(name)
+    tmp = path+'.reshape'
+
+    # La copie lit le fichier directement
+    flush_rrd(name)
+    try :
+        rrdtool.create(*(rrd_params(tmp, profile, None, alpha, beta, period) + ['--source', path]))
+        catch_up_rrd(name, tmp)
+    finally :
+        if os.path.exists(tmp) :
+            os.remove(tmp)
+
+    return None
+
+
+
+def catch_up_rrd(name, tmp) :
+    """Recopie dans la RRD tmp les secondes écrites dans la RRD name depuis
+    la dernière mise à jour de tmp, puis met tmp à la place (os.replace, atomique)
+    Seule l'archive la plus fine de name est lue : une archive consolidée donnerait
+    des lignes de plusieurs secondes, inconnues une fois écrites seconde par seconde.
+    Les secondes plus vieilles que cette archive ne sont donc pas recopiées.
+    RQ : l'écoute continue d'écrire pendant ce temps, on fait quelques passes au plus"""
+
+    path = rrd_file(name)
+    res, size = rrd_archives(name)[0]['AVERAGE'][0]
+    for i in range(10) :
+        flush_rrd(name)
+        done = rrdtool.last(tmp)
+        last = rrdtool.last(path)
+        if last <= done :
+            break
+        start = max(done, last - res*(size - 1))
+        (first, end, step), names, rows = rrdtool.fetch(path, 'AVERAGE', '--resolution', str(res),
+                '--start', str(start - start % res), '--end', str(last))
+        samples = []
+        for j, row in enumerate(rows) :
+            t = first + step*(j+1)
+            if done < t <= last :
+                samples.append(str(t)+':'+':'.join('U' if v is None else str(v) for v in row))
+        if samples :
+            rrdtool.update(tmp, *samples)
+
+    os.replace(tmp, path)
+    return None
+
+
+
+def rrd_cfs(name) :
+    """Renvoie l'ensemble des fonctions de consolidation des archives d'une RRD
+    (AVERAGE, MIN, MAX, HWPREDICT, ...)"""
+
+    info = rrdtool.info(*(daemon_args() + [rrd_file(name)]))
+    return set(v for k, v in info.items() if k.startswith('rra[') and k.endswith('].cf'))
+
+
+
+def rrd_archives(name) :
+    """Renvoie les archives d'une RRD et la date de sa dernière mise à jour :
+    ({cf : [(résolution en s, nombre de lignes), ...]}, dernière mise à jour)
+    les archives de chaque fonction de consolidation étant triées par résolution"""
+
+    info = rrdtool.info(*(daemon_args() + [rrd_file(name)]))
+
+    archives = {}
+    i = 0
+    while 'rra['+str(i)+'].cf' in info :
+        cf = info['rra['+str(i)+'].cf']
+        archives.setdefault(cf, []).append((info['step']*info['rra['+str(i)+'].pdp_per_row'], info['rra['+str(i)+'].rows']))
+        i += 1
+    for cf in archives :
+        archives[cf].sort()
+
+    return archives, info['last_update']
+
+
+
+def backfill_limit(name, first) :
+    """Vérifie qu'une RRD peut être reconstruite à partir de la date first (cf Importer)
+    sans rien perdre de ce qu'elle contient : ses données doivent toutes être après
+    first et tenir dans son archive la plus fine (cf catch_up_rrd).
+    Renvoie la première seconde qu'elle couvre, à partir de laquelle ses données
+    priment sur celles importées (None si elle n'a aucune donnée), lève ValueError sinon"""
+
+    archives, last = rrd_archives(name)
+    averages = archives['AVERAGE']
+    finest = averages[0]
+    longest = max(averages, key=lambda a : a[0]*a[1])
+
+    start = None
+    for res, rows in (finest, longest) :
+        (begin, end, step), names, data = rrdtool.fetch(*(daemon_args() + [rrd_file(name), 'AVERAGE',
+                '--resolution', str(res), '--start', str(last - res*rows), '--end', str(last)]))
+        known = [j for j, row in enumerate(data) if any(v is not None for v in row)]
+        if known :
+            first_known = begin + step*known[0] + 1
+            start = first_known if start is None else min(start, first_known)
+            # Données dès le début de l'archive la plus fine : elles peuvent remonter plus loin
+            if known[0] > 0 :
+                break
+
+    if start is None :
+        return None
+    if start <= first :
+        raise ValueError(name+'.rrd a déjà des données avant le premier échantillon importé')
+    if last - start >= finest[0]*(finest[1] - 1) :
+        raise ValueError(name+'.rrd a plus d\'historique que son archive la plus fine')
+    return start
+
+
+
+def has_peaks(name) :
+    """Indique si une RRD a des archives MIN et MAX (cf peak_rras)"""
+
+    try :
+        cfs = rrd_cfs(name)
+    except Exception :
+        return False
+    return 'MIN' in cfs and 'MAX' in cfs
+
+
+
+def add_peaks_rrd(name, profile) :
+    """Ajoute les archives MIN et MAX du profil à une RRD qui n'en a pas
+    (RRD créées avant leur introduction, rrdtool >= 1.5)
+    Les pics passés sont reconstitués au mieux par rrdtool depuis les autres archives"""
+
+    if has_peaks(name) :
+        return False
+
+    # rrdtool.tune réécrit le fichier
+    flush_rrd(name)
+    rrdtool.tune(rrd_file(name), *peak_rras(STORAGE_PROFILES[profile]))
+    return True
 
 
 
 def del_rrd(name):
     """Supprime une RRD"""
 
-    os.remove(os.path.join(APP_ROOT, RRD_PATH, name+'.rrd'))
+    # Sinon rrdcached recréerait des données pour un fichier disparu
+    flush_rrd(name)
+    os.remove(rrd_file(name))
+    # Ses pics à l'intérieur des secondes disparaissent avec elle
+    for cf in ['MIN', 'MAX'] :
+        if os.path.isfile(rrd_file(subsecond_name(name, cf))) :
+            flush_rrd(subsecond_name(name, cf))
+            os.remove(rrd_file(subsecond_name(name, cf)))
     return None
 
 
@@ -59,41 +354,130 @@ def update_rrd(name, values, t=None) :
         t = int(time.time())
 
     params = []
+    # Via rrdcached si besoin
+    params += daemon_args()
     # Le nom de la RRD
-    params += [os.path.join(APP_ROOT, RRD_PATH, name+'.rrd')]
+    params += [rrd_file(name)]
     # Les valeurs de la RRD
     val = ':'.join(str(v) for v in values)
     params += [str(t)+':'+val]
 
-    return rrdtool.update(*params)
+    return timed_update(name, params, 1)
 
 
 
-def tune_rrd_pred(name, alpha=None, beta=None) :
-    """Permet de modifier les paramètres de prédiction alpha et beta des RRD"""
+def update_rrd_many(name, samples) :
+    """Ajoute plusieurs valeurs dans une rrd en un seul appel à rrdtool
+    samples est une liste de (timestamp, values) triée par timestamp croissant"""
 
-    if alpha :
-        rrdtool.tune(os.path.join(APP_ROOT, RRD_PATH, name+'.rrd'), '--alpha', str(alpha))
-    if beta :
-        rrdtool.tune(os.path.join(APP_ROOT, RRD_PATH, name+'.rrd'), '--beta', str(beta))
+    params = []
+    # Via rrdcached si besoin (il regroupe les écritures dans son journal)
+    params += daemon_args()
+    # Le nom de la RRD
+    params += [rrd_file(name)]
+    # Les valeurs de la RRD (une entrée <timestamp>:<valeurs> par échantillon)
+    for t, values in samples :
+        params += [str(int(t))+':'+':'.join(str(v) for v in values)]
 
-    return None
+    return timed_update(name, params, len(samples))
 
 
 
-def has_error (name, start='-1min') :
-    """Vérifie si une rrd (donc un capteur présente des erreurs"""
+def timed_update(name, params, count) :
+    """Appelle rrdtool.update en mesurant sa durée (cf metrics)"""
 
-    timerange, names, results = rrdtool.fetch(os.path.join(APP_ROOT, RRD_PATH, name+'.rrd'), 'FAILURES', '--start', start)
-    for i in range(len(results)) :
-        for j in range(len(names)) :
-            if results[i][j] == 1.0 :
-                return (i,j)
+    start = time.perf_counter()
+    try :
+        res = rrdtool.update(*params)
+    except Exception :
+        RRD_UPDATE_ERRORS.inc(1, name)
+        raise
+    finally :
+        RRD_UPDATE.observe(time.perf_counter() - start, name)
+    RRD_UPDATE_SAMPLES.inc(count, name)
 
-    return None
+    return res
+
+
+
+def last_rrd(name) :
+    """Renvoie le timestamp de la dernière mise à jour d'une rrd"""
 
+    return rrdtool.last(*(daemon_args() + [rrd_file(name)]))
 
 
 
+def tune_rrd_pred(name, alpha=None, beta=None) :
+    """Permet de modifier les paramètres de prédiction alpha et beta des RRD"""
+
+    # rrdtool.tune modifie directement le fichier
+    flush_rrd(name)
+
+    if alpha :
+        rrdtool.tune(rrd_file(name), '--alpha', str(alpha))
+    if beta :
+        rrdtool.tune(rrd_file(name), '--beta', str(beta))
+
+    return None
+
 
 
+class RRDCached :
+    """Lance le démon rrdcached (cf constant.py) et le relance s'il s'arrête"""
+
+    def __init__ (self, log=print) :
+        self.log = log
+        self.process = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def command (self) :
+        """Renvoie la ligne de commande de rrdcached"""
+
+        journal = os.path.join(APP_ROOT, RRDCACHED_JOURNAL)
+        os.makedirs(journal, exist_ok=True)
+        return [RRDCACHED_BIN,
+                # Au premier plan pour pouvoir le surveiller
+                '-g',
+                '-l', RRDCACHED,
+                # Le journal permet de ne rien perdre en cas d'arrêt brutal
+                '-j', journal,
+                # Écriture des données d'un fichier toutes les RRDCACHED_WRITE s
+                # (étalées sur RRDCACHED_DELAY s pour ne pas tout écrire en même temps)
+                '-w', str(RRDCACHED_WRITE), '-z', str(RRDCACHED_DELAY),
+                # Seuls les fichiers du dossier des RRD sont acceptés
+                '-b', os.path.join(APP_ROOT, RRD_PATH), '-B']
+
+    def supervise (self) :
+        while not self.stopping.is_set() :
+            self.process = subprocess.Popen(self.command())
+            self.log('rrdcached lancé (pid '+str(self.process.pid)+')')
+            code = self.process.wait()
+            if not self.stopping.is_set() :
+                self.log('rrdcached s\'est arrêté (code '+str(code)+'), relance dans '+str(RRDCACHED_RESTART)+' s')
+                self.stopping.wait(RRDCACHED_RESTART)
+
+    def start (self) :
+        """Lance et surveille rrdcached dans un thread dédié"""
+
+        self.thread = threading.Thread(target=self.supervise, daemon=True)
+        self.thread.start()
+
+        # On laisse à rrdcached le temps de créer son socket avant les premières écritures
+        if RRDCACHED.startswith('unix:') :
+            socket_path = RRDCACHED[len('unix:'):]
+            for i in range(50) :
+                if os.path.exists(socket_path) :
+                    break
+                time.sleep(0.1)
+
+        return None
+
+    def stop (self) :
+        """Arrête rrdcached (qui écrit alors toutes ses données en attente)"""
+
+        self.stopping.set()
+        if self.process :
+            self.process.terminate()
+            self.process.wait()
+        return None
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+import json
+import numpy as np
+from .constant import *
+from .rrd import rrd_archives, subsecond_name, has_subsecond
+from .fetch import cached_fetch, fetch_array
+from .graph import resolution
+
+# Les réductions proposées par l'API : min/max/moyenne par pixel ou points choisis (LTTB)
+REDUCERS = ['minmax', 'lttb']
+
+def buckets(t, start, end, width) :
+    """Les indices des premières lignes de chaque pixel (sans pixel vide)
+    quand la période [start, end] est affichée sur width pixels"""
+
+    edges = start + (end - start)*np.arange(width)/float(width)
+    idx = np.unique(np.searchsorted(t, edges))
+    return idx[idx < len(t)]
+
+
+
+def minmax(t, lo, hi, avg, start, end, width) :
+    """Réduit des séries (une colonne par grandeur) à une ligne par pixel :
+    minimum de lo, maximum de hi et moyenne de avg (NaN ignorés)
+    Renvoie (dates de début des pixels, minimums, maximums, moyennes)"""
+
+    idx = buckets(t, start, end, width)
+    if not len(idx) :
+        return t[:0], lo[:0], hi[:0], avg[:0]
+
+    known = ~np.isnan(avg)
+    sums = np.add.reduceat(np.where(known, avg, 0), idx, axis=0)
+    counts = np.add.reduceat(known, idx, axis=0)
+    means = np.divide(sums, counts, out=np.full(sums.shape, np.nan), where=counts > 0)
+    return t[idx], np.fmin.reduceat(lo, idx, axis=0), np.fmax.reduceat(hi, idx, axis=0), means
+
+
+
+def lttb(t, y, width) :
+    """Largest-Triangle-Three-Buckets : choisit width points de (t, y) qui gardent
+    l'allure de la courbe (les valeurs inconnues sont retirées)
+    Renvoie (dates, valeurs) des points choisis"""
+
+    known = ~np.isnan(y)
+    t, y = t[known], y[known]
+    n = len(t)
+    if width >= n or width < 3 :
+        return t, y
+
+    every = (n - 2)/float(width - 2)
+    chosen = np.empty(width, dtype=np.int64)
+    chosen[0] = a = 0
+    for i in range(width - 2) :
+        # Le seau courant et la moyenne du seau suivant
+        s, e = int(i*every) + 1, int((i+1)*every) + 1
+        ns, ne = e, min(int((i+2)*every) + 1, n)
+        if ns >= ne :
+            ns, ne = n - 1, n
+        avg_t, avg_y = t[ns:ne].mean(), y[ns:ne].mean()
+        # Le point qui forme le plus grand triangle avec le point choisi précédent et cette moyenne
+        area = np.abs((t[a] - avg_t)*(y[s:e] - y[a]) - (t[a] - t[s:e])*(avg_y - y[a]))
+        a = s + int(np.argmax(area))
+        chosen[i+1] = a
+    chosen[-1] = n - 1
+    return t[chosen], y[chosen]
+
+
+
+def columns(series, names) :
+    """Les colonnes names d'une Series (tableau à 2 dimensions)"""
+
+    return series.values[:, [series.names.index(n) for n in names]]
+
+
+
+def subsecond_peaks(filename, cf, avg, names, peaks, combine) :
+    """Combine les pics peaks (MIN ou MAX selon cf) lus avec la Series avg avec ceux
+    de la RRD de pics à l'intérieur des secondes (cf create_subsecond_rrd), lue aux
+    mêmes dates (sinon peaks est renvoyé tel quel)"""
+
+    sub = cached_fetch(subsecond_name(filename, cf), cf, avg.start, avg.end, avg.step).after(avg.start)
+    if sub.step != avg.step or sub.start != avg.start or len(sub) < len(avg) :
+        return peaks
+    return combine(peaks, columns(sub, names)[:len(avg)])
+
+
+
+def probe_series(filename, names, start, end, width, reducer='minmax', band=False) :
+    """Les grandeurs names d'une RRD entre start et end (timestamps), réduites à width pixels
+
+    Les données sont lues dans l'archive choisie comme pour les graphes (cf resolution),
+    avec ses archives MIN et MAX quand elles existent et les pics à l'intérieur des
+    secondes du capteur (cf subsecond_peaks) quand il en a. Renvoie un dico :
+    start, end, step (résolution lue), reducer (None si rien à réduire),
+    series {grandeur : {'avg', 'min', 'max'}} avec les dates dans t pour minmax
+    ou {grandeur : {'t', 'v'}} pour lttb, plus band {'t', 'series' : {grandeur :
+    {'pred', 'lower', 'upper'}}} (prédiction de Holt-Winters ± 2 déviations,
+    sur la partie de la période encore couverte) si band est vrai"""
+
+    step, peaks = resolution(filename, start, end, width)
+    if not step :
+        step = 1
+
+    avg = cached_fetch(filename, 'AVERAGE', start, end, step).after(start)
+    t = avg.times
+    values = columns(avg, names)
+    lo = hi = values
+    if peaks :
+        lo = columns(cached_fetch(filename, 'MIN', start, end, step).after(start), names)[:len(t)]
+        hi = columns(cached_fetch(filename, 'MAX', start, end, step).after(start), names)[:len(t)]
+        if len(lo) != len(t) or len(hi) != len(t) :
+            lo = hi = values
+    if has_subsecond(filename) :
+        lo = subsecond_peaks(filename, 'MIN', avg, names, lo, np.fmin)
+        hi = subsecond_peaks(filename, 'MAX', avg, names, hi, np.fmax)
+
+    res = {'start' : start, 'end' : end, 'step' : avg.step, 'reducer' : None, 'series' : {}}
+    if reducer == 'lttb' and len(t) > width :
+        res['reducer'] = 'lttb'
+        for i, n in enumerate(names) :
+            pt, pv = lttb(t, values[:, i], width)
+            res['series'][n] = {'t' : pt, 'v' : pv}
+    else :
+        if len(t) > width :
+            res['reducer'] = 'minmax'
+            t, lo, hi, values = minmax(t, lo, hi, values, start, end, width)
+        # Les dates sont communes à toutes les grandeurs
+        res['t'] = t
+        for i, n in enumerate(names) :
+            res['series'][n] = {'avg' : values[:, i], 'min' : lo[:, i], 'max' : hi[:, i]}
+
+    if band :
+        res['band'] = hw_band(filename, names, start, end, width)
+    return res
+
+
+
+def hw_band(filename, names, start, end, width) :
+    """La bande de prédiction (HWPREDICT ± 2 DEVPREDICT, comme dans graph_detail)
+    moyennée par pixel, limitée à la partie de la période couverte par l'archive"""
+
+    archives, last = rrd_archives(filename)
+    if not 'HWPREDICT' in archives or not 'DEVPREDICT' in archives :
+        return {}
+    res, rows = archives['HWPREDICT'][0]
+    first = max(start, last - res*rows)
+    if first >= end :
+        return {}
+
+    pred = fetch_array(filename, 'HWPREDICT', first, end, res).after(first)
+    dev = fetch_array(filename, 'DEVPREDICT', first, end, res).after(first)
+    count = min(len(pred), len(dev))
+    t = pred.times[:count]
+    p = columns(pred, names)[:count]
+    d = columns(dev, names)[:count]
+    if count > width :
+        bt, lo, hi, p = minmax(t, p, p, p, first, end, width)
+        bt, lo, hi, d = minmax(t, d, d, d, first, end, width)
+        t = bt
+
+    band = {'t' : t, 'series' : {}}
+    for i, n in enumerate(names) :
+        band['series'][n] = {'pred' : p[:, i], 'lower' : p[:, i] - 2*d[:, i], 'upper' : p[:, i] + 2*d[:, i]}
+    return band
+
+
+
+def to_json(data) :
+    """Le résultat de probe_series en JSON compact (valeurs arrondies, null pour inconnu)"""
+
+    def compact(v) :
+        if isinstance(v, dict) :
+            return {k : compact(x) for k, x in v.items()}
+        if isinstance(v, np.ndarray) :
+            if v.dtype.kind in 'iu' :
+                return v.tolist()
+            return [None if x != x else x for x in np.round(v, 3).tolist()]
+        return v
+
+    return json.dumps(compact(data), separators=(',', ':'))
+
+
+
+def to_binary(data) :
+    """Le résultat de probe_series en tableaux float64 petit-boutistes mis bout à bout
+    Renvoie (octets, description) où la description liste les tableaux dans l'ordre,
+    avec leur chemin dans le résultat et leur longueur (ex : t:1000,series.courant.avg:1000)"""
+
+    arrays = []
+    layout = []
+
+    def walk(prefix, v) :
+        if isinstance(v, dict) :
+            for k, x in v.items() :
+                walk(prefix+k+'.', x)
+        elif isinstance(v, np.ndarray) :
+            arrays.append(v.astype('<f8'))
+            layout.append(prefix[:-1]+':'+str(len(v)))
+
+    walk('', data)
+    body = np.concatenate(arrays).tobytes() if arrays else b''
+    return body, ','.join(layout)
@@ -0,0 +1,504 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+import socket
+import threading
+import multiprocessing
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .constant import *
+from .data import decode_many
+from .batch import Batcher
+from .aggregate import Aggregator
+from .groups import GroupAggregator
+from .registry import ProbeRegistry, shard_of
+from .journal import Journal, JournalReplayer
+from .rrd import subsecond_name, has_subsecond, create_subsecond_rrd
+from .metrics import PACKETS, BYTES, UNKNOWN_MACS, DROPPED, FORWARDED, QUEUE_DEPTH, PROBES, REMOTE, snapshot
+
+def make_socket(host, port, reuseport=False) :
+    """Crée et attache un socket UDP non bloquant pour la réception des données"""
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # Un gros tampon noyau pour absorber les rafales
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SERVER_RCVBUF)
+    # Plusieurs processus peuvent écouter sur le même port (le noyau répartit les paquets)
+    if reuseport :
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.setblocking(False)
+    return sock
+
+
+
+class IngestProtocol (asyncio.DatagramProtocol) :
+    """Reçoit les paquets des capteurs et les passe au serveur sans jamais bloquer
+    forwarded indique que les paquets viennent d'un autre processus d'écoute"""
+
+    def __init__ (self, server, forwarded=False) :
+        self.server = server
+        self.forwarded = forwarded
+
+    def datagram_received (self, data, addr) :
+        self.server.receive(data, self.forwarded)
+
+    def error_received (self, exc) :
+        self.server.log('Erreur sur le socket des capteurs : '+str(exc))
+
+
+
+class IngestServer :
+    """Serveur UDP asynchrone qui reçoit les données des capteurs
+
+    La réception (IngestProtocol) vide le socket en continu et dépose les
+    échantillons valides dans une file bornée. Une tâche d'écriture consomme
+    cette file, regroupe les échantillons par seconde (cf Aggregator) et écrit
+    les données dans les RRD par paquets (cf Batcher) dans un thread à part :
+    une écriture lente ne bloque donc jamais la réception.
+
+    probes donne le filename des capteurs à remplir à partir de leur mac
+    (ProbeRegistry ou simple dictionnaire {mac : filename})
+
+    En mode multi-processus (shards > 1), le serveur n'écrit que dans les RRD
+    des capteurs tels que shard_of(mac, shards) == shard et transmet les
+    autres paquets au processus propriétaire sur son port privé
+    (INGEST_BASE_PORT + numéro). Ainsi deux processus n'écrivent jamais dans
+    le même fichier. Avec shard à None, le serveur ne fait que répartir et
+    avec public à False il n'écoute que sur son port privé.
+
+    Avec un journal (cf Journal), les secondes regroupées y sont écrites dès
+    la réception (sans passer par la file) et un JournalReplayer les écrit
+    dans les RRD en tâche de fond.
+
+    Les pics d'une seconde qui a reçu plusieurs échantillons sont écrits par le
+    même chemin dans les RRD de pics du capteur (cf create_subsecond_rrd), créées
+    dans le thread d'écriture à la première seconde de ce genre.
+
+    Les secondes regroupées alimentent aussi les RRD des groupes de capteurs
+    (cf GroupAggregator), qui passent par le même chemin (journal ou Batcher).
+    RQ : un groupe a besoin de tous ses capteurs, ce n'est donc fait que
+    par un serveur unique (shards <= 1)."""
+
+    def __init__ (self, probes=None, host=None, port=None, queue_size=None, batcher=None, log=print,
+            shard=0, shards=1, reuseport=False, public=True, journal=None) :
+        self.probes = probes if probes is not None else {}
+        self.host = host if host is not None else SERVER_IP
+        self.port = port if port else SERVER_PORT
+        self.shard = shard
+        self.shards = shards
+        self.reuseport = reuseport
+        self.public = public
+        self.queue_size = queue_size if queue_size else QUEUE_SIZE
+        self.batcher = batcher if batcher else Batcher()
+        self.log = log
+        self.journal = journal
+        self.replayer = JournalReplayer(journal, self.batcher, log) if journal else None
+        # Les secondes regroupées vont dans le journal ou directement dans le Batcher
+        self.destination = self.journalize if journal else self.batcher.add
+        self.groups = GroupAggregator(self.probes, self.destination) if shards <= 1 else None
+        self.aggregator = Aggregator(self.emit, peak=self.peak)
+        # La dernière seconde écrite dans les RRD de pics {filename : seconde (0 au début)}
+        self.subsecond = {}
+        # Les capteurs dont les RRD de pics sont en cours de création (ou en échec)
+        self.creating = set()
+        # Les capteurs et groupes supprimés (ou recréés) n'ont plus rien à écrire
+        if hasattr(self.probes, 'watch') :
+            self.probes.watch(self.forget)
+
+        self.loop = None
+        self.queue = None
+        self.stopping = None
+        self.thread = None
+        self.transport = None
+        self.private = None
+        # Les paquets reçus pas encore décodés [(data, forwarded), ...]
+        self.inbox = []
+        # Les écritures RRD sont faites dans un unique thread à part
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def receive (self, data, forwarded=False) :
+        """Met un paquet de côté (appelé par IngestProtocol)
+        Les paquets arrivés pendant un même tour de boucle sont décodés ensemble"""
+
+        self.inbox.append((data, forwarded))
+        if len(self.inbox) == 1 :
+            self.loop.call_soon(self.process)
+
+        return None
+
+    def process (self) :
+        """Décode les paquets en attente et met les échantillons en file"""
+
+        inbox = self.inbox
+        self.inbox = []
+
+        PACKETS.inc(len(inbox))
+        BYTES.inc(sum(len(data) for data, forwarded in inbox))
+
+        samples = decode_many([data for data, forwarded in inbox])
+
+        sent = set()
+        for i, ident, t, values in samples :
+            # L'échantillon appartient à un autre processus : on lui transmet le paquet tel quel
+            # (un paquet binaire peut contenir des capteurs de plusieurs processus)
+            if self.shards > 1 :
+                owner = shard_of(ident, self.shards)
+                if owner != self.shard :
+                    if not inbox[i][1] and not (i, owner) in sent :
+                        self.transport.sendto(inbox[i][0], ('127.0.0.1', INGEST_BASE_PORT+owner))
+                        sent.add((i, owner))
+                        FORWARDED.inc()
+                    continue
+
+            name = self.probes.get(ident)
+            if not name :
+                UNKNOWN_MACS.inc()
+                continue
+
+            if self.journal :
+                self.aggregator.add(name, values, t)
+                continue
+
+            try :
+                self.queue.put_nowait((name, values, t))
+            except asyncio.QueueFull :
+                DROPPED.inc()
+
+        if self.journal :
+            self.seal_due()
+
+        return None
+
+    def emit (self, name, values, t) :
+        """Écrit une seconde regroupée d'un capteur et la passe à ses groupes"""
+
+        self.destination(name, values, t)
+        if self.groups :
+            self.groups.add(name, values, t)
+
+        return None
+
+    def peak (self, name, mins, maxs, t) :
+        """Écrit les pics d'une seconde qui a reçu plusieurs échantillons (cf Aggregator)"""
+
+        last = self.subsecond.get(name)
+        if last is None :
+            if name in self.creating :
+                return None
+            if not has_subsecond(name) :
+                # Les pics de cette seconde sont perdus le temps de la création
+                self.creating.add(name)
+                if self.loop and self.loop.is_running() :
+                    self.loop.run_in_executor(self.executor, self.create_subsecond, name, t)
+                else :
+                    self.create_subsecond(name, t)
+                return None
+            last = 0
+
+        for cf, values in (('MIN', mins), ('MAX', maxs)) :
+            # Avec un heartbeat de 1 s, une seconde écrite après un trou serait inconnue
+            if last != t - 1 :
+                self.destination(subsecond_name(name, cf), ['U']*6, t - 1)
+            self.destination(subsecond_name(name, cf), values, t)
+        self.subsecond[name] = t
+
+        return None
+
+    def create_subsecond (self, name, t) :
+        """Crée les RRD de pics d'un capteur (dans le thread d'écriture)
+        RQ : en cas d'échec, on ne réessaie pas avant que le capteur soit oublié"""
+
+        try :
+            create_subsecond_rrd(name, t)
+        except Exception as e :
+            self.log('Impossible de créer les RRD de pics de '+name+'.rrd : '+str(e))
+        else :
+            self.creating.discard(name)
+        return None
+
+    def seal_due (self) :
+        """Scelle les secondes des capteurs et des groupes qui n'attendent plus rien"""
+
+        self.aggregator.seal_due()
+        if self.groups :
+            self.groups.seal_due()
+
+        return None
+
+    def seal_all (self) :
+        """Scelle toutes les secondes en attente (avant un arrêt)"""
+
+        self.aggregator.seal_all()
+        if self.groups :
+            self.groups.seal_all()
+
+        return None
+
+    def forget (self, name) :
+        """Oublie les secondes en attente d'une RRD supprimée ou recréée (cf ProbeRegistry.watch) :
+        une RRD recréée sous le même nom repart de sa propre dernière mise à jour
+        RQ : appelée depuis d'autres threads (pages web), l'oubli se fait dans la boucle du serveur"""
+
+        if self.loop and self.loop.is_running() :
+            self.loop.call_soon_threadsafe(self.drop, name)
+        else :
+            self.drop(name)
+        return None
+
+    def drop (self, name) :
+        self.aggregator.forget(name)
+        if self.groups :
+            self.groups.forget(name)
+        self.batcher.forget(name)
+        self.subsecond.pop(name, None)
+        self.creating.discard(name)
+        for cf in ['MIN', 'MAX'] :
+            self.batcher.forget(subsecond_name(name, cf))
+        return None
+
+    def journalize (self, name, values, t) :
+        """Écrit une seconde regroupée dans le journal"""
+
+        try :
+            if not self.journal.append(name, values, t) :
+                DROPPED.inc()
+        except ValueError as e :
+            DROPPED.inc()
+            self.log(str(e))
+
+        return None
+
+    async def write (self) :
+        """Consomme la file des échantillons et les écrit dans les RRD"""
+
+        while not self.stopping.is_set() or not self.queue.empty() :
+            # On attend un échantillon (au plus SERVER_TIMEOUT s pour écrire les données trop vieilles)
+            try :
+                name, values, t = await asyncio.wait_for(self.queue.get(), SERVER_TIMEOUT)
+            except asyncio.TimeoutError :
+                pass
+            else :
+                self.aggregator.add(name, values, t)
+                # On prend tout ce qui est déjà arrivé sans rendre la main
+                while not self.queue.empty() :
+                    name, values, t = self.queue.get_nowait()
+                    self.aggregator.add(name, values, t)
+
+            self.seal_due()
+            if self.batcher.due() :
+                await self.flush()
+
+        # On écrit tout ce qui reste avant de s'arrêter
+        self.seal_all()
+        await self.flush(force=True)
+
+    async def tick (self) :
+        """Scelle régulièrement les secondes des capteurs qui n'envoient plus rien (avec un journal)"""
+
+        while not self.stopping.is_set() :
+            try :
+                await asyncio.wait_for(self.stopping.wait(), SERVER_TIMEOUT)
+            except asyncio.TimeoutError :
+                pass
+            self.seal_due()
+
+        self.seal_all()
+
+    async def flush (self, force=False) :
+        """Écrit les données en attente dans un thread à part"""
+
+        errors = await self.loop.run_in_executor(self.executor, self.batcher.flush, force)
+        for name, e in errors :
+            self.log('Erreur lors de l\'écriture dans '+name+'.rrd : '+str(e))
+
+    async def serve (self) :
+        """Lance le serveur dans la boucle courante jusqu'à l'appel de stop()"""
+
+        self.loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.stopping = asyncio.Event()
+
+        # Les métriques calculées au moment de leur lecture (rien à faire ici)
+        QUEUE_DEPTH.set_function(self.queue.qsize, 'queue')
+        QUEUE_DEPTH.set_function(lambda: sum(len(s) for s in list(self.batcher.pending.values())), 'batch')
+        if self.journal :
+            QUEUE_DEPTH.set_function(self.journal.pending, 'journal')
+        PROBES.set_function(lambda: len(self.probes))
+
+        if self.public :
+            self.transport, protocol = await self.loop.create_datagram_endpoint(
+                    lambda: IngestProtocol(self), sock=make_socket(self.host, self.port, self.reuseport))
+        # Le port privé sur lequel les autres processus transmettent nos paquets
+        if self.shards > 1 and self.shard is not None :
+            self.private, protocol = await self.loop.create_datagram_endpoint(
+                    lambda: IngestProtocol(self, forwarded=True), sock=make_socket('127.0.0.1', INGEST_BASE_PORT+self.shard))
+        try :
+            # Avec un journal, c'est le JournalReplayer qui écrit dans les RRD
+            if self.journal :
+                await self.tick()
+            else :
+                await self.write()
+        finally :
+            if self.transport :
+                self.transport.close()
+            if self.private :
+                self.private.close()
+
+    def start (self) :
+        """Lance le serveur dans un thread dédié avec sa propre boucle asyncio"""
+
+        started = threading.Event()
+
+        def run() :
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            self.loop = loop
+            task = loop.create_task(self.serve())
+            loop.call_soon(started.set)
+            try :
+                loop.run_until_complete(task)
+            finally :
+                loop.close()
+
+        self.thread = threading.Thread(target=run)
+        self.thread.start()
+        started.wait()
+
+        if self.replayer :
+            self.replayer.start()
+
+        return None
+
+    def stop (self) :
+        """Arrête le serveur : plus aucune réception, écriture des données en attente"""
+
+        if self.loop and self.stopping :
+            self.loop.call_soon_threadsafe(self.stopping.set)
+        if self.thread :
+            self.thread.join()
+            self.thread = None
+        self.executor.shutdown()
+
+        # La relecture s'arrête une fois le journal vidé
+        if self.replayer :
+            self.replayer.stop()
+            self.journal.flush()
+
+        return None
+
+
+
+##################################
+## Écoute sur plusieurs process ##
+##################################
+
+def run_worker(shard, shards, database, reuseport, stop, report=None) :
+    """Corps d'un processus d'écoute : un IngestServer limité à ses capteurs
+    dont le registre est tenu à jour via le compteur de la BDD
+    Ses métriques sont envoyées dans la file report toutes les INGEST_METRICS_INTERVAL s"""
+
+    registry = ProbeRegistry(database, shard, shards)
+    registry.load()
+
+    # Chaque processus a son propre journal
+    journal = Journal(os.path.join(APP_ROOT, JOURNAL+'.'+str(shard))) if JOURNAL else None
+
+    # Sans SO_REUSEPORT, c'est le répartiteur qui écoute sur SERVER_PORT
+    server = IngestServer(registry, shard=shard, shards=shards,
+            reuseport=reuseport, public=reuseport, journal=journal)
+    server.start()
+
+    # Les métriques pas encore transmises ne doivent pas empêcher l'arrêt
+    if report is not None :
+        report.cancel_join_thread()
+    reported = 0
+    while not stop.wait(REGISTRY_POLL) :
+        registry.refresh()
+        if report is not None and time.time() - reported >= INGEST_METRICS_INTERVAL :
+            report.put((shard, snapshot()))
+            reported = time.time()
+
+    server.stop()
+    return None
+
+
+
+class ShardedIngest :
+    """Répartit la réception des données sur INGEST_WORKERS processus
+
+    Chaque processus est propriétaire d'un sous-ensemble fixe des capteurs
+    (cf shard_of) et donc des fichiers .rrd correspondants. Les processus
+    partagent SERVER_PORT grâce à SO_REUSEPORT quand le système le permet,
+    sinon un répartiteur dans le processus courant leur transmet les paquets.
+
+    Les processus sont créés par fork : spawn() doit être appelé avant que le
+    processus courant ait lancé le moindre thread (cf kerrucent.py), start()
+    lance ensuite les threads du processus courant. Chaque processus
+    envoie ses métriques, que /metrics affiche avec le label shard (cf collect)."""
+
+    def __init__ (self, database, workers=None, log=print) :
+        self.database = database
+        self.workers = workers if workers else INGEST_WORKERS
+        self.log = log
+        self.reuseport = INGEST_REUSEPORT and hasattr(socket, 'SO_REUSEPORT')
+
+        # fork et pas spawn : un nouvel import de kerrucent relancerait toute l'appli
+        self.context = multiprocessing.get_context('fork')
+        self.stopping = self.context.Event()
+        self.report = self.context.Queue()
+        self.processes = []
+        self.dispatcher = None
+        self.collector = None
+
+    def spawn (self) :
+        """Lance les processus d'écoute"""
+
+        for shard in range(self.workers) :
+            p = self.context.Process(target=run_worker,
+                    args=(shard, self.workers, self.database, self.reuseport, self.stopping, self.report))
+            p.start()
+            self.processes.append(p)
+        return None
+
+    def start (self) :
+        """Lance les processus d'écoute s'ils ne le sont pas déjà, puis le répartiteur
+        (si besoin) et la collecte des métriques"""
+
+        if not self.processes :
+            self.spawn()
+
+        # Les threads seulement une fois les processus lancés
+        if not self.reuseport :
+            self.dispatcher = IngestServer(shard=None, shards=self.workers, log=self.log)
+            self.dispatcher.start()
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+        self.log(str(self.workers)+' processus d\'écoute lancés'+('' if self.reuseport else ' (avec répartiteur)'))
+        return None
+
+    def collect (self) :
+        """Garde les dernières métriques envoyées par chaque processus d'écoute (cf metrics.REMOTE)"""
+
+        while not self.stopping.is_set() :
+            try :
+                shard, samples = self.report.get(timeout=1)
+            except queue.Empty :
+                continue
+            REMOTE[shard] = samples
+        return None
+
+    def stop (self) :
+        """Arrête les processus d'écoute (qui écrivent leurs données en attente)"""
+
+        if self.dispatcher :
+            self.dispatcher.stop()
+            self.dispatcher = None
+        self.stopping.set()
+        for p in self.processes :
+            p.join()
+        self.processes = []
+        REMOTE.clear()
+        return None
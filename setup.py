@@ -7,6 +7,7 @@ setup(
     install_requires=[
         'flask',
         'rrdtool',
+        'numpy',
         'email_validator',
         'smtplib',
         'MIMEText'
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import pytest
+
+rrdtool = pytest.importorskip('rrdtool')
+
+# On importe scripts seul : le paquet kerrucent lance toute l'appli
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'kerrucent'))
+from scripts import rrd, fetch
+
+@pytest.fixture
+def probe(tmp_path, monkeypatch) :
+    """Une RRD de capteur mise à jour jusqu'à il y a 5 s, et un cache des lectures vide"""
+
+    monkeypatch.setattr(rrd, 'APP_ROOT', str(tmp_path))
+    monkeypatch.setattr(fetch, 'CACHE', fetch.FetchCache())
+    os.makedirs(os.path.join(str(tmp_path), rrd.RRD_PATH))
+    now = int(time.time())
+    rrd.create_rrd('capteur', now - 120, profile='standard')
+    rrdtool.update(rrd.rrd_file('capteur'), *[str(t)+':2:231:11:101:21:111' for t in range(now - 119, now - 4)])
+    return now
+
+
+
+def test_repeated_alert_check_is_cached(probe, monkeypatch) :
+    """Une vérification d'alerte répétée sans nouvelle mise à jour ne relit pas la RRD"""
+
+    reads = []
+    read = fetch.fetch_array
+    monkeypatch.setattr(fetch, 'fetch_array', lambda *a : reads.append(a) or read(*a))
+
+    assert fetch.has_error('capteur', probe - 60) is None
+    assert reads
+    assert all(a[1] == 'FAILURES' for a in reads)
+
+    del reads[:]
+    assert fetch.has_error('capteur', probe - 60) is None
+    assert not reads
+    assert len(fetch.CACHE)
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import pytest
+
+rrdtool = pytest.importorskip('rrdtool')
+
+# On importe scripts seul : le paquet kerrucent lance toute l'appli
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'kerrucent'))
+from scripts import rrd
+from scripts.importer import Importer
+
+MAC = '00:11:22:33:44:55'
+VALUES = [1.5, 230.0, 10.0, 100.0, 20.0, 110.0]
+
+@pytest.fixture
+def probe(tmp_path, monkeypatch) :
+    """Une RRD de capteur créée il y a 10 s, mise à jour depuis"""
+
+    monkeypatch.setattr(rrd, 'APP_ROOT', str(tmp_path))
+    os.makedirs(os.path.join(str(tmp_path), rrd.RRD_PATH))
+    now = int(time.time())
+    rrd.create_rrd('capteur', now - 10, profile='standard')
+    rrdtool.update(rrd.rrd_file('capteur'), *[str(t)+':2:231:11:101:21:111' for t in range(now - 9, now - 4)])
+    return now
+
+
+
+def write_csv(path, start, count) :
+    with open(path, 'w') as f :
+        f.write('mac,timestamp,courant,tension,dephasage,puiss_active,puiss_reactive,puiss_apparente\n')
+        for t in range(start, start + count) :
+            f.write(MAC+','+str(t)+','+','.join(str(v) for v in VALUES)+'\n')
+    return path
+
+
+
+def values(filename, start, end) :
+    (first, last, step), names, rows = rrdtool.fetch(rrd.rrd_file(filename), 'AVERAGE',
+            '--start', str(start), '--end', str(end), '--resolution', '1')
+    return {first + step*(i+1) : row for i, row in enumerate(rows)}
+
+
+
+def test_import_older_than_rrd(probe, tmp_path) :
+    """L'historique antérieur à la RRD est importé, les données récentes sont gardées"""
+
+    now = probe
+    start = now - 3600
+    path = write_csv(str(tmp_path / 'historique.csv'), start, 120)
+
+    def create(filename, tmp, first) :
+        rrd.create_rrd(filename, first, profile='standard', path=tmp)
+
+    stats = Importer({MAC : 'capteur'}, create=create).run(path)
+    assert stats['written'] == 120
+    assert stats['skipped'] == 0
+    assert stats['rebuilt'] == 1
+    assert not os.path.exists(rrd.rrd_file('capteur')+'.import')
+
+    imported = values('capteur', start, start + 119)
+    for t in range(start + 1, start + 120) :
+        assert imported[t] == pytest.approx(tuple(VALUES))
+
+    # Les secondes écrites dans la RRD avant l'import sont recopiées
+    assert rrdtool.last(rrd.rrd_file('capteur')) == now - 5
+    recent = values('capteur', now - 8, now - 5)
+    assert recent[now - 5] == pytest.approx((2, 231, 11, 101, 21, 111))
+
+
+
+def test_import_older_than_rrd_without_create(probe, tmp_path) :
+    """Sans create, l'historique antérieur à la RRD est ignoré"""
+
+    path = write_csv(str(tmp_path / 'historique.csv'), probe - 3600, 120)
+
+    stats = Importer({MAC : 'capteur'}).run(path)
+    assert stats['written'] == 0
+    assert stats['skipped'] == 120
+    assert stats['rebuilt'] == 0
+
+
+
+def test_import_overlapping_rrd(probe, tmp_path) :
+    """Les données de la RRD priment sur l'historique importé qui les recouvre"""
+
+    now = probe
+    start = now - 3600
+    path = write_csv(str(tmp_path / 'historique.csv'), start, 3600 - 6)
+
+    def create(filename, tmp, first) :
+        rrd.create_rrd(filename, first, profile='standard', path=tmp)
+
+    stats = Importer({MAC : 'capteur'}, create=create).run(path)
+    assert stats['rebuilt'] == 1
+    assert stats['written'] == 3600 - 9
+    assert stats['skipped'] == 3
+
+    kept = values('capteur', now - 12, now - 5)
+    assert kept[now - 10] == pytest.approx(tuple(VALUES))
+    for t in range(now - 8, now - 4) :
+        assert kept[t] == pytest.approx((2, 231, 11, 101, 21, 111))
+
+
+
+def test_import_refused_inside_rrd(probe, tmp_path) :
+    """L'import ne reconstruit pas une RRD qui a des données avant son premier échantillon"""
+
+    now = probe
+    path = write_csv(str(tmp_path / 'historique.csv'), now - 7, 5)
+
+    def create(filename, tmp, first) :
+        rrd.create_rrd(filename, first, profile='standard', path=tmp)
+
+    stats = Importer({MAC : 'capteur'}, create=create).run(path)
+    assert stats['refused'] == 1
+    assert stats['rebuilt'] == 0
+    # Seuls les échantillons après la dernière mise à jour sont écrits
+    assert stats['written'] == 2
+
+    kept = values('capteur', now - 10, now - 5)
+    for t in range(now - 8, now - 4) :
+        assert kept[t] == pytest.approx((2, 231, 11, 101, 21, 111))
+
+
+
+def test_import_refused_longer_history(tmp_path, monkeypatch) :
+    """L'import ne reconstruit pas une RRD qui a plus d'historique que son archive
+    la plus fine : ses archives consolidées seraient perdues"""
+
+    monkeypatch.setattr(rrd, 'APP_ROOT', str(tmp_path))
+    monkeypatch.setitem(rrd.STORAGE_PROFILES, 'petit', dict(rrd.STORAGE_PROFILES['standard'],
+            rras=[(1, 600), (60, 1000)]))
+    os.makedirs(os.path.join(str(tmp_path), rrd.RRD_PATH))
+    now = int(time.time())
+    rrd.create_rrd('capteur', now - 1000, profile='petit')
+    rrdtool.update(rrd.rrd_file('capteur'), *[str(t)+':2:231:11:101:21:111' for t in range(now - 999, now - 4)])
+    before = values('capteur', now - 3000, now - 5)
+    path = write_csv(str(tmp_path / 'historique.csv'), now - 3600, 120)
+
+    def create(filename, tmp, first) :
+        rrd.create_rrd(filename, first, profile='petit', path=tmp)
+
+    stats = Importer({MAC : 'capteur'}, create=create).run(path)
+    assert stats['refused'] == 1
+    assert stats['rebuilt'] == 0
+    assert stats['skipped'] == 120
+    assert values('capteur', now - 3000, now - 5) == before
+    assert not os.path.exists(rrd.rrd_file('capteur')+'.import')